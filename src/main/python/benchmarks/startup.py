@@ -0,0 +1,81 @@
+"""
+Startup-time benchmark. Every measurement runs in a fresh interpreter, so
+nothing is already cached in sys.modules.
+
+Run from src/main/python with
+    python benchmarks/startup.py
+"""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import time
+t0 = time.perf_counter()
+import {module}
+print(time.perf_counter() - t0)
+"""
+
+# The window counts as shown once the event loop has processed the first round
+# of events after show(), i.e. when the first paint has been scheduled
+WINDOW_SNIPPET = """
+import time
+t0 = time.perf_counter()
+from PyQt5.QtCore import QTimer
+import main
+appctxt = main.ApplicationContext()
+main.appctxt = appctxt
+window = main.MainWindow()
+QTimer.singleShot(0, appctxt.app.quit)
+appctxt.app.exec_()
+print(time.perf_counter() - t0)
+"""
+
+
+def _run_snippet(snippet, repeats):
+    """Runs a snippet printing a single duration in fresh interpreters"""
+    timings = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", snippet],
+            cwd=PYTHON_DIR,
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout
+        timings.append(float(out.strip().splitlines()[-1]))
+    return np.array(timings)
+
+
+def time_import(module="lib.algorithms", repeats=5):
+    """Returns the cold import times of a module, in seconds"""
+    return _run_snippet(IMPORT_SNIPPET.format(module=module), repeats)
+
+
+def time_first_window(repeats=5):
+    """Returns the time from interpreter start to first shown window"""
+    return _run_snippet(WINDOW_SNIPPET, repeats)
+
+
+def report(name, timings):
+    print(
+        "{:<24} median {:8.1f} ms   min {:8.1f} ms   ({} runs)".format(
+            name,
+            np.median(timings) * 1e3,
+            np.min(timings) * 1e3,
+            len(timings),
+        )
+    )
+
+
+if __name__ == "__main__":
+    report("import lib.algorithms", time_import("lib.algorithms"))
+    try:
+        report("time-to-first-window", time_first_window())
+    except subprocess.CalledProcessError:
+        print("time-to-first-window    skipped (no Qt/fbs runtime available)")
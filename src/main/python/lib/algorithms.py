@@ -1,12 +1,18 @@
 import pandas as pd
 import numpy as np
-import pomegranate as pg
-from retrying import retry, RetryError
-from tqdm import tqdm
 import os
 import time
 
-import lib.utils
+import lib.backend
+import lib.background
+import lib.batch
+import lib.checkpoint
+import lib.labels
+import lib.pipeline
+import lib.ragged
+
+# pomegranate and tqdm are comparatively expensive to import, so they are only
+# loaded once the code paths that need them actually run
 
 
 def generate_traces(
@@ -34,6 +40,31 @@ def generate_traces(
     discard_unbleached=False,
     progressbar_callback=None,
     callback_every=1,
+    seed=None,
+    checkpoint_dir=None,
+    processes=1,
+    batch_size=1000,
+    backend="numpy",
+    state_model="hmm",
+    rates=None,
+    dwell=None,
+    exposure=1,
+    noise_model="gaussian",
+    brightness=100,
+    background=10,
+    em_gain=None,
+    background_pool=None,
+    background_scale=1,
+    trace_lengths=None,
+    gamma=1,
+    beta=1,
+    leakage=0,
+    direct_excitation=0,
+    dyes=None,
+    pipeline=None,
+    return_parameters=False,
+    first_trace=0,
+    batch_callback=None,
 ):
     """
     Parameters
@@ -74,7 +105,10 @@ def generate_traces(
         distribution. Sigma can be either a value or range.
     trans_mat:
         Transition matrix to be provided instead of the quick trans_prob
-        parameter.
+        parameter. With state_model="markov" or "kinetic" and given
+        state_means, state j is the j-th of the state means a trace uses, in
+        the given order. With state_model="hmm", and with random state means,
+        states are assigned to the means in random order.
     au_scaling_factor:
         Arbitrary unit scaling factor after trace generation. Can be value or
         range.
@@ -104,483 +138,366 @@ def generate_traces(
     callback_every:
         How often to callback to the progressbar
     progressbar_callback:
-        Progressbar callback object
+        Progressbar callback object. If None, progress is printed to the
+        terminal with tqdm instead.
+    seed:
+        Random seed. If None, the dataset is not reproducible. Every batch
+        draws from its own random stream, keyed by the seed and the index of
+        its first trace, so that any batch can be regenerated on its own (see
+        get_traces).
+    checkpoint_dir:
+        Directory to flush completed batches to. If it already contains a
+        checkpoint from the same parameters, generation resumes from the last
+        flushed batch. With a seed set, the resumed dataset is identical to
+        one generated without interruption. A run can be resumed with more
+        traces than it was started with, but not with fewer.
+    processes:
+        Number of worker processes. With more than one, traces are generated
+        in chunks of about 1000, a multiple of batch_size, and transported
+        back through shared memory (see lib.transport).
+    batch_size:
+        Number of traces simulated at once
+    backend:
+        Array backend to simulate on (see lib.backend)
+    state_model:
+        How FRET state paths are sampled: "hmm" samples every trace with
+        pomegranate, "markov" samples the whole batch at once (see
+        lib.markov), and "kinetic" samples transitions in continuous time,
+        including those within a frame.
+    rates:
+        With state_model="markov" or "kinetic", transition rates between
+        states in transitions per frame, instead of trans_mat. States are
+        assigned to the means as with trans_mat.
+    dwell:
+        With state_model="markov", the dwell time distribution of every
+        state, as a list of (distribution, *args) in frames, e.g.
+        [("exponential", 20), ("gamma", 2, 10)]. With given state_means,
+        the j-th distribution is that of the j-th state mean a trace uses,
+        in the given order. With random state means, states are assigned to
+        the means in random order.
+    exposure:
+        With state_model="kinetic", the fraction of each frame the camera is
+        exposed for. The signal is averaged over the exposure.
+    noise_model:
+        "gaussian" adds noise and gamma_noise as above. "photon" instead
+        samples Poisson photon counts from the intensities, with brightness,
+        background and em_gain below, and replaces noise and
+        gamma_noise_prob.
+    brightness:
+        With noise_model="photon", the photons per frame at an intensity of
+        1. Can be value or range.
+    background:
+        With noise_model="photon", the background photons per frame and
+        channel
+    em_gain:
+        With noise_model="photon", the EM gain of an EMCCD camera, which adds
+        excess noise, or None for no EM amplification
+    background_pool:
+        Pool of background recordings (see lib.background), or its path, to
+        add real background to all channels. The background is returned as
+        DD_bg, DA_bg and AA_bg, and E and S are those of the signals without
+        it.
+    background_scale:
+        Factor to convert the recorded background to the units of the
+        simulated signals. Can be value or range.
+    trace_lengths:
+        Distribution of the length of every trace, as a (low, high) range or
+        (distribution, *args) as for dwell, up to trace_length. Traces are
+        packed, one row per frame, without padding (see lib.ragged). None
+        for traces of trace_length frames.
+    gamma, beta, leakage, direct_excitation:
+        Correction factors of the simulated instrument, as value or range
+        per trace: the detection efficiency ratio gamma, the excitation
+        intensity ratio beta, donor leakage into the acceptor channel, and
+        direct excitation of the acceptor by the donor laser (see
+        lib.pipeline.CorrectionStage). E and S are the uncorrected,
+        apparent values, and the drawn factors are part of the parameters.
+    dyes:
+        Two-dye lib.dyes.DyeModel the DD, DA and AA intensities are computed
+        from, e.g. with spectral crosstalk in its emission matrix. None for
+        DyeModel.two_color().
+    pipeline:
+        Simulation pipeline (see lib.pipeline). If given, it replaces the
+        default pipeline built from the simulation parameters above.
+    return_parameters:
+        Whether to also return the per-trace parameters every trace was
+        simulated from, as a DataFrame indexed by trace name (see
+        lib.pipeline.parameter_table).
+    first_trace:
+        Index of the first trace to generate. Batches start at first_trace
+        and every batch_size traces after it, and traces are named by their
+        index.
+    batch_callback:
+        Function called with the DataFrame of every batch as soon as it's
+        generated, e.g. to update lib.population.PopulationHistogram while
+        generation is running. Batches resumed from a checkpoint are passed
+        as well.
+
+    Returns
+    -------
+    DataFrame of traces, or a tuple of (traces, parameters) if
+    return_parameters is set
     """
+    # Generation parameters, to make sure a checkpoint is only resumed with
+    # the parameters it was written with
+    params = {
+        k: v
+        for k, v in locals().items()
+        if k
+        not in (
+            "n_traces",
+            "progressbar_callback",
+            "callback_every",
+            "checkpoint_dir",
+            "processes",
+            "pipeline",
+            "return_parameters",
+            "first_trace",
+            "batch_callback",
+        )
+    }
+    if return_parameters and (processes > 1 or checkpoint_dir is not None):
+        raise ValueError(
+            "return_parameters requires processes=1 and no checkpoint_dir"
+        )
+    if batch_callback is not None and processes > 1:
+        raise ValueError("batch_callback requires processes=1")
+    if pipeline is None:
+        pipeline = lib.pipeline.build_pipeline(
+            state_means=state_means,
+            random_k_states_max=random_k_states_max,
+            min_state_diff=min_state_diff,
+            D_lifetime=D_lifetime,
+            A_lifetime=A_lifetime,
+            blink_prob=blink_prob,
+            bleed_through=bleed_through,
+            aa_mismatch=aa_mismatch,
+            trans_prob=trans_prob,
+            noise=noise,
+            trans_mat=trans_mat,
+            au_scaling_factor=au_scaling_factor,
+            aggregation_prob=aggregation_prob,
+            max_aggregate_size=max_aggregate_size,
+            null_fret_value=null_fret_value,
+            acceptable_noise=acceptable_noise,
+            scramble_prob=scramble_prob,
+            gamma_noise_prob=gamma_noise_prob,
+            merge_labels=merge_labels,
+            state_model=state_model,
+            rates=rates,
+            dwell=dwell,
+            exposure=exposure,
+            noise_model=noise_model,
+            brightness=brightness,
+            background=background,
+            em_gain=em_gain,
+            background_pool=background_pool,
+            background_scale=background_scale,
+            trace_lengths=trace_lengths,
+            gamma=gamma,
+            beta=beta,
+            leakage=leakage,
+            direct_excitation=direct_excitation,
+            dyes=dyes,
+        )
+    if processes > 1:
+        if checkpoint_dir is not None:
+            raise ValueError("Checkpointing requires processes=1")
+        from lib.transport import generate_traces_shared
+
+        return generate_traces_shared(
+            n_traces,
+            first_trace=first_trace,
+            processes=processes,
+            progressbar_callback=progressbar_callback,
+            callback_every=callback_every,
+            pipeline=pipeline,
+            **params
+        )
+    backend = lib.backend.get_backend(backend, seed=seed)
 
-    def _E(DD, DA):
-        return DA / (DD + DA)
-
-    def _S(DD, DA, AA):
-        return (DD + DA) / (DD + DA + AA)
-
-    def _DD(E):
-        return 1 - E
-
-    def _DA(DD, E):
-        return -(DD * E) / (E - 1)
-
-    def _AA(E):
-        return np.ones(len(E))
-
-    @retry
-    def generate_state_means(min_diff, k_states):
-        """Returns random values and retries if they are too closely spaced"""
-        states = np.random.uniform(0.01, 0.99, k_states)
-        diffs = np.diff(sorted(states))
-        if any(diffs < min_diff):
-            raise RetryError
-        return states
-
-    def generate_fret_states(kind, state_means, trans_mat, trans_prob):
-        """Creates artificial FRET states"""
-        if all(isinstance(s, float) for s in state_means):
-            kind = "defined"
+    start = first_trace
+    stop = first_trace + n_traces
+    traces = []
+    parameters = []
+    if checkpoint_dir is not None:
+        key = lib.checkpoint.run_key(dict(params, first_trace=first_trace))
+        next_trace, traces, entropy = lib.checkpoint.resume(checkpoint_dir, key)
+        if next_trace > stop:
+            # Batches of a shorter run aren't cut the same way, so the
+            # flushed traces can't be truncated to a shorter run
+            raise ValueError(
+                "Checkpoint in '{}' already holds traces up to {}, past the "
+                "requested end {}".format(checkpoint_dir, next_trace, stop)
+            )
+        if entropy is not None:
+            # Runs without a seed continue with the seed they started with
+            backend = lib.backend.get_backend(params["backend"], seed=entropy)
+            start = next_trace
+        if batch_callback is not None:
+            for batch in traces:
+                batch_callback(batch)
+
+    if progressbar_callback is None:
+        from tqdm import tqdm
+
+        progress = tqdm(total=n_traces, initial=start - first_trace)
+    else:
+        progress = None
+
+    for batch_start, batch in simulate_batches(
+        pipeline, backend, start, stop, batch_size, trace_length
+    ):
+        batch_stop = batch_start + batch.n_traces
+        if return_parameters:
+            parameters.append(
+                lib.pipeline.parameter_table(batch, first_name=batch_start)
+            )
+        batch = lib.pipeline.batch_to_frame(
+            batch,
+            first_name=batch_start,
+            discard_unbleached=discard_unbleached,
+        )
 
-        rand_k_states = np.random.randint(1, random_k_states_max + 1)
+        if checkpoint_dir is not None:
+            lib.checkpoint.flush(
+                checkpoint_dir,
+                key=key,
+                batch=batch,
+                start=batch_start,
+                stop=batch_stop,
+                entropy=backend.entropy,
+            )
+        traces.append(batch)
+        if batch_callback is not None:
+            batch_callback(batch)
 
-        if kind == "random":
-            k_states = rand_k_states
-            state_means = generate_state_means(min_state_diff, k_states)
-        elif kind == "aggregate":
-            state_means = np.random.uniform(0, 1)
-            k_states = 1
+        if progress is not None:
+            progress.update(batch_stop - batch_start)
         else:
-            if np.size(state_means) <= random_k_states_max:
-                # Pick the same amount of k states as state means given
-                k_states = np.size(state_means)
-            else:
-                # Pick no more than k_states_max from the state means (e.g.
-                # given [0.1, 0.2, 0.3, 0.4, 0.5] use only
-                # random_k_states_max of these)
-                k_states = rand_k_states
-                state_means = np.random.choice(
-                    state_means, size=k_states, replace=False
-                )
+            # Same number of callbacks as if traces were made one at a time
+            done = batch_start - first_trace
+            first = -(-done // callback_every) * callback_every
+            for _ in range(first, batch_stop - first_trace, callback_every):
+                progressbar_callback.increment()
 
-        if type(state_means) == float:
-            dists = [pg.NormalDistribution(state_means, 0)]
-        else:
-            dists = [pg.NormalDistribution(m, 0) for m in state_means]
+    if progress is not None:
+        progress.close()
 
-        starts = np.array([1 / k_states] * k_states)
+    if len(traces) > 1:
+        traces = pd.concat(traces)
+    else:
+        traces = traces[0]
 
-        lib.utils.random_seed_mp()
-        np.random.shuffle(dists)
+    if return_parameters:
+        parameters = pd.concat(parameters)
+        # Discarded traces are dropped from the parameters as well
+        parameters = parameters[parameters.index.isin(traces["name"])]
+        return traces, parameters
+    return traces
 
-        # Generate arbitrary transition matrix
-        if trans_mat is None:
-            trans_mat = np.empty([k_states, k_states])
-            trans_mat.fill(trans_prob)
-            np.fill_diagonal(trans_mat, 1 - trans_prob)
 
-            # Make sure that each row/column sums to exactly 1
-            if trans_prob != 0:
-                stay_prob = 1 - trans_prob
-                remaining_prob = 1 - trans_mat.sum(axis=0)
-                trans_mat[trans_mat == stay_prob] += remaining_prob
+def simulate_batches(pipeline, backend, start, stop, batch_size, trace_length):
+    """
+    Simulates the traces [start, stop) of a dataset in batches of batch_size.
+    Every batch draws from the random stream of its first trace, so a batch
+    is the same no matter which traces are simulated with it.
 
-        # Generate HMM model
-        model = pg.HiddenMarkovModel.from_matrix(
-            trans_mat, distributions=dists, starts=starts
+    Yields
+    ------
+    Tuples of (index of the first trace, simulated lib.batch.TraceBatch)
+    """
+    for batch_start in range(start, stop, batch_size):
+        backend.stream(batch_start)
+        batch = lib.batch.TraceBatch(
+            n_traces=min(batch_size, stop - batch_start),
+            trace_length=trace_length,
+            backend=backend,
         )
-        model.bake()
+        pipeline.run(batch)
+        yield batch_start, batch
 
-        E_true = np.array(model.sample(trace_length))
-        return E_true
-
-    def scramble(DD, DA, AA, cls, label):
-        """Scramble trace for model robustness"""
-
-        modify_trace = np.random.choice(("DD", "DA", "AA"))
-        if modify_trace == "DD":
-            c = DD
-        elif modify_trace == "DA":
-            c = DA
-        elif modify_trace == "AA":
-            c = AA
-        else:
-            raise ValueError
-
-        c[c != 0] = 1
-        # Create a sign wave and merge with trace
-        sinwave = np.sin(np.linspace(-10, np.random.randint(0, 1), len(DD)))
-        sinwave[c == 0] = 0
-        sinwave = sinwave ** np.random.randint(5, 10)
-        c += sinwave * 0.4
-        # Fix negatives
-        c = np.abs(c)
-
-        # Correlate heavily
-        DA *= AA * np.random.uniform(0.7, 1)
-        AA *= DA * np.random.uniform(0.7, 1)
-        DD *= AA * np.random.uniform(0.7, 1)
-
-        # Add dark state
-        add_dark = np.random.choice(("add", "noadd"))
-        if add_dark == "add":
-            dark_state_start = np.random.randint(0, 40)
-            dark_state_time = np.random.randint(10, 40)
-            dark_state_end = dark_state_start + dark_state_time
-            DD[dark_state_start:dark_state_end] = 0
-
-        # Add noise
-        if np.random.uniform(0, 1) < 0.1:
-            noise_start = np.random.randint(1, trace_length)
-            noise_time = np.random.randint(10, 50)
-            noise_end = noise_start + noise_time
-            if noise_end > trace_length:
-                noise_end = trace_length
-
-            DD[noise_start:noise_end] *= np.random.normal(
-                1, 1, noise_end - noise_start
-            )
 
-        # Flip traces
-        flip_trace = np.random.choice(("flipDD", "flipDA", "flipAA"))
-        if flip_trace == "flipDD":
-            DD = np.flip(DD)
-        elif flip_trace == "flipAA":
-            AA = np.flip(AA)
-        elif flip_trace == "flipDA":
-            DA = np.flip(DA)
-
-        DD, DA, AA = [np.abs(x) for x in (DD, DA, AA)]
-
-        label.fill(cls["scramble"])
-        return DD, DA, AA, label
-
-    def generate_single_trace(*args):
-        """Function to generate a single trace"""
-        (
-            i,
-            trans_prob,
-            au_scaling_factor,
-            noise,
-            bleed_through,
-            aa_mismatch,
-            scramble_prob,
-        ) = [np.array(arg) for arg in args]
-
-        # Simple table to keep track of labels
-        cls = {
-            "bleached": 0,
-            "aggregate": 1,
-            "noisy": 2,
-            "scramble": 3,
-            "1-state": 4,
-            "2-state": 5,
-            "3-state": 6,
-            "4-state": 7,
-            "5-state": 8,
-        }
-
-        name = [i.tolist()] * trace_length
-        frames = np.arange(1, trace_length + 1, 1)
-
-        if np.random.uniform(0, 1) < aggregation_prob:
-            is_aggregated = True
-            E_true = generate_fret_states(
-                kind="aggregate",
-                trans_mat=trans_mat,
-                trans_prob=0,
-                state_means=state_means,
-            )
-            if max_aggregate_size >= 2:
-                aggregate_size = np.random.randint(2, max_aggregate_size + 1)
-            else:
-                raise ValueError("Can't have an aggregate of size less than 2")
-            np.random.seed()
-            n_pairs = np.random.poisson(aggregate_size)
-            if n_pairs == 0:
-                n_pairs = 2
-        else:
-            is_aggregated = False
-            n_pairs = 1
-            trans_prob = np.random.uniform(trans_prob.min(), trans_prob.max())
-            E_true = generate_fret_states(
-                kind=state_means,
-                trans_mat=trans_mat,
-                trans_prob=trans_prob,
-                state_means=state_means,
-            )
+def get_traces(seed, start, stop, params):
+    """
+    Regenerates the traces [start, stop) of a seeded dataset, exactly as the
+    full run produced them, by only simulating the batches that contain them.
 
-        DD_total, DA_total, AA_total = [], [], []
-        first_bleach_all = []
-
-        for j in range(n_pairs):
-            np.random.seed()
-            if D_lifetime is not None:
-                bleach_D = int(np.ceil(np.random.exponential(D_lifetime)))
-            else:
-                bleach_D = None
-
-            if A_lifetime is not None:
-                bleach_A = int(np.ceil(np.random.exponential(A_lifetime)))
-            else:
-                bleach_A = None
-
-            first_bleach = lib.utils.min_none((bleach_D, bleach_A))
-            first_bleach_all.append(first_bleach)
-
-            # Calculate from underlying E
-            DD = _DD(E_true)
-            DA = _DA(DD, E_true)
-            AA = _AA(E_true)
-
-            # In case AA intensity doesn't correspond exactly to donor
-            # experimentally (S will be off)
-            AA += np.random.uniform(aa_mismatch.min(), aa_mismatch.max())
-
-            # If donor bleaches first
-            if first_bleach is not None:
-                if first_bleach == bleach_D:
-                    # Donor bleaches
-                    DD[bleach_D:] = 0
-                    # DA goes to zero because no energy is transferred
-                    DA[bleach_D:] = 0
-
-                # If acceptor bleaches first
-                elif first_bleach == bleach_A:
-                    # Donor is 1 when there's no acceptor
-                    DD[bleach_A:bleach_D] = 1
-                    if is_aggregated and n_pairs <= 2:
-                        # Sudden spike for small aggregates to mimic
-                        # observations
-                        spike_len = np.min((np.random.randint(2, 10), bleach_D))
-                        DD[bleach_A : bleach_A + spike_len] = 2
-
-            # No matter what, zero each signal after its own bleaching
-            if bleach_D is not None:
-                DD[bleach_D:] = 0
-            if bleach_A is not None:
-                DA[bleach_A:] = 0
-                AA[bleach_A:] = 0
-
-            # Append to total fluorophore intensity per channel
-            DD_total.append(DD)
-            DA_total.append(DA)
-            AA_total.append(AA)
-
-        DD, DA, AA = [np.sum(x, axis=0) for x in (DD_total, DA_total, AA_total)]
-
-        # Initialize -1 label for whole trace
-        label = np.zeros(trace_length)
-        label.fill(-1)
-
-        # Calculate when a channel is bleached. For aggregates, it's when a
-        # fluorophore channel hits 0 from bleaching (because 100% FRET not
-        # considered possible)
-        if is_aggregated:
-            # First bleaching for
-            bleach_DD_all = np.argmax(DD == 0)
-            bleach_DA_all = np.argmax(DA == 0)
-            bleach_AA_all = np.argmax(AA == 0)
-
-            # Find first bleaching overall
-            first_bleach_all = lib.utils.min_none(
-                (bleach_DD_all, bleach_DA_all, bleach_AA_all)
-            )
-            if first_bleach_all == 0:
-                first_bleach_all = None
-            label.fill(cls["aggregate"])
-        else:
-            # Else simply check whether DD or DA bleaches first from lifetimes
-            first_bleach_all = lib.utils.min_none(first_bleach_all)
-
-        # Save unblinked fluorophores to calculate E_true
-        DD_no_blink, DA_no_blink = DD.copy(), DA.copy()
-
-        # No blinking in aggregates (excessive/complicated)
-        if not is_aggregated:
-            if np.random.uniform(0, 1) < blink_prob:
-                blink_start = np.random.randint(1, trace_length)
-                blink_time = np.random.randint(1, 15)
-
-                # Blink either donor or acceptor
-                if np.random.uniform(0, 1) < 0.5:
-                    DD[blink_start : (blink_start + blink_time)] = 0
-                    DA[blink_start : (blink_start + blink_time)] = 0
-                else:
-                    DA[blink_start : (blink_start + blink_time)] = 0
-                    AA[blink_start : (blink_start + blink_time)] = 0
-
-        if first_bleach_all is not None:
-            label[first_bleach_all:] = cls["bleached"]
-            E_true[first_bleach_all:] = null_fret_value
-
-        for x in (DD, DA, AA):
-            # Bleached points get label 0
-            label[x == 0] = cls["bleached"]
-
-        if is_aggregated:
-            first_bleach_all = np.argmin(label)
-            if first_bleach_all == 0:
-                first_bleach_all = None
-
-        # Scramble trace, but only if contains 1 or 2 pairs (diminishing
-        # effect otherwise)
-        is_scrambled = False
-        if np.random.uniform(0, 1) < scramble_prob and n_pairs <= 2:
-            DD, DA, AA, label = scramble(
-                DD=DD, DA=DA, AA=AA, cls=cls, label=label
+    Parameters
+    ----------
+    seed:
+        Seed of the full run
+    start, stop:
+        Range of trace indices (names) to regenerate
+    params:
+        Keyword arguments the full run was generated with, including
+        n_traces, and batch_size if it wasn't the default
+    """
+    params = dict(params)
+    n_traces = params.pop("n_traces")
+    params.pop("seed", None)
+    params.pop("processes", None)
+    params.pop("checkpoint_dir", None)
+    batch_size = params.get("batch_size", 1000)
+    if not 0 <= start < stop <= n_traces:
+        raise ValueError(
+            "Traces [{}, {}) are not in a dataset of {} traces".format(
+                start, stop, n_traces
             )
-            is_scrambled = True
-
-        # Figure out bleached places before true signal is modified:
-        is_bleached = np.zeros(trace_length)
-        for x in (DD, DA, AA):
-            is_bleached[x == 0] = 1
-
-        # Add donor bleed-through
-        DD_bleed = np.random.uniform(bleed_through.min(), bleed_through.max())
-        DA[DD != 0] += DD_bleed
-
-        # Re-adjust E_true to match offset caused by correction factors
-        # so technically it's not the true, corrected FRET, but actually the
-        # un-noised
-        E_true[E_true != null_fret_value] = _E(
-            DD_no_blink[E_true != null_fret_value],
-            DA_no_blink[E_true != null_fret_value],
-        )
-
-        # Add gaussian noise
-        noise = np.random.uniform(noise.min(), noise.max())
-        x = [s + np.random.normal(0, noise, len(s)) for s in (DD, DA, AA)]
-
-        # Add centered gamma noise
-        if np.random.uniform(0, 1) < gamma_noise_prob:
-            for signal in x:
-                gnoise = np.random.gamma(1, noise * 1.1, len(signal))
-                signal += gnoise
-                signal -= np.mean(gnoise)
-
-        # Scale trace to AU units and calculate observed E and S as one would
-        # in real experiments
-        au_scaling_factor = np.random.uniform(
-            au_scaling_factor.min(), au_scaling_factor.max()
-        )
-        DD, DA, AA = [s * au_scaling_factor for s in x]
-
-        E_obs = _E(DD, DA)
-        S_obs = _S(DD, DA, AA)
-
-        # FRET from fluorophores that aren't bleached
-        E_unbleached = E_obs[:first_bleach_all]
-        E_unbleached_true = E_true[:first_bleach_all]
-
-        # Count actually observed states, because a slow system might not
-        # transition in the observation window
-        observed_states = np.unique(E_true[E_true != null_fret_value])
-
-        # Calculate noise level for each FRET state, and check if it
-        # surpasses the limit
-        is_noisy = False
-        for state in observed_states:
-            noise_level = np.std(E_unbleached[E_unbleached_true == state])
-            if noise_level > acceptable_noise:
-                label[label != cls["bleached"]] = cls["noisy"]
-                is_noisy = True
-
-        # For all FRET traces, assign the number of states observed
-        if not any((is_noisy, is_aggregated, is_scrambled)):
-            for i in range(5):
-                k_states = i + 1
-                if len(observed_states) == k_states:
-                    label[label != cls["bleached"]] = cls[
-                        "{}-state".format(k_states)
-                    ]
-
-        # Bad traces don't contain FRET
-        if any((is_noisy, is_aggregated, is_scrambled)):
-            E_true.fill(-1)
-
-        # Everything that isn't FRET is 0, and FRET is 1
-        if merge_labels:
-            label[label <= 3] = 0
-            label[label >= 4] = 1
-
-        if discard_unbleached:
-            if label[-1] != cls["bleached"]:
-                return pd.DataFrame()
-
-        # Calculate difference between states if >=2 states and actual smFRET
-        if label[0] in [5, 6, 7, 8]:
-            min_diff = np.min(np.diff(state_means))
-        else:
-            min_diff = np.nan
-
-        # Columns pre-fixed with underscore contain metadata, and only the
-        # first value should be used (repeated because table structure)
-        trace = pd.DataFrame(
-            {
-                "DD": DD,
-                "DA": DA,
-                "AA": AA,
-                "E": E_obs,
-                "E_true": E_true,
-                "S": S_obs,
-                "frame": frames,
-                "name": name,
-                "label": label,
-                "_bleaches_at": np.array(first_bleach_all).repeat(trace_length),
-                "_noise_level": np.array(noise).repeat(trace_length),
-                "_min_state_diff": np.array(min_diff).repeat(trace_length),
-            }
         )
-        trace.replace([np.inf, -np.inf], np.nan, inplace=True)
-        trace.fillna(method="pad", inplace=True)
-        return trace
 
-    processes = tqdm(range(n_traces))
-    traces = []
-    for i in processes:
-        traces.append(
-            generate_single_trace(
-                i,
-                trans_prob,
-                au_scaling_factor,
-                noise,
-                bleed_through,
-                aa_mismatch,
-                scramble_prob,
-            )
+    # Batches are aligned as in the full run, so they draw from the same
+    # random streams
+    first = start - start % batch_size
+    last = min(-(-stop // batch_size) * batch_size, n_traces)
+    traces = generate_traces(
+        n_traces=last - first, seed=seed, first_trace=first, **params
+    )
+    if params.get("return_parameters"):
+        traces, parameters = traces
+        return (
+            traces[traces["name"].between(start, stop - 1)],
+            parameters[(parameters.index >= start) & (parameters.index < stop)],
         )
-        if progressbar_callback is not None:
-            if (i % callback_every) == 0:
-                progressbar_callback.increment()
+    return traces[traces["name"].between(start, stop - 1)]
 
-    if len(traces) > 1:
-        traces = pd.concat(traces)
-    else:
-        traces = traces[0]
 
-    return traces
+def get_trace(seed, i, params):
+    """
+    Regenerates trace i of a seeded dataset, exactly as the full run produced
+    it. Parameters are as in get_traces.
+    """
+    return get_traces(seed, i, i + 1, params)
 
 
 def sim_to_ascii(df, trace_len, outdir):
     """
-    Saves simulated traces to ASCII .txt files
+    Saves simulated traces to ASCII .txt files. trace_len is the length of
+    every trace, or None for traces of different lengths, which are split
+    by name.
     """
-    df.index = np.arange(0, len(df), 1) // trace_len
-
-    y = []
+    if trace_len is None:
+        packed = lib.ragged.PackedTraces.from_frame(df, columns=["label"])
+    else:
+        n_traces = len(df) // trace_len
+        offsets = np.arange(n_traces + 1) * trace_len
+        packed = lib.ragged.PackedTraces({"label": df["label"].values}, offsets)
+    df.index = packed.segment_ids()
+
+    # Padding as bleached doesn't change the class of a trace
+    label, _ = packed.pad(fill=lib.labels.Label.BLEACHED)
+    y = lib.labels.trace_labels(label[:, :, 0])
     exp_txt = "Simulated trace"
     for idx, trace in df.groupby(df.index):
-        l = trace["label"].values
-        l = l[l != 0]
-        l = 0 if l.size == 0 else l[0]
-        y.append(int(l))
-
-        bg = np.zeros(len(trace))
         path = os.path.join(
             outdir, "trace_{}_{}.txt".format(idx, time.strftime("%Y%m%d_%H%M"))
         )
 
         df = pd.DataFrame(
             {
-                "D-Dexc-bg": bg,
-                "A-Dexc-bg": bg,
-                "A-Aexc-bg": bg,
+                "D-Dexc-bg": lib.background.trace_background(trace, "DD"),
+                "A-Dexc-bg": lib.background.trace_background(trace, "DA"),
+                "A-Aexc-bg": lib.background.trace_background(trace, "AA"),
                 "D-Dexc-rw": trace["DD"],
                 "A-Dexc-rw": trace["DA"],
                 "A-Aexc-rw": trace["AA"],
@@ -592,7 +509,7 @@ def sim_to_ascii(df, trace_len, outdir):
         date_txt = "Date: {}".format(time.strftime("%Y-%m-%d, %H:%M"))
         mov_txt = "Movie filename: {}".format(None)
         id_txt = "FRET pair #{}".format(idx)
-        bl_txt = "Bleaches at {}".format(trace["fb"].values[0])
+        bl_txt = "Bleaches at {}".format(trace["_bleaches_at"].values[0])
 
         with open(path, "w") as f:
             f.write(
@@ -610,16 +527,15 @@ def sim_to_ascii(df, trace_len, outdir):
                     df.to_csv(index=False, sep="\t"),
                 )
             )
-    y = pd.Series(y)
-    y = labels_to_binary(y, one_hot=False, to_ones=(2, 3))
+    y = pd.Series(y.astype(int))
+    y = labels_to_binary(
+        y,
+        one_hot=False,
+        to_ones=(lib.labels.Label.NOISY, lib.labels.Label.SCRAMBLE),
+    )
     y.to_csv(os.path.join(outdir, "y.txt"), sep="\t")
 
 
 def labels_to_binary(y, one_hot, to_ones):
     """Converts group labels to binary labels, given desired targets"""
-    if one_hot:
-        y = y.argmax(axis=2)
-    y[~np.isin(y, to_ones)] = -1
-    y[y != -1] = 1
-    y[y != 1] = 0
-    return y
+    return lib.labels.to_binary(y, one_hot, to_ones)
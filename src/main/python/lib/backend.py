@@ -0,0 +1,270 @@
+"""
+Array backends for the trace simulator. A backend bundles an array namespace
+(xp), which TraceBatch allocates its arrays with, with a source of random
+numbers. NumPy is the default, and ThreadedBackend draws large random arrays
+on several CPU threads. The stages of lib.pipeline and lib.kernels work on
+numpy arrays, so backends must produce them.
+
+Backends can be checked against each other with
+    python -m lib.backend
+"""
+
+import concurrent.futures
+import os
+
+import numpy as np
+
+
+class NumpyBackend:
+    """
+    Default backend. Arrays are numpy arrays, and random numbers are drawn
+    from a numpy Generator. All distributions are derived from the standard
+    ones, so that backends only have to provide _standard().
+
+    Besides its main stream, a backend can switch to a counter-based Philox
+    stream keyed by (seed, index) with stream(), which gives direct access to
+    the random numbers of any part of a dataset without drawing everything
+    that comes before it.
+    """
+
+    name = "numpy"
+
+    def __init__(self, seed=None):
+        self.xp = np
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
+
+    @property
+    def entropy(self):
+        """Seed of the backend, which is random if none was given"""
+        return self.seed_sequence.entropy
+
+    def stream(self, index):
+        """Switches to the random stream keyed by (seed, index)"""
+        seed_sequence = np.random.SeedSequence(
+            self.seed_sequence.entropy,
+            spawn_key=self.seed_sequence.spawn_key + (index,),
+        )
+        self.rng = np.random.Generator(np.random.Philox(seed_sequence))
+
+    def asarray(self, x, dtype=None):
+        """Converts to an array of the backend"""
+        return self.xp.asarray(x, dtype=dtype)
+
+    def to_numpy(self, x):
+        """Converts an array of the backend to a numpy array"""
+        return np.asarray(x)
+
+    def _standard(self, method, size, out=None, **kwargs):
+        """
+        Draws from one of the Generator's standard_* distributions. With out,
+        a preallocated float64 array is filled in place instead of allocating
+        a new one, and size is ignored.
+        """
+        if out is not None:
+            return getattr(self.rng, method)(out=out, **kwargs)
+        return getattr(self.rng, method)(size=size, **kwargs)
+
+    def standard_normal(self, out):
+        """Fills out with standard normal draws, in place"""
+        return self._standard("standard_normal", None, out=out)
+
+    def standard_gamma(self, shape, out):
+        """Fills out with Gamma(shape, 1) draws, in place"""
+        return self._standard("standard_gamma", None, out=out, shape=shape)
+
+    def random(self, size):
+        return self.asarray(self._standard("random", size))
+
+    def uniform(self, low, high, size):
+        low, high = np.asarray(low), np.asarray(high)
+        return self.asarray(low + (high - low) * self._standard("random", size))
+
+    def normal(self, loc, scale, size):
+        return self.asarray(
+            loc + np.asarray(scale) * self._standard("standard_normal", size)
+        )
+
+    def exponential(self, scale, size):
+        return self.asarray(
+            np.asarray(scale) * self._standard("standard_exponential", size)
+        )
+
+    def gamma(self, shape, scale, size):
+        return self.asarray(
+            np.asarray(scale)
+            * self._standard("standard_gamma", size, shape=shape)
+        )
+
+    def integers(self, low, high, size):
+        return self.asarray(self.rng.integers(low, high, size))
+
+    def poisson(self, lam):
+        return self.asarray(self.rng.poisson(lam))
+
+    def choice(self, a, size, replace=True):
+        return self.asarray(self.rng.choice(a, size, replace=replace))
+
+
+class ThreadedBackend(NumpyBackend):
+    """
+    NumPy backend that fills large random arrays from several threads. Arrays
+    are always split into n_chunks row chunks, each with an independent
+    stream spawned from the backend's seed, and the chunks are spread over
+    the threads, so the numbers drawn don't depend on the number of threads
+    or of CPU cores. Numpy releases the GIL while filling arrays, so this
+    scales with CPU cores.
+    """
+
+    name = "threaded"
+
+    # Below this many elements, threading costs more than it saves
+    min_size = 100000
+    # Fixed, so that seeded datasets are the same on every machine
+    n_chunks = 16
+
+    def __init__(self, seed=None, n_threads=None):
+        super().__init__(seed=seed)
+        self.n_threads = os.cpu_count() if n_threads is None else n_threads
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.n_threads)
+
+    def _standard(self, method, size, out=None, **kwargs):
+        shape = np.atleast_1d(size if out is None else out.shape)
+        if np.prod(shape) < self.min_size or shape[0] < self.n_chunks:
+            return super()._standard(method, size, out=out, **kwargs)
+
+        if out is None:
+            out = np.empty(shape)
+        chunks = np.array_split(np.arange(shape[0]), self.n_chunks)
+        seeds = np.random.SeedSequence(self.rng.integers(2**63)).spawn(
+            self.n_chunks
+        )
+
+        def fill(chunk, seed):
+            rng = np.random.default_rng(seed)
+            rows = slice(chunk[0], chunk[-1] + 1)
+            # Array parameters, like the shape of gamma draws, are split up
+            # with the output
+            chunk_kwargs = {
+                k: np.broadcast_to(v, shape)[rows] if np.ndim(v) > 0 else v
+                for k, v in kwargs.items()
+            }
+            getattr(rng, method)(out=out[rows], **chunk_kwargs)
+
+        list(self.executor.map(fill, chunks, seeds))
+        return out
+
+
+BACKENDS = {"numpy": NumpyBackend, "threaded": ThreadedBackend}
+
+
+def get_backend(backend="numpy", seed=None):
+    """
+    Returns a backend instance. backend can be a name from BACKENDS, or an
+    existing backend instance, which is returned as is.
+    """
+    if isinstance(backend, NumpyBackend):
+        return backend
+    try:
+        return BACKENDS[backend](seed=seed)
+    except (KeyError, TypeError):
+        raise ValueError(
+            "Unknown backend '{}'. Available: {}".format(
+                backend, ", ".join(BACKENDS)
+            )
+        )
+
+
+def ks_statistic(a, b):
+    """Two-sample Kolmogorov-Smirnov statistic"""
+    a, b = np.sort(a), np.sort(b)
+    values = np.concatenate((a, b))
+    cdf_a = np.searchsorted(a, values, side="right") / len(a)
+    cdf_b = np.searchsorted(b, values, side="right") / len(b)
+    return np.max(np.abs(cdf_a - cdf_b))
+
+
+def check_conformance(
+    backends=("numpy", "threaded"),
+    n_traces=2000,
+    trace_length=200,
+    seed=0,
+    **kwargs
+):
+    """
+    Checks that every backend gives a statistically equivalent dataset to
+    the first one. Datasets are generated by lib.algorithms.generate_traces,
+    with kwargs passed on, so every stage the simulator runs is covered.
+    Distributions are compared with a two-sample Kolmogorov-Smirnov test at
+    the 0.1% level, and label fractions within 4 standard errors.
+
+    Returns
+    -------
+    Tuple of (whether all backends conform, dict of per-backend results)
+    """
+    from lib.algorithms import generate_traces
+    from lib.utils import NoProgress
+
+    datasets = {}
+    for i, name in enumerate(backends):
+        backend = get_backend(name, seed=seed + i)
+        df = generate_traces(
+            n_traces,
+            trace_length=trace_length,
+            backend=backend,
+            progressbar_callback=NoProgress(),
+            **kwargs
+        )
+        trace = df["name"].values
+        firsts = np.flatnonzero(np.r_[True, trace[1:] != trace[:-1]])
+        lengths = np.diff(np.append(firsts, len(df)))
+        bleaches_at = df["_bleaches_at"].values[firsts]
+        datasets[backend.name] = {
+            # Frames within a trace are correlated, so signals are compared
+            # on a single frame per trace to keep samples independent
+            "DD": df["DD"].values[firsts],
+            "DA": df["DA"].values[firsts],
+            "AA": df["AA"].values[firsts],
+            "E_true": df["E_true"].values[firsts],
+            "bleaches_at": np.array(
+                [np.nan if b is None else b for b in bleaches_at], dtype=float
+            ),
+            "noise": df["_noise_level"].values[firsts],
+            "label": np.add.reduceat(df["label"].values == 0, firsts) / lengths,
+        }
+
+    names = list(datasets)
+    ref = datasets[names[0]]
+    results = {}
+    for name in names[1:]:
+        data = datasets[name]
+        checks = {}
+        for key in ("DD", "DA", "AA", "E_true", "bleaches_at", "noise"):
+            a, b = ref[key], data[key]
+            a, b = a[np.isfinite(a)], b[np.isfinite(b)]
+            n = len(a) * len(b) / (len(a) + len(b))
+            critical = 1.95 / np.sqrt(n)
+            checks[key] = ks_statistic(a, b) < critical
+
+        f_ref, f = ref["label"], data["label"]
+        se = np.sqrt(np.var(f_ref) / len(f_ref) + np.var(f) / len(f))
+        checks["bleached_fraction"] = abs(np.mean(f) - np.mean(f_ref)) < 4 * se
+        results[name] = checks
+
+    conforms = all(all(c.values()) for c in results.values())
+    return conforms, results
+
+
+if __name__ == "__main__":
+    # Run as lib.backend, so that generate_traces recognizes the backends
+    from lib.backend import check_conformance
+
+    conforms, results = check_conformance()
+    for name, checks in results.items():
+        for check, passed in checks.items():
+            print(
+                "{:<12} {:<20} {}".format(
+                    name, check, "ok" if passed else "FAIL"
+                )
+            )
+    print("All backends conform" if conforms else "Backends do NOT conform")
@@ -0,0 +1,128 @@
+"""
+Background recorded in real experiments, added to simulated traces to get
+camera and background artifacts that a noise model misses. Recordings are
+kept in a pool file that is memory-mapped, so that only the segments drawn
+for a batch are read from disk, however large the pool is, e.g.
+
+    write_pool("background.npy", DD_bg, DA_bg, AA_bg)
+    traces = generate_traces(10000, background_pool="background.npy")
+"""
+
+import numpy as np
+
+CHANNELS = ("DD", "DA", "AA")
+
+
+def write_pool(path, DD, DA, AA):
+    """
+    Writes a background pool file from recorded background traces.
+
+    Parameters
+    ----------
+    path:
+        Path of the .npy file to write
+    DD, DA, AA:
+        (n_recordings, length) background of the channels, which can be
+        memory-mapped themselves
+    """
+    n, length = np.shape(DD)
+    pool = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(n, length, len(CHANNELS))
+    )
+    for i, channel in enumerate((DD, DA, AA)):
+        pool[:, :, i] = channel
+    pool.flush()
+    del pool
+
+
+class BackgroundPool:
+    """
+    Memory-mapped pool of background recordings of shape (n_recordings,
+    length, channels), as written by write_pool.
+
+    Parameters
+    ----------
+    path:
+        Path of the pool file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self.data = np.load(self.path, mmap_mode="r")
+        if self.data.ndim != 3 or self.data.shape[2] != len(CHANNELS):
+            raise ValueError(
+                "Background pool must have shape (n_recordings, length, {}), "
+                "not {}".format(len(CHANNELS), self.data.shape)
+            )
+
+    def __getstate__(self):
+        # Worker processes map the file themselves, instead of receiving a
+        # copy of the whole pool
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+
+    def __repr__(self):
+        return "BackgroundPool('{}')".format(self.path)
+
+    @property
+    def n_recordings(self):
+        return self.data.shape[0]
+
+    @property
+    def length(self):
+        return self.data.shape[1]
+
+    def draw(self, backend, n, length):
+        """
+        Draws a random recording and a random offset into it for n segments
+        of the given length
+
+        Returns
+        -------
+        Tuple of (n,) recordings and (n,) offsets
+        """
+        if length > self.length:
+            raise ValueError(
+                "Background recordings are {} frames long, but {} are "
+                "needed".format(self.length, length)
+            )
+        recording = backend.integers(0, self.n_recordings, n)
+        offset = backend.integers(0, self.length - length + 1, n)
+        return recording, offset
+
+    def read(self, recording, offset, length):
+        """
+        Reads background segments [offset, offset + length) of recordings
+
+        Returns
+        -------
+        (channels, n, length) array of the segments
+        """
+        recording = np.asarray(recording, dtype=np.intp)
+        offset = np.asarray(offset, dtype=np.intp)
+        # Read in file order, so that the pages of the map are touched in
+        # sequence
+        order = np.argsort(recording * self.length + offset, kind="stable")
+        frames = offset[order, None] + np.arange(length)
+        segments = np.empty((len(CHANNELS), len(order), length))
+        segments[:, order] = np.moveaxis(
+            self.data[recording[order, None], frames], 2, 0
+        )
+        return segments
+
+
+def trace_background(trace, channel):
+    """
+    Background of a channel of a trace DataFrame, which is 0 if none was
+    added
+    """
+    column = channel + "_bg"
+    if column in trace:
+        return trace[column].values
+    return np.zeros(len(trace))
@@ -0,0 +1,289 @@
+"""
+Batched trace simulation. A TraceBatch holds N traces of length T as (N, T)
+arrays, and the operators in this module transform a whole batch (or a
+selected subset of it) at once, with per-trace random choices expressed as
+masks and fancy indexing instead of per-trace Python branching.
+"""
+
+import numpy as np
+
+import lib.backend
+from lib.labels import Label
+
+
+class TraceBatch:
+    """
+    Container for a batch of simulated traces. Signals, ground truth and
+    labels are (N, T) arrays, and per-trace values are kept in params as
+    (N,) arrays, forming a columnar table of the batch's parameters. Values
+    of the individual labelled pairs of aggregates are kept in pairs, with
+    the trace each pair belongs to as "owner". bleached marks the frames
+    where any channel is switched off, by bleaching or blinking.
+
+    E_averaged is the true FRET averaged over each frame's exposure, when
+    states can change within a frame, and None otherwise. background is the
+    (channels, N, T) background added to DD, DA and AA, if any.
+
+    Bleaching times that never happen are stored as inf. Traces can end
+    before trace_length, if a "length" is planned for them (see lengths).
+    """
+
+    def __init__(self, n_traces, trace_length, backend=None):
+        self.backend = lib.backend.get_backend(
+            "numpy" if backend is None else backend
+        )
+        xp = self.backend.xp
+        self.n_traces = n_traces
+        self.trace_length = trace_length
+
+        shape = (n_traces, trace_length)
+        self.E_true = xp.zeros(shape)
+        self.DD = xp.zeros(shape)
+        self.DA = xp.zeros(shape)
+        self.AA = xp.zeros(shape)
+        self.label = xp.full(shape, -1.0)
+        self.bleached = xp.zeros(shape, dtype=bool)
+        self.E = None
+        self.S = None
+        self.E_averaged = None
+        self.background = None
+        self.params = {
+            "aggregated": xp.zeros(n_traces, dtype=bool),
+            "n_pairs": xp.ones(n_traces, dtype=int),
+            "scrambled": xp.zeros(n_traces, dtype=bool),
+            "bleaches_at": xp.full(n_traces, np.inf),
+            "noise": xp.zeros(n_traces),
+        }
+        self.pairs = {"owner": xp.arange(n_traces)}
+
+    @property
+    def frames(self):
+        """(1, T) frame indices, for broadcasting against the batch"""
+        return self.backend.xp.arange(self.trace_length)[None, :]
+
+    @property
+    def lengths(self):
+        """(N,) number of frames of every trace"""
+        length = self.params.get("length")
+        if length is None:
+            return self.backend.xp.full(self.n_traces, self.trace_length)
+        return length
+
+    @property
+    def valid(self):
+        """(N, T) mask of the frames within the length of every trace"""
+        return self.frames < self.lengths[:, None]
+
+    def last(self, x):
+        """Value of an (N, T) array in the last frame of every trace"""
+        return x[self.backend.xp.arange(self.n_traces), self.lengths - 1]
+
+    def window(self, start, length):
+        """
+        Returns a (n, T) mask that is True in the frames [start, start +
+        length) of every row, with start and length given per row.
+        """
+        return (self.frames >= start[:, None]) & (
+            self.frames < (start + length)[:, None]
+        )
+
+
+def interval_sum(owner, start, stop, n_rows, length, weights=None):
+    """
+    Sums intervals [start, stop) into rows of a (n_rows, length) array, e.g.
+    to count how many fluorophores of each trace are still active in each
+    frame. Uses a difference array, so the cost is O(intervals + n_rows *
+    length) no matter how long the intervals are.
+
+    Parameters
+    ----------
+    owner:
+        Row of each interval
+    start, stop:
+        Interval boundaries. Can be inf, and are clipped to [0, length].
+    weights:
+        Value of each interval. Defaults to 1.
+    """
+    start = np.clip(start, 0, length).astype(int)
+    stop = np.clip(stop, 0, length).astype(int)
+    if weights is None:
+        weights = np.ones(len(owner))
+    size = n_rows * (length + 1)
+    diff = np.bincount(
+        owner * (length + 1) + start, weights=weights, minlength=size
+    ) - np.bincount(
+        owner * (length + 1) + stop, weights=weights, minlength=size
+    )
+    return np.cumsum(diff.reshape(n_rows, length + 1), axis=1)[:, :length]
+
+
+def first_true(mask, default=np.inf):
+    """Index of the first True of each row, or default if there is none"""
+    return np.where(mask.any(axis=1), np.argmax(mask, axis=1), default)
+
+
+def state_noise(E_true, E, use, null_fret_value):
+    """
+    Groups the frames of each trace by their true FRET state, and measures
+    how noisy the observed FRET is within each state.
+
+    Parameters
+    ----------
+    E_true:
+        (N, T) true FRET. Frames equal to null_fret_value have no state.
+    E:
+        (N, T) observed FRET
+    use:
+        (N, T) mask of the frames to measure noise from
+
+    Returns
+    -------
+    Tuple of (number of observed states, highest standard deviation of the
+    observed FRET within a state) for every trace. The standard deviation is
+    nan if no used frames are left.
+    """
+    N, T = E_true.shape
+    observed = (E_true != null_fret_value).ravel()
+    rows = np.repeat(np.arange(N), T)[observed]
+    states = E_true.ravel()[observed]
+    values = E.ravel()[observed]
+    use = use.ravel()[observed]
+
+    order = np.lexsort((states, rows))
+    rows, states, values, use = (
+        rows[order],
+        states[order],
+        values[order],
+        use[order],
+    )
+    is_new = np.ones(len(rows), dtype=bool)
+    is_new[1:] = (rows[1:] != rows[:-1]) | (states[1:] != states[:-1])
+    group = np.cumsum(is_new) - 1
+    group_rows = rows[is_new]
+
+    n_states = np.bincount(group_rows, minlength=N)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        count = np.bincount(group, weights=use)
+        mean = np.bincount(group, weights=np.where(use, values, 0)) / count
+        dev = np.where(use, values - mean[group], 0)
+        std = np.sqrt(np.bincount(group, weights=dev**2) / count)
+
+    # A trace is as noisy as its noisiest state. States with a nan std (no
+    # frames used, or non-finite E) are skipped
+    max_std = np.full(N, np.nan)
+    valid = ~np.isnan(std)
+    np.fmax.at(max_std, group_rows[valid], std[valid])
+    return n_states, max_std
+
+
+def scramble_batch(batch, selected):
+    """
+    Scrambles the selected traces of a batch for model robustness. Does the
+    same as scrambling each trace separately: one random channel is replaced
+    by a sine artifact, the channels are multiplied together, and a dark
+    state, a noise burst and a time-flip of a random channel are added at
+    random.
+
+    Parameters
+    ----------
+    batch:
+        TraceBatch to modify in place
+    selected:
+        Boolean mask of shape (N,) of the traces to scramble
+    """
+    backend = batch.backend
+    xp = backend.xp
+    rows = xp.nonzero(selected)[0]
+    n = len(rows)
+    if n == 0:
+        return
+    T = batch.trace_length
+    r = xp.arange(n)
+
+    # Channels stacked as (n, 3, T), in the order DD, DA, AA
+    signals = xp.stack((batch.DD[rows], batch.DA[rows], batch.AA[rows]), axis=1)
+
+    # Replace a random channel by a sine wave raised to a random power
+    channel = backend.integers(0, 3, n)
+    c = signals[r, channel]
+    is_on = c != 0
+    sinwave = (
+        xp.sin(xp.linspace(-10, 0, T))[None, :]
+        ** backend.integers(5, 10, n)[:, None]
+    )
+    signals[r, channel] = xp.where(is_on, 1 + sinwave * 0.4, 0.0)
+
+    # Correlate heavily
+    DD, DA, AA = signals[:, 0], signals[:, 1], signals[:, 2]
+    factors = backend.uniform(0.7, 1, (3, n, 1))
+    DA *= AA * factors[0]
+    AA *= DA * factors[1]
+    DD *= AA * factors[2]
+
+    # Add dark state to half of the traces
+    has_dark = backend.random(n) < 0.5
+    dark = batch.window(backend.integers(0, 40, n), backend.integers(10, 40, n))
+    DD[dark & has_dark[:, None]] = 0
+
+    # Add noise burst to 10% of the traces
+    has_burst = backend.random(n) < 0.1
+    burst = (
+        batch.window(backend.integers(1, T, n), backend.integers(10, 50, n))
+        & has_burst[:, None]
+    )
+    DD[burst] *= backend.normal(1, 1, int(burst.sum()))
+
+    # Flip a random channel
+    flip = backend.integers(0, 3, n)
+    signals[r, flip] = signals[r, flip, ::-1]
+
+    signals = xp.abs(signals)
+    batch.DD[rows] = signals[:, 0]
+    batch.DA[rows] = signals[:, 1]
+    batch.AA[rows] = signals[:, 2]
+    batch.label[rows] = Label.SCRAMBLE
+    batch.params["scrambled"][rows] = True
+
+
+def blink_batch(batch, selected, start, length, donor):
+    """
+    Adds a photoblinking event to the selected traces of a batch, switching
+    off either the donor (DD and DA) or the acceptor (DA and AA).
+
+    Parameters
+    ----------
+    batch:
+        TraceBatch to modify in place
+    selected:
+        Boolean mask of shape (N,) of the traces to blink
+    start, length:
+        First frame and number of frames of each blink, of shape (N,). Given
+        for every trace, so that blinks can be built with a single
+        broadcasted comparison instead of indexing each trace
+    donor:
+        Boolean mask of shape (N,), True where the donor blinks
+    """
+    blink = batch.window(start, length) & selected[:, None]
+    donor = donor[:, None]
+
+    batch.DD[blink & donor] = 0
+    batch.DA[blink] = 0
+    batch.AA[blink & ~donor] = 0
+    batch.bleached |= blink
+
+
+def bleed_through_batch(batch, bleed_through):
+    """
+    Adds donor bleed-through to the acceptor channel, wherever the donor
+    isn't bleached.
+
+    Parameters
+    ----------
+    batch:
+        TraceBatch to modify in place
+    bleed_through:
+        Bleed-through of each trace, of shape (N,)
+    """
+    xp = batch.backend.xp
+    batch.DA += xp.where(batch.DD != 0, bleed_through[:, None], 0.0)
@@ -0,0 +1,81 @@
+"""
+Checkpointing for long-running trace generation. Completed traces are flushed
+to disk in batches, together with an index and the seed the random streams of
+the batches are derived from, so that an interrupted run can be resumed from
+the last flushed batch and still produce the same dataset.
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+INDEX_NAME = "index.json"
+
+
+def run_key(params):
+    """Identifies the generation parameters a checkpoint was written with"""
+    s = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def load_index(checkpoint_dir):
+    """Returns the checkpoint index, or None if nothing has been flushed yet"""
+    path = os.path.join(checkpoint_dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def resume(checkpoint_dir, key):
+    """
+    Loads a checkpoint to resume from.
+
+    Returns
+    -------
+    Tuple of (index of the next trace to generate, list of flushed batches,
+    seed entropy of the run or None if starting from scratch)
+    """
+    index = load_index(checkpoint_dir)
+    if index is None:
+        return 0, [], None
+    if index["key"] != key:
+        raise ValueError(
+            "Checkpoint in '{}' was written with different generation "
+            "parameters".format(checkpoint_dir)
+        )
+
+    batches = [
+        pd.read_pickle(os.path.join(checkpoint_dir, b["file"]))
+        for b in index["batches"]
+    ]
+    return index["next_trace"], batches, index["entropy"]
+
+
+def flush(checkpoint_dir, key, batch, start, stop, entropy):
+    """
+    Writes a batch of traces [start, stop) and the seed entropy of the run,
+    which is needed to resume runs that weren't given a seed. The index is
+    replaced last, so a crash at any point leaves the previous checkpoint
+    intact.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    index = load_index(checkpoint_dir)
+    if index is None:
+        index = {"key": key, "batches": []}
+
+    filename = "batch_{:09d}_{:09d}.pkl".format(start, stop)
+    path = os.path.join(checkpoint_dir, filename)
+    batch.to_pickle(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+    index["batches"].append({"file": filename, "start": start, "stop": stop})
+    index["next_trace"] = stop
+    index["entropy"] = entropy
+
+    index_path = os.path.join(checkpoint_dir, INDEX_NAME)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
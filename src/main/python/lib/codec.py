@@ -0,0 +1,435 @@
+"""
+Compact storage of generated traces. Traces are written in blocks of
+block_size traces, and every block is encoded for what simulated traces
+look like and compressed on its own:
+
+- labels and E_true are long runs, and are run-length encoded
+- signals (DD, DA, AA and any background) are quantized to int16 with a
+  per-trace offset and scale, or stored as float16
+- E and S are quantized over a fixed range around [0, 1], and the outliers
+  of dividing noisy signals are stored losslessly next to them
+- per-trace metadata is stored once per trace instead of once per frame
+
+An index of the blocks at the end of the file allows reading any range of
+traces without decoding the rest, e.g.
+
+    with TraceWriter("traces.frt") as writer:
+        generate_traces(10 ** 6, batch_callback=writer.write)
+    traces = TraceReader("traces.frt").read(5000, 6000)
+"""
+
+import io
+import json
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import lib.ragged
+
+MAGIC = b"FRETTRC1"
+
+# Per-frame columns that are run-length encoded, and their dtypes
+RUN_COLUMNS = {"label": np.int16, "E_true": np.float64}
+
+# Per-trace metadata columns, stored once per trace
+META_COLUMNS = ("_bleaches_at", "_noise_level", "_min_state_diff")
+
+# Per-frame columns quantized over a fixed (low, high) range. Values outside
+# it, e.g. E of frames with almost no signal, are stored as they are.
+FIXED_RANGES = {"E": (-1.0, 2.0), "S": (-1.0, 2.0)}
+
+PRECISIONS = ("int16", "float16")
+INT16_MAX = 32767
+# Quantized value of nan
+INT16_NAN = -32768
+
+
+def _compressor(codec, level):
+    """(compress, decompress) functions of a codec"""
+    if codec == "zlib":
+        return (lambda b: zlib.compress(b, level)), zlib.decompress
+    if codec == "zstd":
+        # Optional, but faster at the same ratio
+        import zstandard
+
+        return (
+            zstandard.ZstdCompressor(level=level).compress,
+            zstandard.ZstdDecompressor().decompress,
+        )
+    if codec == "none":
+        return bytes, bytes
+    raise ValueError("Unknown codec '{}'".format(codec))
+
+
+def _pack_arrays(arrays):
+    """Serializes a dict of arrays as a JSON header and the raw buffers"""
+    header = {}
+    buffers = io.BytesIO()
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header[key] = (array.dtype.str, array.shape, buffers.tell())
+        buffers.write(array.tobytes())
+    header = json.dumps(header).encode()
+    return struct.pack("<I", len(header)) + header + buffers.getvalue()
+
+
+def _unpack_arrays(data):
+    (size,) = struct.unpack_from("<I", data)
+    header = json.loads(data[4 : 4 + size])
+    arrays = {}
+    for key, (dtype, shape, offset) in header.items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[key] = np.frombuffer(
+            data, dtype, count, offset=4 + size + offset
+        ).reshape(shape)
+    return arrays
+
+
+def run_length_encode(x):
+    """Values and lengths of the runs of equal values of a 1-D array"""
+    x = np.asarray(x)
+    if len(x) == 0:
+        return x[:0], np.zeros(0, dtype=np.int64)
+    # nan != nan, so nan runs are compared bitwise
+    same = (x[1:] == x[:-1]) | (np.isnan(x[1:]) & np.isnan(x[:-1]))
+    starts = np.flatnonzero(np.r_[True, ~same])
+    return x[starts], np.diff(np.append(starts, len(x)))
+
+
+def run_length_decode(values, lengths):
+    return np.repeat(values, lengths)
+
+
+def quantize(x, lengths):
+    """
+    Quantizes a flat per-frame array to int16, with an offset and scale per
+    trace of the given lengths. Non-finite values are stored as nan.
+
+    Returns
+    -------
+    Tuple of the int16 values and the (N,) offsets and scales
+    """
+    n = len(lengths)
+    finite = np.isfinite(x)
+    ids = np.repeat(np.arange(n), lengths)
+    low = np.full(n, np.inf)
+    high = np.full(n, -np.inf)
+    np.minimum.at(low, ids[finite], x[finite])
+    np.maximum.at(high, ids[finite], x[finite])
+    low[~np.isfinite(low)] = 0
+    high[~np.isfinite(high)] = 0
+
+    offset, scale = _range_to_scale(low, high)
+    return _to_int16(x, offset[ids], scale[ids]), offset, scale
+
+
+def dequantize(q, offset, scale, lengths):
+    return _from_int16(q, np.repeat(offset, lengths), np.repeat(scale, lengths))
+
+
+def _range_to_scale(low, high):
+    """Offset and scale that map [low, high] to [-INT16_MAX, INT16_MAX]"""
+    low, high = np.asarray(low, dtype=float), np.asarray(high, dtype=float)
+    scale = np.where(high > low, (high - low) / (2 * INT16_MAX), 1)
+    return (low + high) / 2, scale
+
+
+def _to_int16(x, offset, scale):
+    # INT16_NAN is left free, to mark non-finite values
+    q = np.rint((x - offset) / scale)
+    return np.where(np.isfinite(x), q, INT16_NAN).astype(np.int16)
+
+
+def _from_int16(q, offset, scale):
+    x = q * scale + offset
+    x[q == INT16_NAN] = np.nan
+    return x
+
+
+def encode_block(df, precision="int16"):
+    """
+    Encodes a DataFrame of whole traces (see lib.algorithms.generate_traces)
+    as a dict of compact arrays
+    """
+    name = df["name"].values
+    firsts = np.flatnonzero(np.r_[True, name[1:] != name[:-1]])
+    lengths = np.diff(np.append(firsts, len(df)))
+    arrays = {"names": name[firsts].astype(np.int64), "lengths": lengths}
+
+    for column in df.columns:
+        values = df[column].values
+        if column in ("name", "frame"):
+            continue
+        elif column in RUN_COLUMNS:
+            runs, run_lengths = run_length_encode(values.astype(float))
+            arrays[column + ".runs"] = runs.astype(RUN_COLUMNS[column])
+            arrays[column + ".lengths"] = run_lengths.astype(np.int32)
+        elif column in META_COLUMNS:
+            # None (never bleaches) is stored as nan
+            arrays[column] = np.array(
+                [np.nan if v is None else v for v in values[firsts]],
+                dtype=float,
+            )
+        elif column in FIXED_RANGES:
+            x = values.astype(float)
+            low, high = FIXED_RANGES[column]
+            outliers = np.flatnonzero(np.isfinite(x) & ((x < low) | (x > high)))
+            arrays[column + ".outlier_index"] = outliers.astype(np.int32)
+            arrays[column + ".outlier_values"] = x[outliers]
+            x[outliers] = np.nan
+            arrays[column + ".range"] = np.array([low, high])
+            if precision == "int16":
+                arrays[column] = _to_int16(x, *_range_to_scale(low, high))
+            else:
+                arrays[column] = x.astype(np.float16)
+        elif precision == "int16":
+            q, offset, scale = quantize(values.astype(float), lengths)
+            arrays[column] = q
+            arrays[column + ".offset"] = offset
+            arrays[column + ".scale"] = scale
+        elif precision == "float16":
+            # Values beyond the float16 range become infinite
+            with np.errstate(over="ignore"):
+                arrays[column] = values.astype(np.float16)
+        else:
+            raise ValueError("Unknown precision '{}'".format(precision))
+    return arrays
+
+
+def decode_block(arrays, columns):
+    """Decodes a block back into the DataFrame of its traces"""
+    lengths = arrays["lengths"]
+    offsets = lib.ragged.lengths_to_offsets(lengths)
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+
+    data = {}
+    for column in columns:
+        if column == "name":
+            data[column] = np.repeat(arrays["names"], lengths)
+        elif column == "frame":
+            data[column] = positions + 1
+        elif column in RUN_COLUMNS:
+            data[column] = run_length_decode(
+                arrays[column + ".runs"].astype(float),
+                arrays[column + ".lengths"],
+            )
+        elif column in META_COLUMNS:
+            values = arrays[column]
+            if column == "_bleaches_at":
+                values = np.array(
+                    [int(v) if np.isfinite(v) else None for v in values],
+                    dtype=object,
+                )
+            data[column] = np.repeat(values, lengths)
+        elif column + ".range" in arrays:
+            if arrays[column].dtype == np.int16:
+                x = _from_int16(
+                    arrays[column], *_range_to_scale(*arrays[column + ".range"])
+                )
+            else:
+                x = arrays[column].astype(float)
+            x[arrays[column + ".outlier_index"]] = arrays[
+                column + ".outlier_values"
+            ]
+            data[column] = x
+        elif column + ".scale" in arrays:
+            data[column] = dequantize(
+                arrays[column],
+                arrays[column + ".offset"],
+                arrays[column + ".scale"],
+                lengths,
+            )
+        else:
+            data[column] = arrays[column].astype(float)
+    return pd.DataFrame(data, columns=columns, index=positions)
+
+
+class TraceWriter:
+    """
+    Writes traces to a compressed file, batch by batch. Traces are buffered
+    until a block is full, so memory is bounded by the block size.
+
+    Parameters
+    ----------
+    path:
+        File to write
+    block_size:
+        Traces per block, the unit of random access
+    precision:
+        "int16" to quantize signals with a per-trace offset and scale (and E
+        and S over FIXED_RANGES), or "float16". Labels, E_true, metadata and
+        the outliers of E and S are always lossless.
+    codec:
+        Block compression: "zlib", "zstd" (needs the zstandard package) or
+        "none"
+    level:
+        Compression level of the codec
+    """
+
+    def __init__(
+        self, path, block_size=1024, precision="int16", codec="zlib", level=1
+    ):
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision '{}'".format(precision))
+        self.path = path
+        self.block_size = block_size
+        self.precision = precision
+        self.codec = codec
+        self.level = level
+        self._compress, _ = _compressor(codec, level)
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._pending = []
+        self._n_pending = 0
+        self.columns = None
+        self.blocks = []
+
+    def write(self, df):
+        """Adds the traces of a DataFrame (whole traces only)"""
+        if len(df) == 0:
+            return
+        if self.columns is None:
+            self.columns = list(df.columns)
+        elif list(df.columns) != self.columns:
+            raise ValueError("All traces must have the same columns")
+
+        name = df["name"].values
+        firsts = np.flatnonzero(np.r_[True, name[1:] != name[:-1]])
+        bounds = np.append(firsts, len(df))
+        n = len(firsts)
+        start = 0
+        while start < n:
+            take = min(self.block_size - self._n_pending, n - start)
+            rows = slice(bounds[start], bounds[start + take])
+            self._pending.append(df.iloc[rows])
+            self._n_pending += take
+            start += take
+            if self._n_pending == self.block_size:
+                self._flush()
+
+    def _flush(self):
+        if self._n_pending == 0:
+            return
+        df = pd.concat(self._pending)
+        arrays = encode_block(df, self.precision)
+        data = self._compress(_pack_arrays(arrays))
+        self.blocks.append(
+            {
+                "offset": self._file.tell(),
+                "size": len(data),
+                "n_traces": self._n_pending,
+                "first_name": int(arrays["names"][0]),
+                "last_name": int(arrays["names"][-1]),
+            }
+        )
+        self._file.write(data)
+        self._pending = []
+        self._n_pending = 0
+
+    def close(self):
+        """Writes the last block and the index"""
+        if self._file is None:
+            return
+        self._flush()
+        index = json.dumps(
+            {
+                "columns": self.columns or [],
+                "precision": self.precision,
+                "codec": self.codec,
+                "blocks": self.blocks,
+            }
+        ).encode()
+        self._file.write(index)
+        self._file.write(struct.pack("<Q", len(index)))
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceReader:
+    """
+    Reads traces written by TraceWriter. Only the blocks that hold the
+    requested traces are read and decompressed.
+
+    Parameters
+    ----------
+    path:
+        File to read
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("'{}' isn't a trace file".format(path))
+            f.seek(-8, 2)
+            (size,) = struct.unpack("<Q", f.read(8))
+            f.seek(-8 - size, 2)
+            index = json.loads(f.read(size))
+        self.columns = index["columns"]
+        self.precision = index["precision"]
+        self.codec = index["codec"]
+        self.blocks = index["blocks"]
+        _, self._decompress = _compressor(self.codec, None)
+        counts = [b["n_traces"] for b in self.blocks]
+        self._block_starts = np.concatenate([[0], np.cumsum(counts)])
+
+    @property
+    def n_traces(self):
+        return int(self._block_starts[-1])
+
+    @property
+    def n_blocks(self):
+        return len(self.blocks)
+
+    def read_block(self, i):
+        """DataFrame of the traces of block i"""
+        block = self.blocks[i]
+        with open(self.path, "rb") as f:
+            f.seek(block["offset"])
+            data = self._decompress(f.read(block["size"]))
+        return decode_block(_unpack_arrays(data), self.columns)
+
+    def __iter__(self):
+        for i in range(self.n_blocks):
+            yield self.read_block(i)
+
+    def read(self, start=0, stop=None):
+        """DataFrame of the traces [start, stop), by position in the file"""
+        stop = self.n_traces if stop is None else min(stop, self.n_traces)
+        if start >= stop:
+            return pd.DataFrame(columns=self.columns)
+        first = int(np.searchsorted(self._block_starts, start, "right")) - 1
+        last = int(np.searchsorted(self._block_starts, stop, "left")) - 1
+        frames = []
+        for i in range(first, last + 1):
+            df = self.read_block(i)
+            n = self.blocks[i]["n_traces"]
+            offset = self._block_starts[i]
+            lo, hi = max(start - offset, 0), min(stop - offset, n)
+            if lo > 0 or hi < n:
+                name = df["name"].values
+                firsts = np.flatnonzero(np.r_[True, name[1:] != name[:-1]])
+                bounds = np.append(firsts, len(df))
+                df = df.iloc[bounds[lo] : bounds[hi]]
+            frames.append(df)
+        return pd.concat(frames)
+
+
+def write_traces(path, df, **kwargs):
+    """Writes a DataFrame of traces, with the options of TraceWriter"""
+    with TraceWriter(path, **kwargs) as writer:
+        writer.write(df)
+
+
+def read_traces(path, start=0, stop=None):
+    """Reads the traces [start, stop) of a file"""
+    return TraceReader(path).read(start, stop)
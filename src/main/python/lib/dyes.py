@@ -0,0 +1,149 @@
+"""
+Linear model of the intensities of N dyes under alternating excitation.
+Every excitation laser excites the dyes by the excitation matrix, excited
+dyes pass on their energy to other dyes by FRET, and the emission of every
+dye is split over the detection channels by the emission matrix. All
+channels of all frames come out of a few matrix products as one
+(..., channels) tensor, e.g. for three colors
+
+    dyes = DyeModel.three_color()
+    # Efficiencies of the transfers B->G, G->R and B->R, per frame
+    signals = dyes.intensities(np.stack([E_BG, E_GR, E_BR], axis=-1))
+
+The two-color model of DD, DA and AA is DyeModel.two_color(), and is the
+only kind of model the simulation pipeline can run (see
+lib.pipeline.PhotophysicsStage), e.g. with crosstalk as
+generate_traces(..., dyes=DyeModel(...)). Models with more dyes compute channel
+intensities from given efficiencies, but generate_traces can't simulate
+traces with them.
+"""
+
+import numpy as np
+
+
+class DyeModel:
+    """
+    Parameters
+    ----------
+    dyes:
+        Names of the dyes, e.g. ("D", "A")
+    excitation:
+        (lasers, dyes) fraction of every dye excited by every laser
+    emission:
+        (dyes, detectors) fraction of the emission of every dye detected in
+        every detection channel. The detectors are named after the dyes.
+    transfers:
+        (donor, acceptor) dye indices of every FRET transfer. Energy can
+        only flow from lower to higher dye indices.
+    channels:
+        Names of the (laser, detector) pairs to return, as the names of the
+        excited dye and the detector, e.g. "DA" for the acceptor emission
+        under donor excitation. Defaults to all pairs where the laser's dye
+        can reach the detector's dye.
+    """
+
+    def __init__(self, dyes, excitation, emission, transfers, channels=None):
+        self.dyes = tuple(dyes)
+        self.excitation = np.asarray(excitation, dtype=float)
+        self.emission = np.asarray(emission, dtype=float)
+        self.transfers = [tuple(t) for t in transfers]
+
+        D = len(self.dyes)
+        if self.excitation.shape[1] != D or self.emission.shape != (D, D):
+            raise ValueError(
+                "Expected excitation of shape (lasers, {0}) and emission of "
+                "shape ({0}, {0})".format(D)
+            )
+        for donor, acceptor in self.transfers:
+            if not 0 <= donor < acceptor < D:
+                raise ValueError(
+                    "Transfers must go from lower to higher dye indices"
+                )
+
+        names = [x + c for x in self.dyes for c in self.dyes]
+        if channels is None:
+            reach = np.eye(D, dtype=bool)
+            for donor, acceptor in self.transfers:
+                reach[donor, acceptor] = True
+            for _ in range(D):
+                reach = reach | (reach.astype(int) @ reach.astype(int) > 0)
+            channels = [
+                name for name, reached in zip(names, reach.ravel()) if reached
+            ]
+        self.channels = tuple(channels)
+        self._index = np.array([names.index(c) for c in self.channels])
+
+    @classmethod
+    def two_color(cls):
+        """Donor and acceptor, with the channels DD, DA and AA"""
+        return cls(
+            dyes=("D", "A"),
+            excitation=np.eye(2),
+            emission=np.eye(2),
+            transfers=[(0, 1)],
+        )
+
+    @classmethod
+    def three_color(cls):
+        """
+        Blue, green and red dyes with transfers B->G, G->R and B->R, and the
+        channels BB, BG, BR, GG, GR and RR
+        """
+        return cls(
+            dyes=("B", "G", "R"),
+            excitation=np.eye(3),
+            emission=np.eye(3),
+            transfers=[(0, 1), (1, 2), (0, 2)],
+        )
+
+    def __repr__(self):
+        return "DyeModel({}, {}, {}, {}, {})".format(
+            self.dyes,
+            self.excitation.tolist(),
+            self.emission.tolist(),
+            self.transfers,
+            self.channels,
+        )
+
+    @property
+    def n_channels(self):
+        return len(self.channels)
+
+    def intensities(self, E):
+        """
+        Intensities of all channels
+
+        Parameters
+        ----------
+        E:
+            (..., transfers) FRET efficiency of every transfer, e.g. per
+            trace and frame
+
+        Returns
+        -------
+        (..., channels) intensities
+        """
+        E = np.asarray(E, dtype=float)
+        X, D = self.excitation.shape
+        lead = E.shape[:-1]
+
+        # Excitation reaching every dye, directly or through transfers, for
+        # every laser, i.e. excitation @ (1 + M + M^2 + ...) for the transfer
+        # matrix M. Transfers only go to higher indices, so one pass in
+        # order of the donors propagates all chains
+        reached = np.empty((X, D) + lead)
+        reached[:] = self.excitation.reshape((X, D) + (1,) * len(lead))
+        kept = np.ones((D,) + lead)
+        for t in sorted(
+            range(len(self.transfers)), key=lambda t: self.transfers[t][0]
+        ):
+            donor, acceptor = self.transfers[t]
+            reached[:, acceptor] += reached[:, donor] * E[..., t]
+            kept[donor] -= E[..., t]
+
+        # Whatever isn't passed on is emitted, and detected by one matrix
+        # product over all frames
+        emitted = (reached * kept).reshape(X, D, -1)
+        detected = np.matmul(self.emission.T, emitted)
+        detected = detected.reshape((X * D,) + lead)
+        return np.moveaxis(detected[self._index], 0, -1)
@@ -0,0 +1,55 @@
+"""
+Array math of the trace simulator, on numpy arrays, like every backend of
+lib.backend produces. Arrays may be single traces of shape (T,) or batches
+of shape (N, T).
+"""
+
+import numpy as np
+
+
+def calc_E(DD, DA):
+    """FRET efficiency"""
+    return DA / (DD + DA)
+
+
+def masked_divide(num, den):
+    """num / den, which is nan wherever den is 0 instead of inf or nan"""
+    nonzero = den != 0
+    return np.where(nonzero, num / np.where(nonzero, den, 1), np.nan)
+
+
+def masked_E_S(DD, DA, AA):
+    """FRET efficiency and stoichiometry, nan where they're undefined"""
+    D_exc = DD + DA
+    return masked_divide(DA, D_exc), masked_divide(D_exc, D_exc + AA)
+
+
+def ffill(x):
+    """
+    Replaces the non-finite values of every row of an (N, T) array by the
+    last finite value before them, and by nan if there is none. The index
+    of the last finite value is propagated along the rows with a running
+    maximum, so the fill takes a few passes over the array.
+    """
+    finite = np.isfinite(x)
+    if finite.all():
+        return x
+    idx = np.where(finite, np.arange(x.shape[-1]), 0)
+    np.maximum.accumulate(idx, axis=-1, out=idx)
+    filled = np.take_along_axis(x, idx, axis=-1)
+    # Rows that start with a non-finite value have nothing to fill with
+    return np.where(np.isfinite(filled), filled, np.nan)
+
+
+def correct_E_S(DD, DA, AA, gamma=1, beta=1, leakage=0, direct_excitation=0):
+    """
+    Corrected FRET efficiency and stoichiometry, from signals with the
+    instrument imperfections of the correction factors (see
+    lib.pipeline.CorrectionStage). Factors can be per trace, broadcasting
+    against the signals.
+    """
+    F_DA = DA - leakage * DD - direct_excitation * AA
+    F_DD = gamma * DD
+    E = F_DA / (F_DD + F_DA)
+    S = (F_DD + F_DA) / (F_DD + F_DA + AA / beta)
+    return E, S
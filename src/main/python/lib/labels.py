@@ -0,0 +1,166 @@
+"""
+Trace classes, shared by simulation, plotting and export. Every frame is
+labelled with a class: the fixed classes of Label, or k_state(k) for a trace
+with k observed FRET states, for any k.
+"""
+
+import enum
+
+import numpy as np
+
+
+class Label(enum.IntEnum):
+    BLEACHED = 0
+    AGGREGATE = 1
+    NOISY = 2
+    SCRAMBLE = 3
+
+
+# Label of a 1-state trace. A k-state trace is labelled FIRST_STATE + k - 1
+FIRST_STATE = 4
+
+# Labels of merged (binary) classes
+NOT_FRET, FRET = 0, 1
+
+COLORS = {
+    Label.BLEACHED: "darkgrey",
+    Label.AGGREGATE: "red",
+    Label.NOISY: "blue",
+    Label.SCRAMBLE: "purple",
+}
+
+# Colors of 1-state, 2-state, ... traces, repeated for more states
+STATE_COLORS = (
+    "orange",
+    "lightgreen",
+    "green",
+    "mediumseagreen",
+    "darkolivegreen",
+)
+
+
+def k_state(k):
+    """Label of traces with k FRET states"""
+    return FIRST_STATE + np.asarray(k) - 1
+
+
+def n_states(label):
+    """Number of FRET states of a label, and 0 for the fixed classes"""
+    label = np.asarray(label)
+    return np.where(label >= FIRST_STATE, label - FIRST_STATE + 1, 0)
+
+
+def class_name(label):
+    """Name of a class, e.g. "bleached" or "3-state" """
+    label = int(label)
+    if label >= FIRST_STATE:
+        return "{}-state".format(label - FIRST_STATE + 1)
+    return Label(label).name.lower()
+
+
+def parse_class(name):
+    """Label of a class given by name (e.g. "noisy" or "3-state") or label"""
+    if not isinstance(name, str):
+        return int(name)
+    key = name.lower()
+    if key.endswith("-state"):
+        return int(k_state(int(key[: -len("-state")])))
+    try:
+        return int(Label[key.upper()])
+    except KeyError:
+        raise ValueError("Unknown class '{}'".format(name))
+
+
+def class_color(label):
+    """Plotting color of a class"""
+    label = int(label)
+    if label >= FIRST_STATE:
+        return STATE_COLORS[(label - FIRST_STATE) % len(STATE_COLORS)]
+    return COLORS[Label(label)]
+
+
+def class_table(max_states=5):
+    """Dict of {name: label} of all classes up to max_states states"""
+    table = {class_name(label): int(label) for label in Label}
+    for k in range(1, max_states + 1):
+        table[class_name(k_state(k))] = int(k_state(k))
+    return table
+
+
+def label_frames(bleached, aggregated, scrambled, noisy, n_states, merge=False):
+    """
+    Labels every frame of a batch of traces. Bleached frames are bleached,
+    and otherwise a trace is labelled by the first of noisy, scrambled,
+    aggregate or the number of its FRET states that applies. Scrambled
+    traces count as signal in every frame, bleached or not, so they are
+    labelled scrambled (or noisy, if they're also noisy) throughout.
+
+    Parameters
+    ----------
+    bleached:
+        (N, T) mask of the bleached (or blinking) frames
+    aggregated, scrambled, noisy:
+        (N,) masks of the traces of each class
+    n_states:
+        (N,) number of observed FRET states of each trace
+    merge:
+        Whether to merge all classes into NOT_FRET and FRET
+
+    Returns
+    -------
+    (N, T) array of labels. Frames of traces without any observed state (and
+    no other class) are -1.
+    """
+    label = np.full(bleached.shape, -1.0)
+    label[aggregated] = Label.AGGREGATE
+    label[bleached] = Label.BLEACHED
+    label[scrambled] = Label.SCRAMBLE
+
+    is_signal = label != Label.BLEACHED
+    label[noisy[:, None] & is_signal] = Label.NOISY
+
+    fret = ~(noisy | aggregated | scrambled) & (n_states > 0)
+    label = np.where(
+        fret[:, None] & is_signal, k_state(n_states)[:, None], label
+    )
+
+    if merge:
+        label = merge_labels(label)
+    return label
+
+
+def merge_labels(label):
+    """Everything that isn't FRET is NOT_FRET, and FRET is FRET"""
+    return np.where(label >= FIRST_STATE, FRET, NOT_FRET).astype(
+        np.asarray(label).dtype
+    )
+
+
+def trace_labels(label):
+    """
+    Class of whole traces, as the first label of each trace that isn't
+    bleached, or bleached if all frames are.
+
+    Parameters
+    ----------
+    label:
+        (N, T) per-frame labels
+    """
+    label = np.asarray(label)
+    unbleached = label != Label.BLEACHED
+    first = np.argmax(unbleached, axis=1)
+    return np.where(
+        unbleached.any(axis=1),
+        label[np.arange(len(label)), first],
+        Label.BLEACHED,
+    )
+
+
+def to_binary(y, one_hot, to_ones):
+    """Converts labels to binary labels, with the classes to_ones as 1"""
+    if one_hot:
+        y = y.argmax(axis=2)
+    y[~np.isin(y, to_ones)] = -1
+    y[y != -1] = 1
+    y[y != 1] = 0
+    return y
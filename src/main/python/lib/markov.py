@@ -0,0 +1,430 @@
+"""
+Batched sampling of FRET state paths from Markov chains, for thousands of
+traces at once. Transitions are drawn with alias tables, precomputed for
+every row of every trace's transition matrix, so a frame costs one
+comparison per trace however many states there are.
+
+Chains are given either as per-frame transition matrices, as transition rates
+in continuous time (discretized per frame), or as per-state dwell time
+distributions, in which case the path is built from whole dwells instead of
+frame by frame. Rates can also be simulated event by event in continuous time
+(kinetic Monte Carlo), and averaged over every frame's exposure, to capture
+transitions faster than the frame rate.
+"""
+
+import numpy as np
+
+import lib.batch
+
+
+def validate_trans_mat(trans_mat, k_states=None):
+    """
+    Checks that trans_mat is a square, row-stochastic matrix, with k_states
+    states if given, and returns it as an array.
+    """
+    trans_mat = np.asarray(trans_mat, dtype=float)
+    if trans_mat.ndim != 2 or trans_mat.shape[0] != trans_mat.shape[1]:
+        raise ValueError(
+            "Transition matrix must be square, got shape {}".format(
+                trans_mat.shape
+            )
+        )
+    if k_states is not None and len(trans_mat) != k_states:
+        raise ValueError(
+            "Transition matrix has {} states, expected {}".format(
+                len(trans_mat), k_states
+            )
+        )
+    if not np.isfinite(trans_mat).all() or (trans_mat < 0).any():
+        raise ValueError("Transition probabilities must be non-negative")
+    sums = trans_mat.sum(axis=1)
+    bad = np.flatnonzero(~np.isclose(sums, 1))
+    if len(bad) > 0:
+        raise ValueError(
+            "Row {} of the transition matrix sums to {}, not 1".format(
+                bad[0], sums[bad[0]]
+            )
+        )
+    return trans_mat
+
+
+def rates_to_trans_mat(rates):
+    """
+    Discretizes a continuous-time chain per frame. rates[i, j] is the rate of
+    going from state i to state j, in transitions per frame, and the diagonal
+    is ignored. Returns the matrix exponential of the rate matrix, i.e. the
+    probabilities of being in each state one frame later, which accounts for
+    any number of transitions within the frame.
+    """
+    rates = np.array(rates, dtype=float)
+    if rates.ndim != 2 or rates.shape[0] != rates.shape[1]:
+        raise ValueError("Rate matrix must be square")
+    np.fill_diagonal(rates, 0)
+    if (rates < 0).any():
+        raise ValueError("Transition rates must be non-negative")
+    np.fill_diagonal(rates, -rates.sum(axis=1))
+
+    # Scaling and squaring, with a Taylor series for the scaled exponential
+    norm = np.abs(rates).sum(axis=1).max()
+    n_squarings = max(0, int(np.ceil(np.log2(norm))) + 1) if norm > 0 else 0
+    scaled = rates / 2**n_squarings
+    trans_mat = np.eye(len(rates))
+    term = np.eye(len(rates))
+    for k in range(1, 20):
+        term = term @ scaled / k
+        trans_mat += term
+    for _ in range(n_squarings):
+        trans_mat = trans_mat @ trans_mat
+
+    # Clean up rounding errors
+    trans_mat = np.clip(trans_mat, 0, None)
+    return trans_mat / trans_mat.sum(axis=1, keepdims=True)
+
+
+def alias_tables(probs):
+    """
+    Builds Walker alias tables for sampling from discrete distributions in
+    constant time, with Vose's method vectorized over all distributions.
+
+    Parameters
+    ----------
+    probs:
+        (..., K) array of probabilities, summing to 1 over the last axis
+
+    Returns
+    -------
+    Tuple of (acceptance probabilities, aliases), both of the same shape as
+    probs. A sample is drawn by picking a column j uniformly, and keeping it
+    with probability accept[..., j], or taking alias[..., j] otherwise.
+    """
+    probs = np.asarray(probs, dtype=float)
+    shape = probs.shape
+    K = shape[-1]
+    scaled = probs.reshape(-1, K) * K
+    n = len(scaled)
+    r = np.arange(n)
+
+    accept = np.ones_like(scaled)
+    alias = np.tile(np.arange(K), (n, 1))
+    done = np.zeros(scaled.shape, dtype=bool)
+
+    # Every round pairs one underfull column with one overfull column in
+    # each distribution, which fills the underfull one
+    for _ in range(K - 1):
+        small = np.where(~done & (scaled < 1), scaled, np.inf)
+        large = np.where(~done & (scaled >= 1), scaled, -np.inf)
+        under = np.argmin(small, axis=1)
+        over = np.argmax(large, axis=1)
+        ok = np.isfinite(small[r, under]) & np.isfinite(large[r, over])
+        rows, under, over = r[ok], under[ok], over[ok]
+        accept[rows, under] = scaled[rows, under]
+        alias[rows, under] = over
+        done[rows, under] = True
+        scaled[rows, over] -= 1 - scaled[rows, under]
+
+    return accept.reshape(shape), alias.reshape(shape)
+
+
+def alias_sample(accept, alias, u):
+    """
+    Draws from alias tables, given the tables selected for every sample
+    (shape (n, K)) and uniform random numbers u of shape (n,). The column is
+    taken from the integer part of u * K, and the acceptance test from the
+    fractional part, so a single random number is enough.
+    """
+    K = accept.shape[-1]
+    x = u * K
+    column = np.minimum(x.astype(int), K - 1)
+    r = np.arange(len(u))
+    return np.where(
+        x - column < accept[r, column], column, alias[r, column]
+    ).astype(int)
+
+
+def uniform_trans_mats(trans_prob, k_states, size):
+    """
+    Per-trace transition matrices where every state is left with probability
+    trans_prob, with equal probability of going to each of the other states.
+    States beyond k_states of a trace are padded, and never entered.
+
+    Parameters
+    ----------
+    trans_prob, k_states:
+        Arrays of shape (N,)
+    size:
+        Number of states to pad the matrices to
+
+    Returns
+    -------
+    (N, size, size) array
+    """
+    states = np.arange(size)
+    valid = states[None, :] < k_states[:, None]
+    row = np.where(valid, trans_prob[:, None], 0.0)
+    trans_mat = np.repeat(row[:, None, :], size, axis=1)
+    trans_mat[~valid] = 0
+    diagonal = 1 - (k_states - 1)[:, None] * trans_prob[:, None]
+    trans_mat[:, states, states] = np.where(valid, diagonal, 1.0)
+    return trans_mat
+
+
+def sample_chain(backend, trans_mats, starts, length):
+    """
+    Samples state paths frame by frame from per-trace Markov chains.
+
+    Parameters
+    ----------
+    backend:
+        lib.backend backend to draw random numbers from
+    trans_mats:
+        (N, K, K) transition matrices, or a single (K, K) matrix for all
+    starts:
+        (N, K) initial state probabilities
+    length:
+        Number of frames
+
+    Returns
+    -------
+    (N, length) array of state indices
+    """
+    N, K = starts.shape
+    if trans_mats.ndim == 2:
+        trans_mats = trans_mats[None]
+    accept, alias = alias_tables(trans_mats)
+    start_accept, start_alias = alias_tables(starts)
+
+    u = backend.to_numpy(backend.random((N, length)))
+    states = np.empty((N, length), dtype=int)
+    states[:, 0] = alias_sample(start_accept, start_alias, u[:, 0])
+
+    # A shared matrix is indexed by state only, per-trace matrices by trace
+    # and state
+    rows = np.zeros(N, dtype=int) if len(accept) == 1 else np.arange(N)
+    for t in range(1, length):
+        current = states[:, t - 1]
+        states[:, t] = alias_sample(
+            accept[rows, current], alias[rows, current], u[:, t]
+        )
+    return states
+
+
+def draw_dwells(backend, dwell, states):
+    """
+    Draws a dwell time for every entry of states, from the distribution of
+    that state. dwell is a list of (distribution, *args) per state, naming a
+    distribution of the backend, e.g. ("exponential", 20) or
+    ("gamma", 2, 10), in frames.
+    """
+    times = np.empty(len(states))
+    for s, (distribution, *args) in enumerate(dwell):
+        idx = np.flatnonzero(states == s)
+        if len(idx) > 0:
+            draw = getattr(backend, distribution)
+            times[idx] = backend.to_numpy(draw(*args, size=len(idx)))
+    return np.maximum(times, 0)
+
+
+def sample_segments(backend, dwell, jump_mats, starts, length):
+    """
+    Samples state paths as whole dwells, from per-state dwell time
+    distributions. On leaving a state, the next state is drawn from the jump
+    matrix of the trace. All traces take a step at once, so the cost scales
+    with the number of transitions rather than the number of frames.
+
+    Parameters
+    ----------
+    backend:
+        lib.backend backend to draw random numbers from
+    dwell:
+        Dwell time distribution of each state, see draw_dwells
+    jump_mats:
+        (N, K, K) or (K, K) probabilities of the next state, with a zero
+        diagonal
+    starts:
+        (N, K) initial state probabilities
+    length:
+        Time to cover, in frames
+
+    Returns
+    -------
+    Tuple of (owner, state, start, stop) arrays, one entry per dwell, in
+    continuous time
+    """
+    N, K = starts.shape
+    if jump_mats.ndim == 2:
+        jump_mats = jump_mats[None]
+    accept, alias = alias_tables(jump_mats)
+    start_accept, start_alias = alias_tables(starts)
+    shared = len(accept) == 1
+
+    current = alias_sample(
+        start_accept, start_alias, backend.to_numpy(backend.random(N))
+    )
+    time = np.zeros(N)
+    active = np.arange(N)
+    segments = []
+    while len(active) > 0:
+        state = current[active]
+        stop = time[active] + draw_dwells(backend, dwell, state)
+        segments.append((active, state, time[active], stop))
+        time[active] = stop
+
+        active = active[stop < length]
+        u = backend.to_numpy(backend.random(len(active)))
+        rows = np.zeros(len(active), dtype=int) if shared else active
+        state = current[active]
+        current[active] = alias_sample(
+            accept[rows, state], alias[rows, state], u
+        )
+
+    return tuple(np.concatenate(x) for x in zip(*segments))
+
+
+def segments_to_frames(owner, state, start, stop, n_traces, length):
+    """
+    Discretizes dwells per frame, as the state each trace is in at the start
+    of every frame. Returns an (n_traces, length) array of state indices.
+    """
+    return lib.batch.interval_sum(
+        owner, np.ceil(start), np.ceil(stop), n_traces, length, weights=state
+    ).astype(int)
+
+
+def sample_gillespie(backend, rates, starts, length, block=16):
+    """
+    Samples continuous-time state paths event by event (Gillespie's direct
+    method). Dwell times are exponential with the total rate of leaving the
+    state, and the next state is drawn in proportion to the rates out of it.
+    Random numbers are drawn for blocks of events of all unfinished traces
+    at once, so the cost scales with the number of transitions rather than
+    the number of frames.
+
+    Parameters
+    ----------
+    backend:
+        lib.backend backend to draw random numbers from
+    rates:
+        (N, K, K) or (K, K) transition rates, in transitions per frame. The
+        diagonal is ignored.
+    starts:
+        (N, K) initial state probabilities
+    length:
+        Time to cover, in frames
+    block:
+        Number of events drawn for at once
+
+    Returns
+    -------
+    Tuple of (owner, state, start, stop) arrays, one entry per dwell
+    """
+    N, K = starts.shape
+    rates = np.array(rates, dtype=float)
+    if rates.ndim == 2:
+        rates = rates[None]
+    diagonal = np.arange(K)
+    rates[:, diagonal, diagonal] = 0
+    exit_rate = rates.sum(axis=2)
+
+    # States that are never left jump back to themselves, after an infinite
+    # dwell
+    leaves = exit_rate > 0
+    jumps = np.zeros_like(rates)
+    jumps[leaves] = rates[leaves] / exit_rate[leaves][:, None]
+    stuck = np.nonzero(~leaves)
+    jumps[stuck[0], stuck[1], stuck[1]] = 1
+    accept, alias = alias_tables(jumps)
+    start_accept, start_alias = alias_tables(starts)
+    shared = len(accept) == 1
+
+    current = alias_sample(
+        start_accept, start_alias, backend.to_numpy(backend.random(N))
+    )
+    time = np.zeros(N)
+    active = np.arange(N)
+    segments = []
+    while len(active) > 0:
+        n = len(active)
+        exp = backend.to_numpy(backend.exponential(1.0, (n, block)))
+        u = backend.to_numpy(backend.random((n, block)))
+        pos = np.arange(n)
+        for j in range(block):
+            rows = np.zeros(len(active), dtype=int) if shared else active
+            state = current[active]
+            with np.errstate(divide="ignore"):
+                dwell = exp[pos, j] / exit_rate[rows, state]
+            stop = time[active] + dwell
+            segments.append((active, state, time[active], stop))
+            time[active] = stop
+
+            going = stop < length
+            active, pos, rows, state = (
+                active[going],
+                pos[going],
+                rows[going],
+                state[going],
+            )
+            if len(active) == 0:
+                break
+            current[active] = alias_sample(
+                accept[rows, state], alias[rows, state], u[pos, j]
+            )
+
+    return tuple(np.concatenate(x) for x in zip(*segments))
+
+
+def _integral(owner, values, start, stop, n_traces, length, offset):
+    """
+    Integral of piecewise constant values from time 0 to each of the times
+    f + offset, for f in [0, length). Every segment adds a ramp between its
+    start and stop and a constant after it, which are accumulated with
+    difference arrays.
+    """
+
+    def first_after(t):
+        # First frame f with f + offset > t
+        return np.clip(np.floor(t - offset) + 1, 0, length)
+
+    times = np.arange(length) + offset
+    ramp_from, ramp_to = first_after(start), first_after(stop)
+    slope = lib.batch.interval_sum(
+        owner, ramp_from, ramp_to, n_traces, length, weights=values
+    )
+    intercept = lib.batch.interval_sum(
+        owner, ramp_from, ramp_to, n_traces, length, weights=-values * start
+    )
+    with np.errstate(invalid="ignore"):
+        area = values * (stop - start)
+    done = np.isfinite(area)
+    after = lib.batch.interval_sum(
+        owner[done],
+        ramp_to[done],
+        np.inf,
+        n_traces,
+        length,
+        weights=area[done],
+    )
+    return slope * times[None, :] + intercept + after
+
+
+def exposure_average(owner, values, start, stop, n_traces, length, exposure=1):
+    """
+    Averages piecewise constant values, e.g. the FRET of each dwell, over
+    the exposure window [f, f + exposure) of every frame f, as a camera
+    integrating the signal would see them.
+
+    Parameters
+    ----------
+    owner, values, start, stop:
+        Trace, value and time interval of every segment, which must cover
+        the frames of each trace
+    exposure:
+        Fraction of each frame the camera is exposed for, from the start of
+        the frame
+
+    Returns
+    -------
+    (n_traces, length) array
+    """
+    end = _integral(owner, values, start, stop, n_traces, length, exposure)
+    begin = _integral(owner, values, start, stop, n_traces, length, 0)
+    return (end - begin) / exposure
@@ -0,0 +1,1408 @@
+"""
+Trace simulation as an explicit pipeline of stages. Every stage transforms a
+lib.batch.TraceBatch in place, so stages can be reordered, disabled or
+swapped for other implementations, e.g.
+
+    pipeline = build_pipeline(noise=0.1)
+    pipeline.disable("blinking")
+    pipeline.replace("noise", MyNoiseStage())
+    traces = lib.algorithms.generate_traces(1000, pipeline=pipeline)
+    print(pipeline.report())
+
+A run has two phases. Planning draws all per-trace parameters (aggregate
+sizes, bleaching times, noise levels, ...) up front into the batch's columnar
+parameter table, and execution then simulates the traces from that table.
+The table is kept as ground truth, see parameter_table().
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+import lib.background
+import lib.batch
+import lib.dyes
+import lib.labels
+import lib.markov
+from lib.kernels import calc_E, ffill, masked_E_S
+
+
+def _draw_range(backend, value, size):
+    """Draws uniformly from a (low, high) range, or repeats a single value"""
+    value = np.array(value)
+    return backend.uniform(value.min(), value.max(), size)
+
+
+def _steer(batch, mask, label):
+    """
+    Overrides a randomly planned (N,) mask with the target classes of the
+    traces, where targets are set (see lib.quota): a targeted trace is in
+    the mask exactly if its target is label.
+    """
+    target = batch.params.get("target")
+    if target is None:
+        return mask
+    return np.where(target >= 0, target == label, mask)
+
+
+class Stage:
+    """
+    Base class of pipeline stages. Subclasses set a name and implement
+    __call__(batch), modifying the batch in place. Stages with random
+    per-trace parameters draw them in plan(batch), which runs for all stages
+    before any stage is executed.
+    """
+
+    name = None
+
+    def plan(self, batch):
+        """Draws the stage's per-trace parameters into batch.params"""
+        pass
+
+    def __call__(self, batch):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "{}()".format(type(self).__name__)
+
+
+class Pipeline:
+    """
+    Runs a batch through a sequence of stages, and keeps track of how much
+    time is spent in each of them.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.disabled = set()
+        self.timings = {}
+
+    def _index(self, name):
+        for i, stage in enumerate(self.stages):
+            if stage.name == name:
+                return i
+        raise KeyError("No stage named '{}'".format(name))
+
+    def __getitem__(self, name):
+        return self.stages[self._index(name)]
+
+    def __repr__(self):
+        return "Pipeline({})".format(
+            [s.name for s in self.stages if s.name not in self.disabled]
+        )
+
+    def enable(self, name):
+        self._index(name)
+        self.disabled.discard(name)
+
+    def disable(self, name):
+        self._index(name)
+        self.disabled.add(name)
+
+    def replace(self, name, stage):
+        """Swaps the stage with the given name for another one"""
+        self.stages[self._index(name)] = stage
+
+    def insert_before(self, name, stage):
+        self.stages.insert(self._index(name), stage)
+
+    def insert_after(self, name, stage):
+        self.stages.insert(self._index(name) + 1, stage)
+
+    def remove(self, name):
+        del self.stages[self._index(name)]
+
+    def reorder(self, names):
+        """Puts the stages in the given order. Stages not named are dropped"""
+        self.stages = [self[name] for name in names]
+
+    def _timed(self, key, func, batch):
+        t0 = time.perf_counter()
+        func(batch)
+        elapsed = time.perf_counter() - t0
+        self.timings[key] = self.timings.get(key, 0) + elapsed
+
+    def plan(self, batch):
+        """Draws the per-trace parameters of all enabled stages, in order"""
+        for stage in self.stages:
+            if stage.name not in self.disabled:
+                self._timed("planning", stage.plan, batch)
+        return batch
+
+    def execute(self, batch):
+        """Runs all enabled stages on a planned batch, in order"""
+        for stage in self.stages:
+            if stage.name not in self.disabled:
+                self._timed(stage.name, stage, batch)
+        return batch
+
+    def run(self, batch):
+        """Plans and executes the batch"""
+        return self.execute(self.plan(batch))
+
+    def report(self):
+        """Returns a table of the total time spent in each stage"""
+        total = sum(self.timings.values())
+        lines = ["{:<16} {:>10} {:>7}".format("stage", "time (ms)", "share")]
+        for name, t in self.timings.items():
+            lines.append(
+                "{:<16} {:>10.1f} {:>6.1f}%".format(
+                    name, t * 1e3, 100 * t / total if total > 0 else 0
+                )
+            )
+        return "\n".join(lines)
+
+
+class LengthStage(Stage):
+    """
+    Gives every trace its own length, drawn from a distribution. Traces are
+    still simulated up to the batch's trace_length, and end at their length
+    when they are labelled and converted (see batch_to_frame and
+    lib.ragged).
+
+    Parameters
+    ----------
+    lengths:
+        (low, high) range to draw lengths from uniformly, or a distribution
+        as (distribution, *args), as the dwell times of MarkovStateStage.
+        Lengths are clipped to [1, trace_length].
+    """
+
+    name = "length"
+
+    def __init__(self, lengths):
+        if not isinstance(lengths[0], str):
+            low, high = lengths
+            lengths = ("uniform", low, high + 1)
+        self.lengths = tuple(lengths)
+
+    def plan(self, batch):
+        N = batch.n_traces
+        draws = lib.markov.draw_dwells(
+            batch.backend, [self.lengths], np.zeros(N, dtype=int)
+        )
+        batch.params["length"] = np.clip(
+            np.floor(draws), 1, batch.trace_length
+        ).astype(int)
+
+    def __call__(self, batch):
+        pass
+
+
+class AggregationStage(Stage):
+    """
+    Decides which traces are aggregates, and how many labelled molecules
+    each of them contains.
+    """
+
+    name = "aggregation"
+
+    def __init__(self, aggregation_prob=0.1, max_aggregate_size=100):
+        self.aggregation_prob = aggregation_prob
+        self.max_aggregate_size = max_aggregate_size
+
+    def plan(self, batch):
+        backend = batch.backend
+        N = batch.n_traces
+        aggregated = backend.random(N) < self.aggregation_prob
+        aggregated = _steer(batch, aggregated, lib.labels.Label.AGGREGATE)
+        if aggregated.any() and self.max_aggregate_size < 2:
+            raise ValueError("Can't have an aggregate of size less than 2")
+
+        n_agg = int(aggregated.sum())
+        size = backend.integers(2, self.max_aggregate_size + 1, n_agg)
+        n_pairs = backend.poisson(size)
+        n_pairs[n_pairs == 0] = 2
+
+        batch.params["aggregated"] = aggregated
+        batch.params["n_pairs"] = np.ones(N, dtype=int)
+        batch.params["n_pairs"][aggregated] = n_pairs
+
+    def __call__(self, batch):
+        # Aggregates are fully described by their planned size
+        pass
+
+
+class HMMStateStage(Stage):
+    """
+    Samples the true FRET state path of every trace from a hidden Markov
+    model, one trace at a time with pomegranate. Aggregates are locked in a
+    single, random state.
+    """
+
+    name = "states"
+
+    def __init__(
+        self,
+        state_means="random",
+        random_k_states_max=5,
+        min_state_diff=0.1,
+        trans_prob=0.1,
+        trans_mat=None,
+    ):
+        self.state_means = state_means
+        self.random_k_states_max = random_k_states_max
+        self.min_state_diff = min_state_diff
+        self.trans_prob = trans_prob
+        self.trans_mat = None
+        if trans_mat is not None:
+            # A transition matrix fixes the number of states of every trace
+            self.trans_mat = lib.markov.validate_trans_mat(trans_mat)
+            if not self.is_random and np.size(state_means) < len(
+                self.trans_mat
+            ):
+                raise ValueError(
+                    "Transition matrix has {} states, but only {} state "
+                    "means are given".format(
+                        len(self.trans_mat), np.size(state_means)
+                    )
+                )
+
+    @property
+    def is_random(self):
+        return not all(isinstance(s, float) for s in self.state_means)
+
+    @property
+    def max_states(self):
+        """Highest number of states a trace can have"""
+        if self.trans_mat is not None:
+            return len(self.trans_mat)
+        if self.is_random:
+            return self.random_k_states_max
+        return min(np.size(self.state_means), self.random_k_states_max)
+
+    def draw_state_means(self, backend, k_states=None):
+        """
+        Returns the FRET state means of a single trace, with k_states states
+        if given
+        """
+        drawn = self.trans_mat is None and k_states is None
+        if self.trans_mat is not None:
+            k_states = len(self.trans_mat)
+        elif drawn:
+            k_states = int(
+                backend.integers(1, self.random_k_states_max + 1, 1)[0]
+            )
+        if self.is_random:
+            # Redraw until no states are too closely spaced
+            while True:
+                means = backend.uniform(0.01, 0.99, k_states)
+                if not any(np.diff(np.sort(means)) < self.min_state_diff):
+                    return means
+        if drawn:
+            if np.size(self.state_means) <= self.random_k_states_max:
+                return np.array(self.state_means, dtype=float)
+        elif np.size(self.state_means) == k_states:
+            return np.array(self.state_means, dtype=float)
+        # Pick no more than random_k_states_max of the given state means
+        return backend.choice(self.state_means, k_states, replace=False)
+
+    def plan(self, batch):
+        backend = batch.backend
+        N = batch.n_traces
+        aggregated = batch.params["aggregated"]
+
+        trans_prob = _draw_range(backend, self.trans_prob, N)
+        state_means = np.full((N, self.max_states), np.nan)
+        # Traces targeted at a k-state class get k states
+        target = batch.params.get("target", np.full(N, -1))
+        k_target = lib.labels.n_states(target)
+        for i in range(N):
+            if aggregated[i]:
+                if self.is_random:
+                    means = backend.uniform(0, 1, 1)
+                else:
+                    means = backend.choice(self.state_means, 1)
+            else:
+                means = self.draw_state_means(
+                    backend, k_states=k_target[i] if k_target[i] > 0 else None
+                )
+            state_means[i, : len(means)] = means
+
+        trans_prob[aggregated] = 0
+        batch.params["trans_prob"] = trans_prob
+        batch.params["state_means"] = state_means
+
+    def __call__(self, batch):
+        import pomegranate as pg
+
+        backend = batch.backend
+        N, T = batch.n_traces, batch.trace_length
+        aggregated = batch.params["aggregated"]
+        trans_prob = batch.params["trans_prob"]
+        state_means = batch.params["state_means"]
+
+        # pomegranate samples from numpy's global random state, which is
+        # seeded from the batch to keep runs reproducible
+        np.random.seed(int(backend.integers(0, 2**32 - 1, 1)[0]))
+
+        for i in range(N):
+            means = state_means[i][~np.isnan(state_means[i])]
+            if aggregated[i]:
+                batch.E_true[i] = means[0]
+                continue
+            k_states = len(means)
+
+            dists = [pg.NormalDistribution(m, 0) for m in means]
+            np.random.shuffle(dists)
+            starts = np.array([1 / k_states] * k_states)
+
+            trans_mat = self.trans_mat
+            if trans_mat is None:
+                # Every state is left with probability trans_prob, with equal
+                # probability of going to each of the other states
+                p = trans_prob[i]
+                trans_mat = np.full((k_states, k_states), p)
+                np.fill_diagonal(trans_mat, 1 - (k_states - 1) * p)
+
+            model = pg.HiddenMarkovModel.from_matrix(
+                trans_mat, distributions=dists, starts=starts
+            )
+            model.bake()
+            batch.E_true[i] = np.array(model.sample(T))
+
+
+class MarkovStateStage(HMMStateStage):
+    """
+    Samples the true FRET state paths of the whole batch at once from Markov
+    chains (see lib.markov), as a faster replacement of HMMStateStage with
+    the same parameters. Chains can also be given as transition rates in
+    continuous time, or with per-state dwell time distributions.
+
+    Parameters
+    ----------
+    rates:
+        Transition rates between states, in transitions per frame, instead of
+        trans_mat. Discretized to the per-frame transition matrix.
+    dwell:
+        Dwell time distribution of each state, as (distribution, *args) of a
+        backend distribution in frames, e.g. [("exponential", 20), ("gamma",
+        2, 10)]. The next state is then drawn from trans_mat or rates, without
+        self-transitions, or uniformly from the other states.
+
+    With given state_means and trans_mat, rates or dwell, state j of the
+    chain is the j-th state mean a trace uses, in the given order. Random
+    state means, and state means without a chain of their own, are assigned
+    to the states in random order.
+    """
+
+    def __init__(
+        self,
+        state_means="random",
+        random_k_states_max=5,
+        min_state_diff=0.1,
+        trans_prob=0.1,
+        trans_mat=None,
+        rates=None,
+        dwell=None,
+    ):
+        if rates is not None:
+            if trans_mat is not None:
+                raise ValueError("Give either a transition matrix or rates")
+            rates = np.array(rates, dtype=float)
+            trans_mat = lib.markov.rates_to_trans_mat(rates)
+        super().__init__(
+            state_means,
+            random_k_states_max,
+            min_state_diff,
+            trans_prob,
+            trans_mat,
+        )
+        self.rates = rates
+        self.dwell = dwell
+        if dwell is not None and len(dwell) < self.max_states:
+            raise ValueError(
+                "Dwell time distributions are needed for {} states, got "
+                "{}".format(self.max_states, len(dwell))
+            )
+
+    @property
+    def keeps_order(self):
+        """Whether the state means are assigned to the states in order"""
+        return not self.is_random and (
+            self.trans_mat is not None or self.dwell is not None
+        )
+
+    def draw_state_means(self, backend, k_states=None):
+        means = super().draw_state_means(backend, k_states)
+        if self.keeps_order:
+            # A subset of the given state means stays in the given order
+            given = np.array(self.state_means, dtype=float)
+            means = given[np.isin(given, means)]
+        return means
+
+    def _shared_matrix(self, size, jumps):
+        """
+        The given chain, padded to size states. With jumps, returns the
+        probabilities of the next state on leaving a state instead.
+        """
+        if self.rates is not None and jumps:
+            matrix = self.rates.copy()
+        else:
+            matrix = self.trans_mat.copy()
+        if jumps:
+            np.fill_diagonal(matrix, 0)
+            total = matrix.sum(axis=1)
+            leaves = total > 0
+            matrix[leaves] /= total[leaves, None]
+            # States that are never left jump back to themselves
+            stuck = np.flatnonzero(~leaves)
+            matrix[stuck, stuck] = 1
+        padded = np.eye(size)
+        padded[: len(matrix), : len(matrix)] = matrix
+        return padded
+
+    def _chain_states(self, batch):
+        """
+        Assigns the state means of every trace to the states of its chain, in
+        order if keeps_order and in random order otherwise. Returns (means,
+        k_states, starts), with the means and the uniform initial state
+        probabilities padded to the same width.
+        """
+        state_means = batch.params["state_means"]
+        size = state_means.shape[1]
+        missing = np.isnan(state_means)
+        k_states = (~missing).sum(axis=1)
+
+        if self.keeps_order:
+            means = state_means
+        else:
+            keys = batch.backend.to_numpy(
+                batch.backend.random(state_means.shape)
+            )
+            keys[missing] = np.inf
+            means = np.take_along_axis(
+                state_means, np.argsort(keys, axis=1), axis=1
+            )
+        starts = (np.arange(size)[None, :] < k_states[:, None]) / k_states[
+            :, None
+        ]
+        return means, k_states, starts
+
+    def __call__(self, batch):
+        backend = batch.backend
+        N, T = batch.n_traces, batch.trace_length
+        aggregated = batch.params["aggregated"]
+        means, k_states, starts = self._chain_states(batch)
+        size = means.shape[1]
+
+        if self.dwell is None:
+            if self.trans_mat is not None:
+                trans_mats = self._shared_matrix(size, jumps=False)
+            else:
+                trans_mats = lib.markov.uniform_trans_mats(
+                    batch.params["trans_prob"], k_states, size
+                )
+            states = lib.markov.sample_chain(backend, trans_mats, starts, T)
+        else:
+            if self.trans_mat is not None:
+                jump_mats = self._shared_matrix(size, jumps=True)
+            else:
+                jump_prob = np.where(
+                    k_states > 1, 1 / np.maximum(k_states - 1, 1), 0
+                )
+                jump_mats = lib.markov.uniform_trans_mats(
+                    jump_prob, k_states, size
+                )
+            segments = lib.markov.sample_segments(
+                backend, self.dwell, jump_mats, starts, T
+            )
+            states = lib.markov.segments_to_frames(*segments, N, T)
+
+        E_true = np.take_along_axis(means, states, axis=1)
+        # Aggregates are locked in their single state
+        E_true[aggregated] = means[aggregated, :1]
+        batch.E_true[:] = E_true
+
+
+class KineticStateStage(MarkovStateStage):
+    """
+    Samples the true FRET state paths in continuous time from transition
+    rates (kinetic Monte Carlo, see lib.markov.sample_gillespie), so that
+    states can change within a frame. The FRET the fluorophores emit is
+    averaged over each frame's exposure, and E_true is the state at the
+    start of each frame.
+
+    Parameters
+    ----------
+    rates:
+        Transition rates between states, in transitions per frame. Without
+        rates, every state is left for each of the others at a rate of
+        trans_prob per frame. With given state_means, state j is the j-th
+        state mean, as in MarkovStateStage.
+    exposure:
+        Fraction of each frame the camera is exposed for
+    """
+
+    def __init__(
+        self,
+        state_means="random",
+        random_k_states_max=5,
+        min_state_diff=0.1,
+        trans_prob=0.1,
+        rates=None,
+        exposure=1,
+    ):
+        super().__init__(
+            state_means,
+            random_k_states_max,
+            min_state_diff,
+            trans_prob,
+            rates=rates,
+        )
+        if not 0 < exposure <= 1:
+            raise ValueError("Exposure must be within (0, 1] frames")
+        self.exposure = exposure
+
+    def __call__(self, batch):
+        N, T = batch.n_traces, batch.trace_length
+        aggregated = batch.params["aggregated"]
+        means, k_states, starts = self._chain_states(batch)
+        size = means.shape[1]
+
+        if self.rates is not None:
+            rates = np.zeros((size, size))
+            rates[: len(self.rates), : len(self.rates)] = self.rates
+        else:
+            # Rates from the uniform chains, whose padded states are never
+            # left (nor entered)
+            rates = lib.markov.uniform_trans_mats(
+                batch.params["trans_prob"], k_states, size
+            )
+            rates[:, np.arange(size), np.arange(size)] = 0
+
+        owner, state, start, stop = lib.markov.sample_gillespie(
+            batch.backend, rates, starts, T
+        )
+        states = lib.markov.segments_to_frames(owner, state, start, stop, N, T)
+        E_true = np.take_along_axis(means, states, axis=1)
+        E_averaged = lib.markov.exposure_average(
+            owner, means[owner, state], start, stop, N, T, self.exposure
+        )
+
+        # Aggregates are locked in their single state
+        E_true[aggregated] = means[aggregated, :1]
+        E_averaged[aggregated] = means[aggregated, :1]
+        batch.E_true[:] = E_true
+        batch.E_averaged = E_averaged
+
+
+class PhotophysicsStage(Stage):
+    """
+    Computes the DD, DA and AA intensities of every labelled pair from the
+    true FRET, bleaches donor and acceptor after exponentially distributed
+    lifetimes, and sums up the pairs of aggregates. Sets the bleached frames
+    and the true FRET as seen by the unblinked fluorophores.
+
+    The intensities of a pair come from a two-dye lib.dyes.DyeModel, with
+    channels DD, DA and AA, which defaults to DyeModel.two_color(). Other
+    excitation and emission matrices, e.g. with spectral crosstalk, can be
+    simulated, also for the unquenched donor after its acceptor has
+    bleached. Models with more dyes can't: state paths, bleaching, labels
+    and the batch itself only have one FRET efficiency and the DD, DA and
+    AA channels.
+    """
+
+    name = "photophysics"
+
+    def __init__(
+        self,
+        D_lifetime=400,
+        A_lifetime=200,
+        aa_mismatch=(-0.3, 0.3),
+        null_fret_value=-1,
+        dyes=None,
+    ):
+        self.D_lifetime = D_lifetime
+        self.A_lifetime = A_lifetime
+        self.aa_mismatch = aa_mismatch
+        self.null_fret_value = null_fret_value
+        if dyes is None:
+            dyes = lib.dyes.DyeModel.two_color()
+        if len(dyes.dyes) != 2 or dyes.channels != ("DD", "DA", "AA"):
+            raise ValueError(
+                "Only two-dye models with channels DD, DA, AA can be "
+                "simulated, got dyes {} and channels {}".format(
+                    dyes.dyes, dyes.channels
+                )
+            )
+        self.dyes = dyes
+
+    def _intensities(self, E):
+        """DD, DA and AA intensities of a pair, from (N, T) FRET"""
+        signals = self.dyes.intensities(E[..., None])
+        return signals[..., 0], signals[..., 1], signals[..., 2]
+
+    def _donor_only(self):
+        """DD and DA intensities of a donor whose acceptor has bleached"""
+        # A bleached acceptor is neither excited nor receives transfers
+        donor = lib.dyes.DyeModel(
+            self.dyes.dyes,
+            self.dyes.excitation * [1, 0],
+            self.dyes.emission,
+            self.dyes.transfers,
+            self.dyes.channels,
+        )
+        DD, DA, _ = donor.intensities(np.zeros(1))
+        return DD, DA
+
+    def plan(self, batch):
+        backend = batch.backend
+        N = batch.n_traces
+
+        # Every labelled pair is a row, owned by a trace
+        owner = np.repeat(np.arange(N), batch.params["n_pairs"])
+        P = len(owner)
+
+        def lifetimes(lifetime):
+            if lifetime is None:
+                return np.full(P, np.inf)
+            return np.ceil(backend.exponential(lifetime, P))
+
+        batch.pairs = {
+            "owner": owner,
+            "bleach_D": lifetimes(self.D_lifetime),
+            "bleach_A": lifetimes(self.A_lifetime),
+            # In case AA intensity doesn't correspond exactly to donor
+            # experimentally (S will be off)
+            "aa": 1 + _draw_range(backend, self.aa_mismatch, P),
+            # Only used if the pair turns out to spike
+            "spike_len": backend.integers(2, 10, P),
+        }
+
+    def __call__(self, batch):
+        N, T = batch.n_traces, batch.trace_length
+        aggregated = batch.params["aggregated"]
+        n_pairs = batch.params["n_pairs"]
+        owner = batch.pairs["owner"]
+        bleach_D = batch.pairs["bleach_D"]
+        bleach_A = batch.pairs["bleach_A"]
+        P = len(owner)
+
+        # Which fluorophore bleaches first only matters if both can bleach
+        if self.D_lifetime is not None and self.A_lifetime is not None:
+            first_bleach = np.minimum(bleach_D, bleach_A)
+        else:
+            first_bleach = np.full(P, np.inf)
+        acceptor_first = np.isfinite(first_bleach) & (bleach_A < bleach_D)
+
+        # Donor is quenched until the first bleaching, and fully emits
+        # between acceptor and donor bleaching. DA goes to zero with either
+        donor_until = np.where(
+            np.isfinite(first_bleach), first_bleach, bleach_D
+        )
+        acceptor_until = np.where(
+            np.isfinite(first_bleach), first_bleach, bleach_A
+        )
+        n_DD = lib.batch.interval_sum(owner, 0, donor_until, N, T)
+        n_DA = lib.batch.interval_sum(owner, 0, acceptor_until, N, T)
+        unquenched = lib.batch.interval_sum(
+            owner[acceptor_first],
+            bleach_A[acceptor_first],
+            bleach_D[acceptor_first],
+            N,
+            T,
+        )
+
+        # Sudden donor spike for small aggregates to mimic observations
+        spiked = acceptor_first & (aggregated & (n_pairs <= 2))[owner]
+        spike_len = np.minimum(
+            batch.pairs["spike_len"][spiked], bleach_D[spiked]
+        )
+        spike = lib.batch.interval_sum(
+            owner[spiked],
+            bleach_A[spiked],
+            np.minimum(bleach_A[spiked] + spike_len, bleach_D[spiked]),
+            N,
+            T,
+        )
+
+        n_AA = lib.batch.interval_sum(owner, 0, bleach_A, N, T)
+        AA = lib.batch.interval_sum(
+            owner, 0, bleach_A, N, T, weights=batch.pairs["aa"]
+        )
+
+        # Intensities follow the FRET averaged over each frame's exposure,
+        # if the states can change within a frame
+        E_true = batch.E_true
+        E_emitted = E_true if batch.E_averaged is None else batch.E_averaged
+        DD, DA, AA_pair = self._intensities(E_emitted)
+        DD_only, DA_only = self._donor_only()
+        n_only = unquenched + spike
+        batch.DD[:] = DD * n_DD + DD_only * n_only
+        batch.DA[:] = DA * n_DA + DA_only * n_only
+        batch.AA[:] = np.where(n_AA > 0, AA * AA_pair, 0)
+
+        # A single pair is bleached from its first bleaching. For aggregates,
+        # it's when all fluorophores of a channel have bleached
+        off = (batch.DD == 0) | (batch.DA == 0) | (batch.AA == 0)
+        trace_bleach = np.full(N, np.inf)
+        np.minimum.at(trace_bleach, owner, first_bleach)
+        channel_bleach = np.min(
+            [np.argmax(x == 0, axis=1) for x in (batch.DD, batch.DA, batch.AA)],
+            axis=0,
+        ).astype(float)
+        channel_bleach[channel_bleach == 0] = np.inf
+        trace_bleach[aggregated] = channel_bleach[aggregated]
+
+        batch.bleached[:] = off | (batch.frames >= trace_bleach[:, None])
+
+        # Aggregates count as bleached from the first frame where any
+        # channel is off
+        bleaches_at = trace_bleach.copy()
+        agg_bleach = lib.batch.first_true(batch.bleached)
+        agg_bleach[agg_bleach == 0] = np.inf
+        bleaches_at[aggregated] = agg_bleach[aggregated]
+        batch.params["bleaches_at"] = bleaches_at
+
+        # True FRET as seen by the (unblinked) fluorophores, which differs
+        # from the state means for aggregates
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if batch.E_averaged is None:
+                E_seen = calc_E(batch.DD, batch.DA)
+            else:
+                # The ground truth stays at the states, not their averages
+                DD, DA, _ = self._intensities(E_true)
+                E_seen = calc_E(
+                    DD * n_DD + DD_only * n_only, DA * n_DA + DA_only * n_only
+                )
+        batch.E_true[:] = np.where(
+            batch.frames < trace_bleach[:, None], E_seen, self.null_fret_value
+        )
+
+
+class BlinkingStage(Stage):
+    """Adds photoblinking to a fraction of the (non-aggregate) traces"""
+
+    name = "blinking"
+
+    def __init__(self, blink_prob=0.05):
+        self.blink_prob = blink_prob
+
+    def plan(self, batch):
+        backend = batch.backend
+        N, T = batch.n_traces, batch.trace_length
+        # No blinking in aggregates (excessive/complicated)
+        blinks = backend.random(N) < self.blink_prob
+        blinks &= ~batch.params["aggregated"]
+        batch.params["blinks"] = blinks
+        # Each blink starts at a random frame, lasts 1-14 frames and switches
+        # off the donor or the acceptor with equal probability
+        batch.params["blink_start"] = backend.integers(1, T, N)
+        batch.params["blink_length"] = backend.integers(1, 15, N)
+        batch.params["blink_donor"] = backend.random(N) < 0.5
+
+    def __call__(self, batch):
+        params = batch.params
+        lib.batch.blink_batch(
+            batch,
+            params["blinks"],
+            params["blink_start"],
+            params["blink_length"],
+            params["blink_donor"],
+        )
+
+
+class ScramblingStage(Stage):
+    """
+    Scrambles a fraction of the traces for model robustness, but only traces
+    of 1 or 2 pairs (diminishing effect otherwise)
+    """
+
+    name = "scrambling"
+
+    def __init__(self, scramble_prob=0.3):
+        self.scramble_prob = scramble_prob
+
+    def plan(self, batch):
+        selected = batch.backend.random(batch.n_traces) < self.scramble_prob
+        selected = _steer(batch, selected, lib.labels.Label.SCRAMBLE)
+        selected &= batch.params["n_pairs"] <= 2
+        batch.params["scrambled"] = selected
+
+    def __call__(self, batch):
+        lib.batch.scramble_batch(batch, batch.params["scrambled"])
+
+
+class BleedThroughStage(Stage):
+    """Adds donor bleed-through into the acceptor channel"""
+
+    name = "bleed_through"
+
+    def __init__(self, bleed_through=0):
+        self.bleed_through = bleed_through
+
+    def plan(self, batch):
+        batch.params["bleed_through"] = _draw_range(
+            batch.backend, self.bleed_through, batch.n_traces
+        )
+
+    def __call__(self, batch):
+        lib.batch.bleed_through_batch(batch, batch.params["bleed_through"])
+
+
+class CorrectionStage(Stage):
+    """
+    Instrument imperfections that correction factors undo, as in ALEX
+    experiments: the donor is detected gamma times less efficiently than the
+    acceptor, acceptor excitation is beta times as strong as donor
+    excitation, the acceptor channel picks up leakage times the donor signal
+    and direct_excitation times the acceptor signal under donor excitation.
+    Factors are drawn per trace, and lib.kernels.correct_E_S recovers the
+    corrected E and S from the resulting signals.
+
+    Parameters
+    ----------
+    gamma, beta, leakage, direct_excitation:
+        Value or range of each correction factor
+    """
+
+    name = "correction"
+
+    def __init__(self, gamma=1, beta=1, leakage=0, direct_excitation=0):
+        self.gamma = gamma
+        self.beta = beta
+        self.leakage = leakage
+        self.direct_excitation = direct_excitation
+
+    def plan(self, batch):
+        backend = batch.backend
+        N = batch.n_traces
+        for key in ("gamma", "beta", "leakage", "direct_excitation"):
+            batch.params[key] = _draw_range(backend, getattr(self, key), N)
+
+    def __call__(self, batch):
+        params = batch.params
+        batch.DD /= params["gamma"][:, None]
+        batch.AA *= params["beta"][:, None]
+        batch.DA += params["leakage"][:, None] * batch.DD
+        batch.DA += params["direct_excitation"][:, None] * batch.AA
+
+
+class NoiseStage(Stage):
+    """
+    Adds gaussian noise to all channels, and to a fraction of the traces
+    centered Gamma(1, 1.1 * sigma) noise, to make the data appear less
+    synthetic.
+    """
+
+    name = "noise"
+
+    def __init__(self, noise=0.08, gamma_noise_prob=0.5):
+        self.noise = noise
+        self.gamma_noise_prob = gamma_noise_prob
+        self._buffer = None
+
+    def __getstate__(self):
+        # The scratch buffer isn't worth sending to worker processes
+        state = self.__dict__.copy()
+        state["_buffer"] = None
+        return state
+
+    def _scratch(self, batch):
+        """
+        (N, T) buffer the noise is drawn into. Kept between batches, so that
+        a run of equally sized batches allocates it only once.
+        """
+        shape = (batch.n_traces, batch.trace_length)
+        if self._buffer is None or tuple(self._buffer.shape) != shape:
+            self._buffer = batch.backend.xp.empty(shape)
+        return self._buffer
+
+    def plan(self, batch):
+        backend = batch.backend
+        N = batch.n_traces
+        batch.params["noise"] = _draw_range(backend, self.noise, N)
+        batch.params["gamma_noise"] = backend.random(N) < self.gamma_noise_prob
+
+    def __call__(self, batch):
+        backend = batch.backend
+        sigma = batch.params["noise"]
+        has_gamma = batch.params["gamma_noise"]
+        noise = self._scratch(batch)
+
+        for signal in (batch.DD, batch.DA, batch.AA):
+            backend.standard_normal(out=noise)
+            noise *= sigma[:, None]
+            signal += noise
+
+        if not has_gamma.any():
+            return
+        # Gamma noise is drawn for every trace and zeroed where unused, so
+        # that it can be added without indexing (and copying) the selection
+        scale = backend.xp.where(has_gamma, 1.1 * sigma, 0.0)[:, None]
+        for signal in (batch.DD, batch.DA, batch.AA):
+            backend.standard_gamma(1.0, out=noise)
+            noise -= noise.mean(axis=1, keepdims=True)
+            noise *= scale
+            signal += noise
+
+
+class PhotonNoiseStage(Stage):
+    """
+    Observation model with shot noise, instead of NoiseStage. The channels'
+    intensities set the expected number of photons per frame, with
+    brightness photons for an intensity of 1 on top of a constant
+    background, and the detected photons are Poisson distributed. An EMCCD
+    camera amplifies every photon by a random gain, which is modelled as
+    Gamma(photons, gain) and doubles the variance (excess noise). Signals are
+    converted back to intensities, so that they have the same expectation as
+    without noise.
+
+    Parameters
+    ----------
+    brightness:
+        Photons per frame at an intensity of 1. Value or range.
+    background:
+        Background photons per frame and channel
+    gain:
+        EM gain of the camera, or None for a camera without EM
+        amplification
+    """
+
+    name = "noise"
+
+    def __init__(self, brightness=100, background=10, gain=None):
+        self.brightness = brightness
+        self.background = background
+        self.gain = gain
+
+    def plan(self, batch):
+        brightness = _draw_range(batch.backend, self.brightness, batch.n_traces)
+        batch.params["brightness"] = brightness
+        # Noise of an intensity of 1, for comparison with gaussian noise
+        excess = 1 if self.gain is None else 2
+        batch.params["noise"] = (
+            np.sqrt(excess * (brightness + self.background)) / brightness
+        )
+
+    def __call__(self, batch):
+        backend = batch.backend
+        xp = backend.xp
+        brightness = batch.params["brightness"][None, :, None]
+
+        # All channels are drawn at once, as (channels, N, T)
+        signals = xp.stack((batch.DD, batch.DA, batch.AA))
+        expected = brightness * xp.clip(signals, 0, None) + self.background
+        photons = backend.poisson(expected)
+        if self.gain is None:
+            counts = photons
+        else:
+            counts = backend.gamma(photons, self.gain, photons.shape)
+            counts /= self.gain
+
+        signals = (counts - self.background) / brightness
+        batch.DD[:], batch.DA[:], batch.AA[:] = signals
+
+
+class ScalingStage(Stage):
+    """Scales traces to arbitrary units"""
+
+    name = "scaling"
+
+    def __init__(self, au_scaling_factor=1):
+        self.au_scaling_factor = au_scaling_factor
+
+    def plan(self, batch):
+        batch.params["scaling"] = _draw_range(
+            batch.backend, self.au_scaling_factor, batch.n_traces
+        )
+
+    def __call__(self, batch):
+        scaling = batch.params["scaling"]
+        for signal in (batch.DD, batch.DA, batch.AA):
+            signal *= scaling[:, None]
+
+
+class ObservablesStage(Stage):
+    """
+    Calculates observed E and S, as one would in real experiments. Frames
+    where they're undefined (no signal) are nan, and are filled in from the
+    previous frame on conversion (see batch_to_frame).
+    """
+
+    name = "observables"
+
+    def __call__(self, batch):
+        batch.E, batch.S = masked_E_S(batch.DD, batch.DA, batch.AA)
+
+
+class BackgroundStage(Stage):
+    """
+    Adds background segments from recordings of real experiments (see
+    lib.background) to all channels. Runs after ObservablesStage, so that
+    the channels become raw signals while E and S stay those of the
+    background-corrected signals. The background is kept as
+    batch.background.
+
+    Parameters
+    ----------
+    pool:
+        lib.background.BackgroundPool, or the path of a pool file
+    scale:
+        Factor to convert the recorded background to the units of the
+        simulated signals. Value or range.
+    """
+
+    name = "background"
+
+    def __init__(self, pool, scale=1):
+        if not isinstance(pool, lib.background.BackgroundPool):
+            pool = lib.background.BackgroundPool(pool)
+        self.pool = pool
+        self.scale = scale
+
+    def plan(self, batch):
+        backend = batch.backend
+        recording, offset = self.pool.draw(
+            backend, batch.n_traces, batch.trace_length
+        )
+        batch.params["bg_recording"] = recording
+        batch.params["bg_offset"] = offset
+        batch.params["bg_scale"] = _draw_range(
+            backend, self.scale, batch.n_traces
+        )
+
+    def __call__(self, batch):
+        backend = batch.backend
+        params = batch.params
+        segments = self.pool.read(
+            backend.to_numpy(params["bg_recording"]),
+            backend.to_numpy(params["bg_offset"]),
+            batch.trace_length,
+        )
+        background = backend.asarray(segments) * params["bg_scale"][:, None]
+        batch.background = background
+        for signal, bg in zip((batch.DD, batch.DA, batch.AA), background):
+            signal += bg
+
+
+class LabellingStage(Stage):
+    """
+    Labels every frame: bleached frames, aggregates, scrambled traces, traces
+    too noisy to tell the FRET states apart, and otherwise the number of
+    observed FRET states. Bad traces lose their true FRET.
+    """
+
+    name = "labelling"
+
+    def __init__(
+        self, acceptable_noise=0.25, null_fret_value=-1, merge_labels=False
+    ):
+        self.acceptable_noise = acceptable_noise
+        self.null_fret_value = null_fret_value
+        self.merge_labels = merge_labels
+
+    def __call__(self, batch):
+        params = batch.params
+        aggregated = params["aggregated"]
+        scrambled = params["scrambled"]
+
+        # Count actually observed states, because a slow system might not
+        # transition in the observation window, and check whether the noise
+        # within any state surpasses the limit
+        E = batch.E if batch.E is not None else batch.E_true
+        E_true = batch.E_true
+        unbleached = batch.frames < params["bleaches_at"][:, None]
+        if "length" in params:
+            # Frames after the end of a trace aren't observed
+            valid = batch.valid
+            E_true = np.where(valid, E_true, self.null_fret_value)
+            unbleached &= valid
+        n_states, state_noise = lib.batch.state_noise(
+            E_true, E, unbleached, self.null_fret_value
+        )
+        noisy = state_noise > self.acceptable_noise
+        params["noisy"] = noisy
+        params["n_states"] = n_states
+
+        batch.label[:] = lib.labels.label_frames(
+            batch.bleached,
+            aggregated,
+            scrambled,
+            noisy,
+            n_states,
+            merge=self.merge_labels,
+        )
+        if "length" in params:
+            batch.label[~valid] = -1
+
+        # Bad traces don't contain FRET
+        batch.E_true[noisy | aggregated | scrambled] = -1
+
+
+def build_pipeline(
+    state_means="random",
+    random_k_states_max=5,
+    min_state_diff=0.1,
+    D_lifetime=400,
+    A_lifetime=200,
+    blink_prob=0.05,
+    bleed_through=0,
+    aa_mismatch=(-0.3, 0.3),
+    trans_prob=0.1,
+    noise=0.08,
+    trans_mat=None,
+    au_scaling_factor=1,
+    aggregation_prob=0.1,
+    max_aggregate_size=100,
+    null_fret_value=-1,
+    acceptable_noise=0.25,
+    scramble_prob=0.3,
+    gamma_noise_prob=0.5,
+    merge_labels=False,
+    state_model="hmm",
+    rates=None,
+    dwell=None,
+    exposure=1,
+    noise_model="gaussian",
+    brightness=100,
+    background=10,
+    em_gain=None,
+    background_pool=None,
+    background_scale=1,
+    trace_lengths=None,
+    gamma=1,
+    beta=1,
+    leakage=0,
+    direct_excitation=0,
+    dyes=None,
+):
+    """
+    Returns the default simulation pipeline. Parameters are as in
+    lib.algorithms.generate_traces.
+    """
+    if noise_model == "gaussian":
+        noise_stage = NoiseStage(noise, gamma_noise_prob)
+    elif noise_model == "photon":
+        noise_stage = PhotonNoiseStage(brightness, background, em_gain)
+    else:
+        raise ValueError("Unknown noise model '{}'".format(noise_model))
+
+    if state_model == "hmm":
+        if rates is not None or dwell is not None:
+            raise ValueError(
+                "Rates and dwell time distributions require "
+                "state_model='markov'"
+            )
+        states = HMMStateStage(
+            state_means,
+            random_k_states_max,
+            min_state_diff,
+            trans_prob,
+            trans_mat,
+        )
+    elif state_model == "kinetic":
+        if trans_mat is not None or dwell is not None:
+            raise ValueError(
+                "state_model='kinetic' is given by rates or trans_prob only"
+            )
+        states = KineticStateStage(
+            state_means,
+            random_k_states_max,
+            min_state_diff,
+            trans_prob,
+            rates,
+            exposure,
+        )
+    elif state_model == "markov":
+        states = MarkovStateStage(
+            state_means,
+            random_k_states_max,
+            min_state_diff,
+            trans_prob,
+            trans_mat,
+            rates,
+            dwell,
+        )
+    else:
+        raise ValueError("Unknown state model '{}'".format(state_model))
+
+    stages = [
+        AggregationStage(aggregation_prob, max_aggregate_size),
+        states,
+        PhotophysicsStage(
+            D_lifetime, A_lifetime, aa_mismatch, null_fret_value, dyes
+        ),
+        BlinkingStage(blink_prob),
+        ScramblingStage(scramble_prob),
+        BleedThroughStage(bleed_through),
+        noise_stage,
+        ScalingStage(au_scaling_factor),
+        ObservablesStage(),
+        LabellingStage(acceptable_noise, null_fret_value, merge_labels),
+    ]
+    if (gamma, beta, leakage, direct_excitation) != (1, 1, 0, 0):
+        # Imperfections of the instrument come before the camera noise
+        correction = CorrectionStage(gamma, beta, leakage, direct_excitation)
+        stages.insert(stages.index(noise_stage), correction)
+    if background_pool is not None:
+        stages.insert(-1, BackgroundStage(background_pool, background_scale))
+    if trace_lengths is not None:
+        stages.insert(0, LengthStage(trace_lengths))
+    return Pipeline(stages)
+
+
+def batch_signals(batch):
+    """
+    Per-frame columns of the DataFrame of batch_to_frame, as a dict of
+    (N, T) arrays. Undefined E and S, from divisions by 0, are replaced by
+    the last valid value of the trace. Frames past the length of a trace are
+    left as they are.
+    """
+    N, T = batch.n_traces, batch.trace_length
+    E = ffill(batch.E) if batch.E is not None else np.full((N, T), np.nan)
+    S = ffill(batch.S) if batch.S is not None else np.full((N, T), np.nan)
+    signals = {
+        "DD": batch.DD,
+        "DA": batch.DA,
+        "AA": batch.AA,
+        "E": E,
+        "E_true": ffill(batch.E_true),
+        "S": S,
+        "label": batch.label,
+    }
+    if batch.background is not None:
+        for name, bg in zip(lib.background.CHANNELS, batch.background):
+            signals[name + "_bg"] = bg
+    return signals
+
+
+def batch_metadata(batch, keep=None):
+    """
+    Per-trace metadata columns of the DataFrame of batch_to_frame, as a dict
+    of arrays of the traces in the (N,) mask keep, or of all traces. Traces
+    that don't bleach have None as their bleaching time.
+    """
+    if keep is None:
+        keep = np.ones(batch.n_traces, dtype=bool)
+    N = batch.n_traces
+    label = batch.label
+
+    # Calculate difference between states if >=2 states and actual smFRET.
+    # Missing states are nan, which sort last
+    state_means = batch.params.get("state_means", np.full((N, 1), np.nan))
+    diffs = np.diff(np.sort(state_means, axis=1), axis=1)
+    has_diff = ~np.isnan(diffs).all(axis=1)
+    min_diff = np.full(N, np.nan)
+    if has_diff.any():
+        min_diff[has_diff] = np.nanmin(diffs[has_diff], axis=1)
+    min_diff[lib.labels.n_states(label[:, 0]) < 2] = np.nan
+
+    bleaches_at = batch.params["bleaches_at"][keep]
+    if np.isfinite(bleaches_at).all():
+        bleaches_at = bleaches_at.astype(int)
+    else:
+        bleaches_at = np.array(
+            [int(b) if np.isfinite(b) else None for b in bleaches_at],
+            dtype=object,
+        )
+    return {
+        "_bleaches_at": bleaches_at,
+        "_noise_level": np.asarray(batch.params["noise"])[keep],
+        "_min_state_diff": min_diff[keep],
+    }
+
+
+def kept_traces(batch, discard_unbleached=False, keep=None):
+    """
+    (N,) mask of the traces of a batch that are kept: those in keep, if
+    given, and only those that bleach with discard_unbleached
+    """
+    keep = np.ones(batch.n_traces, dtype=bool) if keep is None else keep.copy()
+    if discard_unbleached:
+        keep &= batch.last(batch.label) == lib.labels.Label.BLEACHED
+    return keep
+
+
+def batch_to_frame(batch, first_name=0, discard_unbleached=False, keep=None):
+    """
+    Converts a simulated batch into the DataFrame returned by
+    lib.algorithms.generate_traces. Columns pre-fixed with underscore contain
+    per-trace metadata, repeated for every frame. With a BackgroundStage, the
+    background added to every channel is kept as DD_bg, DA_bg and AA_bg.
+    Traces with a planned length end at their length, so that frames are
+    packed without padding. Only traces in the (N,) mask keep are converted,
+    if given.
+    """
+    N, T = batch.n_traces, batch.trace_length
+    keep = kept_traces(batch, discard_unbleached, keep)
+    n_kept = int(keep.sum())
+    lengths = np.asarray(batch.lengths)[keep]
+
+    def per_frame(x):
+        return np.repeat(np.asarray(x)[keep], lengths)
+
+    if "length" in batch.params:
+        frames = np.nonzero(batch.valid[keep])[1]
+
+        def flat(x):
+            return x[keep][batch.valid[keep]]
+
+    else:
+        frames = np.tile(np.arange(T), n_kept)
+
+        def flat(x):
+            return x[keep].ravel()
+
+    signals = batch_signals(batch)
+    columns = {c: flat(signals[c]) for c in ("DD", "DA", "AA", "E", "E_true")}
+    columns["S"] = flat(signals["S"])
+    columns["frame"] = frames + 1
+    columns["name"] = per_frame(np.arange(first_name, first_name + N))
+    columns["label"] = flat(signals["label"])
+    for c, values in batch_metadata(batch, keep).items():
+        columns[c] = np.repeat(values, lengths)
+    for c in lib.background.CHANNELS:
+        if c + "_bg" in signals:
+            columns[c + "_bg"] = flat(signals[c + "_bg"])
+    return pd.DataFrame(columns, index=frames)
+
+
+# How the values of the labelled pairs of a trace are combined into one
+# value per trace in parameter_table. Bleaching times are those of the first
+# pair to bleach, everything else is averaged over the pairs.
+PAIR_AGGREGATES = {"bleach_D": "min", "bleach_A": "min"}
+
+
+def parameter_table(batch, first_name=0):
+    """
+    Returns the per-trace parameters of a simulated batch as a DataFrame,
+    indexed by trace name. Parameters with several values per trace, like
+    state_means, are split into numbered columns. Values of the labelled
+    pairs, like bleaching times and the AA mismatch, are combined per trace
+    (see PAIR_AGGREGATES) into "pair_" columns, which are the values of the
+    only pair of traces that aren't aggregated.
+    """
+    N = batch.n_traces
+    columns = {}
+    for key, value in batch.params.items():
+        value = batch.backend.to_numpy(value)
+        if value.ndim == 1:
+            columns[key] = value
+        else:
+            for j in range(value.shape[1]):
+                columns["{}_{}".format(key, j)] = value[:, j]
+
+    owner = batch.backend.to_numpy(batch.pairs["owner"])
+    n_pairs = np.bincount(owner, minlength=N)
+    for key, value in batch.pairs.items():
+        if key == "owner":
+            continue
+        value = batch.backend.to_numpy(value).astype(float)
+        if PAIR_AGGREGATES.get(key) == "min":
+            combined = np.full(N, np.inf)
+            np.minimum.at(combined, owner, value)
+        else:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                combined = (
+                    np.bincount(owner, weights=value, minlength=N) / n_pairs
+                )
+        # Traces without any pairs have no values
+        combined[n_pairs == 0] = np.nan
+        columns["pair_" + key] = combined
+    return pd.DataFrame(
+        columns,
+        index=pd.Index(np.arange(first_name, first_name + N), name="name"),
+    )
@@ -0,0 +1,153 @@
+"""
+E-S population histogram of all generated frames. Frames are binned as they
+arrive, so the histogram is never recomputed from the full dataset, and can
+be drawn into a lib.mpl_layout.MatplotlibCanvas with the JointGrid layout
+while generation is running, e.g.
+
+    population = PopulationHistogram(classes=["2-state", "3-state"])
+    traces = generate_traces(10 ** 6, batch_callback=population.update_frame)
+    population.draw(canvas)
+"""
+
+import numpy as np
+
+import lib.labels
+
+
+class PopulationHistogram:
+    """
+    2D histogram of E and S, with marginals, of the frames of selected
+    classes. Bleached frames are never counted, and neither are frames with
+    E or S outside of the ranges.
+
+    Parameters
+    ----------
+    bins:
+        Number of bins along E and S
+    E_range, S_range:
+        (low, high) of the bins of E and S
+    classes:
+        Classes to include, by name (e.g. "aggregate" or "3-state") or
+        label, or None to include all frames that aren't bleached
+    """
+
+    def __init__(
+        self, bins=100, E_range=(-0.1, 1.1), S_range=(-0.1, 1.1), classes=None
+    ):
+        self.bins = bins
+        self.E_range = E_range
+        self.S_range = S_range
+        if classes is not None:
+            classes = [lib.labels.parse_class(c) for c in classes]
+        self.classes = classes
+        self.counts = np.zeros((bins, bins), dtype=np.int64)
+        self._artists = None
+
+    @property
+    def E_edges(self):
+        return np.linspace(*self.E_range, self.bins + 1)
+
+    @property
+    def S_edges(self):
+        return np.linspace(*self.S_range, self.bins + 1)
+
+    @property
+    def n_frames(self):
+        """Number of frames counted"""
+        return int(self.counts.sum())
+
+    def _bin(self, x, lo_hi):
+        """Bin index of every value, and -1 outside of the range"""
+        lo, hi = lo_hi
+        idx = np.floor((x - lo) * (self.bins / (hi - lo)))
+        # The upper edge belongs to the last bin, as with np.histogram2d
+        idx[x == hi] = self.bins - 1
+        inside = (idx >= 0) & (idx < self.bins)
+        return np.where(inside, idx, -1).astype(np.intp)
+
+    def update(self, E, S, label):
+        """
+        Adds frames to the histogram
+
+        Parameters
+        ----------
+        E, S, label:
+            Arrays of any (matching) shape of the frames
+        """
+        E = np.ravel(np.asarray(E, dtype=float))
+        S = np.ravel(np.asarray(S, dtype=float))
+        label = np.ravel(label)
+
+        keep = label != lib.labels.Label.BLEACHED
+        if self.classes is not None:
+            keep &= np.isin(label, self.classes)
+        with np.errstate(invalid="ignore"):
+            i = self._bin(E[keep], self.E_range)
+            j = self._bin(S[keep], self.S_range)
+        inside = (i >= 0) & (j >= 0)
+
+        flat = i[inside] * self.bins + j[inside]
+        self.counts += np.bincount(flat, minlength=self.bins**2).reshape(
+            self.bins, self.bins
+        )
+
+    def update_frame(self, df):
+        """Adds the frames of a DataFrame of traces"""
+        self.update(df["E"].values, df["S"].values, df["label"].values)
+
+    def update_batch(self, batch):
+        """Adds the frames of a simulated lib.batch.TraceBatch"""
+        to_numpy = batch.backend.to_numpy
+        self.update(to_numpy(batch.E), to_numpy(batch.S), batch.label)
+
+    def reset(self):
+        """Empties the histogram"""
+        self.counts[:] = 0
+
+    def marginals(self):
+        """Counts along E and along S"""
+        return self.counts.sum(axis=1), self.counts.sum(axis=0)
+
+    def draw(self, canvas, cmap="viridis"):
+        """
+        Draws the histogram into a canvas set up with setupJointGridLayout.
+        The artists are created on the first call and only updated after
+        that, so it's cheap to redraw after every batch.
+        """
+        E_counts, S_counts = self.marginals()
+        if self._artists is None or self._artists[0].axes is not canvas.ax_ctr:
+            for ax in canvas.axes:
+                ax.clear()
+            image = canvas.ax_ctr.imshow(
+                self.counts.T,
+                origin="lower",
+                aspect="auto",
+                interpolation="nearest",
+                cmap=cmap,
+                extent=(*self.E_range, *self.S_range),
+            )
+            top = canvas.ax_top.stairs(E_counts, self.E_edges, color="black")
+            right = canvas.ax_rgt.stairs(
+                S_counts,
+                self.S_edges,
+                orientation="horizontal",
+                color="black",
+            )
+            canvas.ax_ctr.set_xlabel("E")
+            canvas.ax_ctr.set_ylabel("S")
+            canvas.ax_top.set_xlim(*self.E_range)
+            canvas.ax_rgt.set_ylim(*self.S_range)
+            for ax in canvas.axes_marg:
+                ax.set_xticks(())
+                ax.set_yticks(())
+            self._artists = image, top, right
+        else:
+            image, top, right = self._artists
+            image.set_data(self.counts.T)
+            top.set_data(E_counts)
+            right.set_data(S_counts)
+
+        image.set_clim(0, max(1, self.counts.max()))
+        canvas.ax_top.set_ylim(0, max(1, E_counts.max()) * 1.05)
+        canvas.ax_rgt.set_xlim(0, max(1, S_counts.max()) * 1.05)
+        canvas.draw_idle()
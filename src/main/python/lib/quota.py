@@ -0,0 +1,196 @@
+"""
+Generation of class-balanced datasets. Instead of leaving the mix of classes
+to the simulation probabilities and subsampling afterwards, every trace is
+planned with a target class (aggregate, scrambled or k states), traces are
+kept while their class still has room, and shortfalls are topped up in
+further rounds, e.g.
+
+    traces = generate_quota({"aggregate": 500, "2-state": 500, "3-state": 500})
+"""
+
+import numpy as np
+import pandas as pd
+
+import lib.backend
+import lib.batch
+import lib.labels
+import lib.pipeline
+
+# Traces planned per expected missing trace, as a margin on the yield
+OVERSHOOT = 1.25
+
+# Rounds are at most this many times batch_size, however low the yield
+MAX_ROUND_FACTOR = 10
+
+
+def parse_quotas(quotas):
+    """
+    Converts quotas keyed by class name (e.g. "noisy" or "3-state") or label
+    to a dict of {label: count}
+    """
+    table = {}
+    for key, count in quotas.items():
+        label = lib.labels.parse_class(key)
+        table[label] = table.get(label, 0) + int(count)
+    return table
+
+
+def generate_quota(
+    quotas,
+    trace_length=200,
+    batch_size=1000,
+    max_rounds=100,
+    seed=None,
+    backend="numpy",
+    pipeline=None,
+    discard_unbleached=False,
+    return_parameters=False,
+    progressbar_callback=None,
+    **params
+):
+    """
+    Generates exactly the requested number of traces of every class.
+
+    Parameters
+    ----------
+    quotas:
+        Number of traces per class, keyed by class name or label (see
+        lib.labels)
+    trace_length, batch_size, seed, backend, discard_unbleached:
+        As in lib.algorithms.generate_traces. With discard_unbleached, only
+        traces that bleach count towards the quotas.
+    max_rounds:
+        Number of rounds to simulate at most, before giving up on quotas
+        that the parameters can't produce (e.g. noisy traces when the noise
+        is always acceptable). Every round simulates at least batch_size
+        traces, and more for classes that rarely turn out as planned (e.g.
+        too noisy, or not bleaching), sized by the yield of every class in
+        the rounds so far.
+    pipeline:
+        Simulation pipeline. Defaults to lib.pipeline.build_pipeline(**params)
+    return_parameters:
+        Whether to also return the per-trace parameters, including the class
+        every trace was planned for as "target"
+    progressbar_callback:
+        Progressbar callback object, incremented for every trace kept. If
+        None, progress is printed to the terminal with tqdm instead.
+    **params:
+        Simulation parameters, as in lib.algorithms.generate_traces
+
+    Returns
+    -------
+    DataFrame of traces, named in the order they were generated, or a tuple
+    of (traces, parameters) if return_parameters is set
+    """
+    if params.get("merge_labels"):
+        raise ValueError("Quotas are for unmerged classes only")
+    remaining = parse_quotas(quotas)
+    if pipeline is None:
+        pipeline = lib.pipeline.build_pipeline(**params)
+
+    max_states = getattr(pipeline["states"], "max_states", None)
+    for label in remaining:
+        k = int(lib.labels.n_states(label))
+        if max_states is not None and k > max_states:
+            raise ValueError(
+                "Can't generate {} traces with at most {} states".format(
+                    lib.labels.class_name(label), max_states
+                )
+            )
+
+    backend = lib.backend.get_backend(backend, seed=seed)
+    if progressbar_callback is None:
+        from tqdm import tqdm
+
+        progress = tqdm(total=sum(remaining.values()))
+    else:
+        progress = None
+
+    traces = []
+    lengths = []
+    parameters = []
+    # Traces planned as every class, and usable traces of that class they
+    # turned into, for the yield of every class
+    planned = dict.fromkeys(remaining, 0)
+    produced = dict.fromkeys(remaining, 0)
+    for round_ in range(max_rounds):
+        if sum(remaining.values()) == 0:
+            break
+
+        # Plan enough traces of every class to cover what's missing at the
+        # yield seen so far. The yield starts out at 1, and is estimated
+        # with one extra success so it never reaches 0.
+        labels = np.array([label for label in remaining if remaining[label]])
+        yields = np.array(
+            [(produced[label] + 1) / (planned[label] + 1) for label in labels]
+        )
+        needed = np.array([remaining[label] for label in labels]) / yields
+        n = int(np.ceil(needed.sum() * OVERSHOOT))
+        n = min(max(n, batch_size), MAX_ROUND_FACTOR * batch_size)
+        backend.stream(round_)
+        # Targets are drawn in proportion to the traces needed per class
+        cdf = np.cumsum(needed) / needed.sum()
+        u = backend.to_numpy(backend.random(n))
+        targets = labels[np.minimum(np.searchsorted(cdf, u), len(labels) - 1)]
+
+        batch = lib.batch.TraceBatch(n, trace_length, backend)
+        batch.params["target"] = targets
+        pipeline.run(batch)
+
+        # Keep traces of the classes that still have room, whatever they
+        # were planned as
+        classes = lib.labels.trace_labels(batch.label)
+        usable = np.ones(n, dtype=bool)
+        if discard_unbleached:
+            usable &= batch.last(batch.label) == lib.labels.Label.BLEACHED
+        for label in labels:
+            planned[label] += int((targets == label).sum())
+            produced[label] += int(
+                (usable & (targets == label) & (classes == label)).sum()
+            )
+
+        keep = np.zeros(n, dtype=bool)
+        for label in labels:
+            idx = np.flatnonzero(usable & (classes == label))
+            idx = idx[: remaining[label]]
+            keep[idx] = True
+            remaining[label] -= len(idx)
+
+        if keep.any():
+            traces.append(lib.pipeline.batch_to_frame(batch, keep=keep))
+            lengths.append(np.asarray(batch.lengths)[keep])
+            if return_parameters:
+                table = lib.pipeline.parameter_table(batch)
+                parameters.append(table[keep])
+
+        n_kept = int(keep.sum())
+        if progress is not None:
+            progress.update(n_kept)
+        else:
+            for _ in range(n_kept):
+                progressbar_callback.increment()
+    else:
+        missing = {
+            lib.labels.class_name(label): count
+            for label, count in remaining.items()
+            if count > 0
+        }
+        if missing:
+            raise RuntimeError(
+                "Quotas not met after {} rounds, still missing {}".format(
+                    max_rounds, missing
+                )
+            )
+
+    if progress is not None:
+        progress.close()
+
+    traces = pd.concat(traces)
+    lengths = np.concatenate(lengths)
+    n_traces = len(lengths)
+    traces["name"] = np.repeat(np.arange(n_traces), lengths)
+    if return_parameters:
+        parameters = pd.concat(parameters)
+        parameters.index = pd.Index(np.arange(n_traces), name="name")
+        return traces, parameters
+    return traces
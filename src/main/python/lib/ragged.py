@@ -0,0 +1,238 @@
+"""
+Packed storage of traces of different lengths. All frames are kept in flat
+per-frame arrays, one per column, and an offsets index marks where every
+trace starts, so that nothing is padded. Kernels reduce over the traces of
+the flat arrays directly, and pad() and buckets() make rectangular batches
+for consumers that need them, e.g.
+
+    traces = generate_traces(1000, trace_length=500, trace_lengths=(50, 500))
+    packed = PackedTraces.from_frame(traces)
+    mean_E = packed.mean("E")
+    for names, X, mask in packed.buckets(batch_size=32, columns=("DD", "DA")):
+        ...
+"""
+
+import numpy as np
+import pandas as pd
+
+# Per-frame columns packed by default
+COLUMNS = ("DD", "DA", "AA", "E", "E_true", "S", "label")
+
+
+def lengths_to_offsets(lengths):
+    """(N + 1,) offsets of traces with the given lengths"""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+class PackedTraces:
+    """
+    Traces of different lengths, packed into flat per-frame arrays. The
+    frames of trace i are [offsets[i], offsets[i + 1]) of every column.
+
+    Parameters
+    ----------
+    columns:
+        Dict of flat per-frame arrays
+    offsets:
+        (N + 1,) start of every trace, and the total number of frames
+    names:
+        (N,) name of every trace. Defaults to 0, ..., N - 1.
+    """
+
+    def __init__(self, columns, offsets, names=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.columns = dict(columns)
+        for key, values in self.columns.items():
+            if len(values) != self.offsets[-1]:
+                raise ValueError(
+                    "Column '{}' has {} frames, but the offsets {}".format(
+                        key, len(values), self.offsets[-1]
+                    )
+                )
+        if names is None:
+            names = np.arange(self.n_traces)
+        self.names = np.asarray(names)
+
+    @classmethod
+    def from_frame(cls, df, columns=None):
+        """
+        Packs a DataFrame of traces as returned by
+        lib.algorithms.generate_traces, with the frames of every trace
+        in a contiguous run
+        """
+        if columns is None:
+            columns = [c for c in COLUMNS if c in df]
+        name = df["name"].values
+        starts = np.flatnonzero(np.r_[True, name[1:] != name[:-1]])
+        offsets = np.append(starts, len(df))
+        return cls(
+            {c: df[c].values for c in columns}, offsets, names=name[starts]
+        )
+
+    @classmethod
+    def from_batch(cls, batch, columns=COLUMNS, first_name=0):
+        """
+        Packs a simulated lib.batch.TraceBatch, ending every trace at its
+        length
+        """
+        to_numpy = batch.backend.to_numpy
+        lengths = to_numpy(batch.lengths)
+        valid = to_numpy(batch.valid)
+        packed = {}
+        for c in columns:
+            values = getattr(batch, c)
+            if values is not None:
+                packed[c] = to_numpy(values)[valid]
+        names = np.arange(first_name, first_name + batch.n_traces)
+        return cls(packed, lengths_to_offsets(lengths), names=names)
+
+    def __len__(self):
+        return self.n_traces
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @property
+    def n_traces(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def trace(self, i):
+        """Dict of the columns of the i-th trace, as views"""
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return {c: values[start:stop] for c, values in self.columns.items()}
+
+    def segment_ids(self):
+        """Trace index of every frame"""
+        return np.repeat(np.arange(self.n_traces), self.lengths)
+
+    def positions(self):
+        """Frame index within its trace of every frame"""
+        return np.arange(self.offsets[-1]) - np.repeat(
+            self.offsets[:-1], self.lengths
+        )
+
+    def reduce(self, column, ufunc=np.add, empty=np.nan):
+        """
+        Reduces every trace of a column with a ufunc, e.g. np.add or
+        np.maximum. Empty traces are set to empty.
+        """
+        values = np.asarray(self.columns[column])
+        out = np.full(self.n_traces, empty, dtype=np.result_type(values, empty))
+        nonempty = self.lengths > 0
+        if nonempty.any():
+            out[nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty])
+        return out
+
+    def sum(self, column):
+        return self.reduce(column, np.add, empty=0)
+
+    def mean(self, column):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum(column) / self.lengths
+
+    def std(self, column):
+        mean = self.mean(column)
+        dev = self.columns[column] - np.repeat(mean, self.lengths)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(
+                np.bincount(
+                    self.segment_ids(), weights=dev**2, minlength=len(self)
+                )
+                / self.lengths
+            )
+
+    def select(self, idx):
+        """Packs the traces idx (indices or a mask) into new PackedTraces"""
+        idx = np.arange(self.n_traces)[idx]
+        lengths = self.lengths[idx]
+        offsets = lengths_to_offsets(lengths)
+        # Old frame of every new frame
+        frames = np.arange(offsets[-1]) + np.repeat(
+            self.offsets[idx] - offsets[:-1], lengths
+        )
+        return PackedTraces(
+            {c: values[frames] for c, values in self.columns.items()},
+            offsets,
+            names=self.names[idx],
+        )
+
+    def pad(self, columns=None, length=None, fill=np.nan, idx=None):
+        """
+        Rectangular copy of traces, for consumers that need one
+
+        Parameters
+        ----------
+        columns:
+            Columns to pad, stacked along the last axis. Defaults to all.
+        length:
+            Padded length. Defaults to the longest trace, and longer traces
+            are cut.
+        fill:
+            Value of the padding
+        idx:
+            Traces to pad (indices or a mask). Defaults to all.
+
+        Returns
+        -------
+        Tuple of an (n, length, columns) array and the (n, length) mask of
+        the frames that aren't padding
+        """
+        if columns is None:
+            columns = list(self.columns)
+        idx = np.arange(self.n_traces)[slice(None) if idx is None else idx]
+        lengths = self.lengths[idx]
+        if length is None:
+            length = int(lengths.max()) if len(lengths) > 0 else 0
+        mask = np.arange(length)[None, :] < lengths[:, None]
+        frames = (self.offsets[idx][:, None] + np.arange(length))[mask]
+
+        out = np.full((len(idx), length, len(columns)), fill, dtype=float)
+        for c, column in enumerate(columns):
+            out[:, :, c][mask] = self.columns[column][frames]
+        return out, mask
+
+    def buckets(self, batch_size=32, columns=None, fill=np.nan, shuffle=None):
+        """
+        Yields rectangular batches of traces of similar length, so that
+        little padding is needed. Traces are sorted by length and cut into
+        batches of batch_size, each padded to its longest trace.
+
+        Parameters
+        ----------
+        batch_size:
+            Traces per batch
+        columns, fill:
+            As in pad
+        shuffle:
+            numpy Generator to shuffle the order of the batches with, or None
+            to yield them from short to long
+
+        Yields
+        ------
+        Tuples of (names, (n, length, columns) array, (n, length) mask)
+        """
+        order = np.argsort(self.lengths, kind="stable")
+        batches = [
+            order[start : start + batch_size]
+            for start in range(0, len(order), batch_size)
+        ]
+        if shuffle is not None:
+            batches = [batches[i] for i in shuffle.permutation(len(batches))]
+        for idx in batches:
+            X, mask = self.pad(columns=columns, fill=fill, idx=idx)
+            yield self.names[idx], X, mask
+
+    def to_frame(self):
+        """DataFrame of the traces, with name and frame columns"""
+        df = pd.DataFrame(self.columns)
+        positions = self.positions()
+        df["frame"] = positions + 1
+        df["name"] = np.repeat(self.names, self.lengths)
+        df.index = positions
+        return df
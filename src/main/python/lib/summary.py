@@ -0,0 +1,257 @@
+"""
+Summary statistics of a generated dataset, accumulated batch by batch while
+it's being generated, so the full dataset never has to be grouped again.
+Memory doesn't grow with the number of traces: counts are kept per class,
+histograms per bin, and everything else as running moments, e.g.
+
+    summary = DatasetSummary()
+    traces = generate_traces(10 ** 6, batch_callback=summary.update_frame)
+    summary.to_html("summary.html")
+"""
+
+import html
+import json
+
+import numpy as np
+
+import lib.labels
+import lib.ragged
+
+
+class RunningMoments:
+    """Count, mean, standard deviation, min and max of a stream of values"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """Adds values, merging their moments with Chan's formula"""
+        values = np.asarray(values, dtype=float).ravel()
+        n = len(values)
+        if n == 0:
+            return
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def to_dict(self):
+        if self.n == 0:
+            return {"count": 0}
+        return {
+            "count": self.n,
+            "mean": self.mean,
+            "std": np.sqrt(self.m2 / self.n),
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+class SparseHistogram:
+    """
+    Histogram of a stream of values, with bins of a fixed width that are
+    only stored once a value falls into them. Non-finite values are counted
+    separately.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.counts = {}
+        self.non_finite = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        finite = np.isfinite(values)
+        self.non_finite += int((~finite).sum())
+        bins, counts = np.unique(
+            np.floor(values[finite] / self.width).astype(np.int64),
+            return_counts=True,
+        )
+        for b, c in zip(bins.tolist(), counts.tolist()):
+            self.counts[b] = self.counts.get(b, 0) + c
+
+    def to_dict(self):
+        bins = sorted(self.counts)
+        return {
+            "width": self.width,
+            "edges": [b * self.width for b in bins],
+            "counts": [self.counts[b] for b in bins],
+            "non_finite": self.non_finite,
+        }
+
+
+class DatasetSummary:
+    """
+    Streaming summary of a dataset: traces and frames per class, bleaching
+    times, noise levels, numbers of states and minimum state differences.
+    Feed it the DataFrame of every batch, e.g. as batch_callback of
+    lib.algorithms.generate_traces.
+
+    Parameters
+    ----------
+    bleach_width:
+        Width of the bleaching time histogram bins, in frames
+    noise_width, diff_width:
+        Width of the noise level and minimum state difference histogram bins
+    """
+
+    def __init__(self, bleach_width=10, noise_width=0.01, diff_width=0.01):
+        self.n_traces = 0
+        self.n_frames = 0
+        self.trace_classes = {}
+        self.frame_classes = {}
+        self.n_states = {}
+        self.unbleached = 0
+        self.bleaches_at = SparseHistogram(bleach_width)
+        self.noise = SparseHistogram(noise_width)
+        self.noise_moments = RunningMoments()
+        self.min_state_diff = SparseHistogram(diff_width)
+        self.min_state_diff_moments = RunningMoments()
+        self.lengths = RunningMoments()
+
+    @staticmethod
+    def _count(table, values):
+        keys, counts = np.unique(values, return_counts=True)
+        for k, c in zip(keys.tolist(), counts.tolist()):
+            table[k] = table.get(k, 0) + c
+
+    def update_frame(self, df):
+        """Adds the traces of a DataFrame, as returned by generate_traces"""
+        if len(df) == 0:
+            return
+        packed = lib.ragged.PackedTraces.from_frame(df, columns=["label"])
+        firsts = packed.offsets[:-1]
+        self.n_traces += packed.n_traces
+        self.n_frames += len(df)
+        self.lengths.update(packed.lengths)
+
+        # Padding as bleached doesn't change the class of a trace
+        label, _ = packed.pad(fill=lib.labels.Label.BLEACHED)
+        classes = lib.labels.trace_labels(label[:, :, 0]).astype(int)
+        self._count(self.trace_classes, classes)
+        self._count(self.frame_classes, packed["label"].astype(int))
+        k = lib.labels.n_states(classes)
+        self._count(self.n_states, k[k > 0])
+
+        bleaches_at = df["_bleaches_at"].values[firsts]
+        never = np.array([b is None for b in bleaches_at])
+        self.unbleached += int(never.sum())
+        self.bleaches_at.update(bleaches_at[~never].astype(float))
+
+        noise = df["_noise_level"].values[firsts]
+        self.noise.update(noise)
+        self.noise_moments.update(noise)
+
+        diff = df["_min_state_diff"].values[firsts].astype(float)
+        self.min_state_diff.update(diff)
+        self.min_state_diff_moments.update(diff[np.isfinite(diff)])
+
+    def _named(self, table):
+        return {
+            lib.labels.class_name(label) if label >= 0 else "unlabelled": count
+            for label, count in sorted(table.items())
+        }
+
+    def to_dict(self):
+        """Summary as a dict of plain Python values"""
+        return {
+            "n_traces": self.n_traces,
+            "n_frames": self.n_frames,
+            "trace_length": self.lengths.to_dict(),
+            "traces_per_class": self._named(self.trace_classes),
+            "frames_per_class": self._named(self.frame_classes),
+            "n_states": {str(k): c for k, c in sorted(self.n_states.items())},
+            "bleaching": {
+                "unbleached": self.unbleached,
+                "histogram": self.bleaches_at.to_dict(),
+            },
+            "noise_level": {
+                "stats": self.noise_moments.to_dict(),
+                "histogram": self.noise.to_dict(),
+            },
+            "min_state_diff": {
+                "stats": self.min_state_diff_moments.to_dict(),
+                "histogram": self.min_state_diff.to_dict(),
+            },
+        }
+
+    def to_json(self, path=None):
+        """Writes the summary to a JSON file, or returns it as a string"""
+        text = json.dumps(self.to_dict(), indent=2, default=float)
+        if path is None:
+            return text
+        with open(path, "w") as f:
+            f.write(text)
+
+    def to_html(self, path=None):
+        """Writes the summary to an HTML file, or returns it as a string"""
+
+        def table(rows):
+            cells = "".join(
+                "<tr><td>{}</td><td>{}</td></tr>".format(
+                    html.escape(str(k)), html.escape(_format(v))
+                )
+                for k, v in rows
+            )
+            return "<table>{}</table>".format(cells)
+
+        def histogram(h):
+            return table(
+                ("{:g}".format(edge), count)
+                for edge, count in zip(h["edges"], h["counts"])
+            )
+
+        summary = self.to_dict()
+        sections = [
+            (
+                "Dataset",
+                [
+                    ("traces", summary["n_traces"]),
+                    ("frames", summary["n_frames"]),
+                ]
+                + list(summary["trace_length"].items()),
+            ),
+            ("Traces per class", summary["traces_per_class"].items()),
+            ("Frames per class", summary["frames_per_class"].items()),
+            ("Number of states", summary["n_states"].items()),
+            ("Noise level", summary["noise_level"]["stats"].items()),
+            (
+                "Minimum state difference",
+                summary["min_state_diff"]["stats"].items(),
+            ),
+        ]
+        body = "".join(
+            "<h2>{}</h2>{}".format(title, table(rows))
+            for title, rows in sections
+        )
+        body += "<h2>Bleaching times</h2>{}{}".format(
+            table([("unbleached", summary["bleaching"]["unbleached"])]),
+            histogram(summary["bleaching"]["histogram"]),
+        )
+        body += "<h2>Noise level histogram</h2>{}".format(
+            histogram(summary["noise_level"]["histogram"])
+        )
+        text = (
+            "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+            "<title>Dataset summary</title></head>"
+            "<body><h1>Dataset summary</h1>{}</body></html>".format(body)
+        )
+        if path is None:
+            return text
+        with open(path, "w") as f:
+            f.write(text)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return "{:.4g}".format(value)
+    return str(value)
@@ -0,0 +1,227 @@
+"""
+Parameter sweeps over generate_traces. Every point of a grid (or random
+search space) is generated in a pool of warm worker processes and written to
+its own file, and a manifest keeps track of what has been completed, so an
+interrupted sweep can simply be started again.
+
+Usage from the command line:
+    python -m lib.sweep sweep.json --outdir sweeps/run1 --processes 8
+
+where sweep.json looks like e.g.
+    {
+        "n_traces": 10000,
+        "params": {"trace_length": 300},
+        "grid": {"noise": [0.05, 0.1, [0.1, 0.2]], "trans_prob": [0.05, 0.1]}
+    }
+or, for a random search, uses "space", "n_points" and "seed" instead of
+"grid", with each entry of the space given as {"uniform": [low, high]} or
+{"choice": [...]}.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _as_param(value):
+    """JSON has no tuples, so lists are turned back into (low, high) ranges"""
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def expand_grid(grid):
+    """
+    Returns every combination of a parameter grid, e.g.
+    {"noise": [0.1, 0.2], "trans_prob": [0.05, 0.1]} gives 4 points.
+    """
+    keys = sorted(grid.keys())
+    return [
+        {k: _as_param(v) for k, v in zip(keys, values)}
+        for values in itertools.product(*(grid[k] for k in keys))
+    ]
+
+
+def sample_space(space, n_points, seed=None):
+    """
+    Returns n_points random points from a search space. Tuples are sampled
+    uniformly as (low, high) ranges, lists are sampled as choices and anything
+    else is kept fixed.
+    """
+    rng = np.random.RandomState(seed)
+    points = []
+    for _ in range(n_points):
+        point = {}
+        for k in sorted(space.keys()):
+            v = space[k]
+            if isinstance(v, tuple):
+                point[k] = float(rng.uniform(*v))
+            elif isinstance(v, list):
+                point[k] = _as_param(v[rng.randint(len(v))])
+            else:
+                point[k] = v
+        points.append(point)
+    return points
+
+
+def point_id(params):
+    """Stable identifier of a sweep point, used for its output file"""
+    s = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()[:12]
+
+
+def load_manifest(outdir):
+    """Returns the manifest of a sweep directory, keyed by point id"""
+    path = os.path.join(outdir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(outdir, manifest):
+    """Writes the manifest atomically, so a crash never leaves it truncated"""
+    path = os.path.join(outdir, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+
+
+def _init_worker():
+    """Imports the simulation stack once per worker, instead of once per point"""
+    import lib.algorithms  # noqa: F401
+    import pomegranate  # noqa: F401
+
+
+def _run_point(args):
+    """Generates and saves a single sweep point. Runs in a worker process"""
+    import lib.algorithms
+    import lib.utils
+
+    pid, params, n_traces, outdir = args
+    path = os.path.join(outdir, "{}.pkl".format(pid))
+    t0 = time.time()
+    try:
+        df = lib.algorithms.generate_traces(
+            n_traces=n_traces,
+            progressbar_callback=lib.utils.NoProgress(),
+            **params
+        )
+        # Write to a temporary file first, so a half-written file is never
+        # mistaken for a finished point
+        df.to_pickle(path + ".tmp")
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        return pid, {"status": "failed", "error": repr(e)}
+    return pid, {
+        "status": "done",
+        "file": os.path.basename(path),
+        "elapsed": time.time() - t0,
+    }
+
+
+def run_sweep(points, n_traces, outdir, base_params=None, processes=None):
+    """
+    Generates a dataset for every sweep point in a pool of worker processes.
+
+    Parameters
+    ----------
+    points:
+        List of parameter dicts for generate_traces (see expand_grid and
+        sample_space)
+    n_traces:
+        Number of traces to generate per point
+    outdir:
+        Directory to write each point's dataset and the manifest to
+    base_params:
+        Parameters shared by all points. Point parameters take precedence.
+    processes:
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    The manifest, keyed by point id. Points already completed in outdir are
+    skipped.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    base_params = {} if base_params is None else base_params
+
+    manifest = load_manifest(outdir)
+    jobs = []
+    for point in points:
+        params = {**base_params, **point}
+        pid = point_id(params)
+        entry = manifest.get(pid)
+        if (
+            entry is not None
+            and entry["status"] == "done"
+            and entry["n_traces"] == n_traces
+            and os.path.exists(os.path.join(outdir, entry["file"]))
+        ):
+            continue
+        manifest[pid] = {"params": params, "n_traces": n_traces}
+        jobs.append((pid, params, n_traces, outdir))
+
+    with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+        for pid, result in pool.imap_unordered(_run_point, jobs):
+            manifest[pid].update(result)
+            _write_manifest(outdir, manifest)
+
+    _write_manifest(outdir, manifest)
+    return manifest
+
+
+def load_sweep(outdir):
+    """Yields (params, dataframe) for every completed point of a sweep"""
+    for pid, entry in load_manifest(outdir).items():
+        if entry.get("status") == "done":
+            path = os.path.join(outdir, entry["file"])
+            yield entry["params"], pd.read_pickle(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("config", help="JSON file describing the sweep")
+    parser.add_argument("--outdir", required=True)
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    if "grid" in config:
+        points = expand_grid(config["grid"])
+    else:
+        space = {}
+        for k, v in config["space"].items():
+            if isinstance(v, dict) and "uniform" in v:
+                space[k] = tuple(v["uniform"])
+            elif isinstance(v, dict) and "choice" in v:
+                space[k] = v["choice"]
+            else:
+                space[k] = v
+        points = sample_space(space, config["n_points"], config.get("seed"))
+
+    base_params = {k: _as_param(v) for k, v in config.get("params", {}).items()}
+    manifest = run_sweep(
+        points,
+        n_traces=config["n_traces"],
+        outdir=args.outdir,
+        base_params=base_params,
+        processes=args.processes,
+    )
+    n_done = sum(e.get("status") == "done" for e in manifest.values())
+    print("{}/{} sweep points completed".format(n_done, len(manifest)))
+
+
+if __name__ == "__main__":
+    main()
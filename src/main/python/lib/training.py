@@ -0,0 +1,257 @@
+"""
+On-the-fly training data. TrainingData is an endless iterator of (X, y)
+minibatches of freshly simulated traces, produced by a pool of worker
+processes ahead of time, so that simulation overlaps with training, e.g.
+
+    with TrainingData(batch_size=64, channels=("DD", "DA", "AA")) as data:
+        for step, (X, y) in zip(range(10000), data):
+            model.train_on_batch(X, y)
+"""
+
+import multiprocessing
+import queue
+
+import numpy as np
+
+CHANNELS = ("DD", "DA", "AA", "E", "S", "E_true")
+NORMALIZATIONS = (None, "max", "zscore")
+
+# Intensity channels, which are normalized together by "max"
+INTENSITIES = ("DD", "DA", "AA")
+
+
+def batch_arrays(batch, channels=("DD", "DA", "AA"), normalize=None):
+    """
+    Converts a simulated lib.batch.TraceBatch into arrays for training.
+
+    Parameters
+    ----------
+    batch:
+        Simulated batch
+    channels:
+        Channels of X, in order, from CHANNELS. Non-finite values of E and S
+        are set to 0.
+    normalize:
+        None to keep the signals as simulated, "max" to divide the intensity
+        channels of every trace by their common maximum, or "zscore" to
+        standardize every channel of every trace
+
+    Returns
+    -------
+    Tuple of X, of shape (N, T, channels), and the per-frame labels y, of
+    shape (N, T). Frames after the end of traces shorter than T are 0 in X
+    and -1 in y.
+    """
+    if normalize not in NORMALIZATIONS:
+        raise ValueError("Unknown normalization '{}'".format(normalize))
+    to_numpy = batch.backend.to_numpy
+    X = np.stack([to_numpy(getattr(batch, c)) for c in channels], axis=-1)
+    X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
+    valid = to_numpy(batch.valid)
+    X[~valid] = 0
+
+    if normalize == "max":
+        idx = [i for i, c in enumerate(channels) if c in INTENSITIES]
+        if idx:
+            peak = X[:, :, idx].max(axis=(1, 2), keepdims=True)
+            X[:, :, idx] /= np.where(peak > 0, peak, 1)
+    elif normalize == "zscore":
+        # Statistics of the frames within each trace's length only
+        n = valid.sum(axis=1)[:, None, None]
+        mean = X.sum(axis=1, keepdims=True) / n
+        X -= mean
+        X[~valid] = 0
+        std = np.sqrt((X**2).sum(axis=1, keepdims=True) / n)
+        X /= np.where(std > 0, std, 1)
+
+    y = to_numpy(batch.label).astype(int)
+    y[~valid] = -1
+    return X, y
+
+
+def _simulate(config, backend, index):
+    """Simulates one chunk of traces with the stream index, as (X, y)"""
+    import lib.batch
+
+    backend.stream(index)
+    batch = lib.batch.TraceBatch(
+        config["chunk_size"], config["trace_length"], backend
+    )
+    config["pipeline"].run(batch)
+    return batch_arrays(batch, config["channels"], config["normalize"])
+
+
+def _make_config(config):
+    """Builds the pipeline of a config, in the process that runs it"""
+    import lib.pipeline
+
+    config = dict(config)
+    if config["pipeline"] is None:
+        config["pipeline"] = lib.pipeline.build_pipeline(**config["params"])
+    return config
+
+
+def _worker(config, worker_id, seed, out, stop):
+    """Fills the queue with minibatches until told to stop"""
+    import lib.backend
+
+    config = _make_config(config)
+    backend = lib.backend.get_backend(
+        config["backend"], seed=None if seed is None else [seed, worker_id]
+    )
+    size = config["batch_size"]
+    index = 0
+    while not stop.is_set():
+        X, y = _simulate(config, backend, index)
+        index += 1
+        for start in range(0, len(X) - size + 1, size):
+            item = (X[start : start + size], y[start : start + size])
+            # Time out regularly, to notice being stopped while the queue is
+            # full
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+
+class TrainingData:
+    """
+    Endless iterator of (X, y) minibatches of simulated traces, with X of
+    shape (batch_size, trace_length, channels) and y the per-frame labels, of
+    shape (batch_size, trace_length).
+
+    Traces are simulated chunk_size at a time by worker processes, which
+    keep a queue of up to prefetch minibatches filled. Call close() (or use
+    as a context manager) to stop the workers.
+
+    Parameters
+    ----------
+    batch_size:
+        Traces per minibatch
+    channels, normalize:
+        As in batch_arrays
+    processes:
+        Number of worker processes. With 0, traces are simulated in the
+        calling process whenever a minibatch is requested.
+    prefetch:
+        Number of minibatches to keep ready
+    chunk_size:
+        Traces simulated at once by a worker. Defaults to the largest
+        multiple of batch_size up to 1000.
+    seed:
+        Random seed. Every worker draws from its own streams, but the order
+        in which minibatches of different workers arrive isn't fixed.
+    trace_length, backend:
+        As in lib.algorithms.generate_traces
+    pipeline:
+        Simulation pipeline. Defaults to lib.pipeline.build_pipeline(**params)
+    **params:
+        Simulation parameters, as in lib.algorithms.generate_traces
+    """
+
+    def __init__(
+        self,
+        batch_size=32,
+        channels=("DD", "DA", "AA"),
+        normalize="max",
+        processes=2,
+        prefetch=16,
+        chunk_size=None,
+        seed=None,
+        trace_length=200,
+        backend="numpy",
+        pipeline=None,
+        **params
+    ):
+        unknown = set(channels) - set(CHANNELS)
+        if unknown:
+            raise ValueError("Unknown channels {}".format(sorted(unknown)))
+        if normalize not in NORMALIZATIONS:
+            raise ValueError("Unknown normalization '{}'".format(normalize))
+        if chunk_size is None:
+            chunk_size = max(1, 1000 // batch_size) * batch_size
+        if chunk_size < batch_size:
+            raise ValueError("chunk_size must be at least batch_size")
+
+        self.config = {
+            "batch_size": batch_size,
+            "channels": tuple(channels),
+            "normalize": normalize,
+            "chunk_size": chunk_size,
+            "trace_length": trace_length,
+            "backend": backend,
+            "pipeline": pipeline,
+            "params": params,
+        }
+        self.seed = seed
+        self.processes = processes
+        self.workers = []
+
+        if processes == 0:
+            import lib.backend
+
+            self._local = _make_config(self.config)
+            self._backend = lib.backend.get_backend(backend, seed=seed)
+            self._index = 0
+            self._pending = []
+        else:
+            self.queue = multiprocessing.Queue(maxsize=prefetch)
+            self.stop = multiprocessing.Event()
+            for i in range(processes):
+                worker = multiprocessing.Process(
+                    target=_worker,
+                    args=(self.config, i, seed, self.queue, self.stop),
+                    daemon=True,
+                )
+                worker.start()
+                self.workers.append(worker)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.processes > 0:
+            while True:
+                try:
+                    return self.queue.get(timeout=1)
+                except queue.Empty:
+                    if not any(w.is_alive() for w in self.workers):
+                        raise RuntimeError("All workers have stopped")
+
+        if not self._pending:
+            X, y = _simulate(self._local, self._backend, self._index)
+            self._index += 1
+            size = self.config["batch_size"]
+            self._pending = [
+                (X[start : start + size], y[start : start + size])
+                for start in range(0, len(X) - size + 1, size)
+            ][::-1]
+        return self._pending.pop()
+
+    def close(self):
+        """Stops the workers"""
+        if self.processes == 0 or not self.workers:
+            return
+        self.stop.set()
+        # Drain the queue, so that workers aren't kept alive by buffered data
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,236 @@
+"""
+Shared-memory transport for generating traces in parallel. The parent
+preallocates a (N, T, channels) block in shared memory, workers run the
+simulation pipeline and write the signal arrays of every batch straight into
+it, and only send back small per-trace metadata records. The final DataFrame
+is assembled on top of the block without copying it.
+"""
+
+import multiprocessing
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# Per-frame columns written to shared memory, in channel order
+SIGNAL_COLUMNS = ("DD", "DA", "AA", "E", "E_true", "S", "label")
+
+# Per-frame columns of the background, with real background added
+BACKGROUND_COLUMNS = ("DD_bg", "DA_bg", "AA_bg")
+
+# Per-trace columns sent back as metadata
+META_COLUMNS = ("_bleaches_at", "_noise_level", "_min_state_diff")
+
+
+def _signal_columns(params):
+    """Per-frame columns of the traces generated with params"""
+    pipeline = params.get("pipeline")
+    if pipeline is not None:
+        with_background = any(
+            s.name == "background" and s.name not in pipeline.disabled
+            for s in pipeline.stages
+        )
+    else:
+        with_background = params.get("background_pool") is not None
+    if with_background:
+        return SIGNAL_COLUMNS + BACKGROUND_COLUMNS
+    return SIGNAL_COLUMNS
+
+
+class SharedTraceBuffer:
+    """
+    A (n_traces, trace_length, channels) float64 block in shared memory.
+    Created by the parent, and attached to by name in workers.
+    """
+
+    def __init__(self, shape, name=None):
+        self.shape = tuple(shape)
+        self.create = name is None
+        if self.create:
+            size = int(np.prod(self.shape)) * np.dtype(np.float64).itemsize
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=max(size, 1)
+            )
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.array = np.ndarray(
+            self.shape, dtype=np.float64, buffer=self.shm.buf
+        )
+
+    def close(self):
+        """Detaches from the block. Call in workers when done writing"""
+        self.array = None
+        self.shm.close()
+
+    def release(self):
+        """
+        Hands the block over to the returned array, and removes its name from
+        the system. The memory is freed once the array (and every view of it)
+        is garbage collected, so nothing is copied and nothing leaks.
+        """
+        array = self.array
+        self.array = None
+        self.shm.unlink()
+        weakref.finalize(array, self.shm.close)
+        return array
+
+
+def _init_worker():
+    """Imports the simulation stack once per worker, instead of once per chunk"""
+    import lib.algorithms  # noqa: F401
+
+
+def _generate_chunk(args):
+    """
+    Simulates traces [start, stop) and writes their signals straight into
+    shared memory, batch by batch. Runs in a worker
+    """
+    import lib.algorithms
+    import lib.backend
+    import lib.pipeline
+
+    name, shape, start, stop, columns, params = args
+    # Name of the chunk's first trace, which is row start of the block
+    first_trace = params["first_trace"]
+    backend = lib.backend.get_backend(
+        params.get("backend", "numpy"), seed=params["seed"]
+    )
+
+    buffer = SharedTraceBuffer(shape, name=name)
+    # Traces can be discarded with discard_unbleached, which leaves them at
+    # length 0
+    lengths = np.zeros(stop - start, dtype=int)
+    meta = [[] for _ in META_COLUMNS]
+    for batch_start, batch in lib.algorithms.simulate_batches(
+        params["pipeline"],
+        backend,
+        first_trace,
+        first_trace + stop - start,
+        params.get("batch_size", 1000),
+        shape[1],
+    ):
+        offset = batch_start - first_trace
+        rows = slice(start + offset, start + offset + batch.n_traces)
+        signals = lib.pipeline.batch_signals(batch)
+        for c, column in enumerate(columns):
+            buffer.array[rows, :, c] = signals[column]
+
+        keep = lib.pipeline.kept_traces(
+            batch, params.get("discard_unbleached", False)
+        )
+        lengths[offset : offset + batch.n_traces] = np.where(
+            keep, batch.lengths, 0
+        )
+        metadata = lib.pipeline.batch_metadata(batch, keep)
+        for values, column in zip(meta, META_COLUMNS):
+            values.extend(metadata[column].tolist())
+    buffer.close()
+    return start, lengths, meta
+
+
+def generate_traces_shared(
+    n_traces,
+    trace_length=200,
+    processes=None,
+    chunk_size=None,
+    seed=None,
+    progressbar_callback=None,
+    callback_every=1,
+    first_trace=0,
+    **params
+):
+    """
+    Generates traces in a pool of worker processes, transporting signals
+    through shared memory. Takes the same parameters as
+    lib.algorithms.generate_traces and returns the same DataFrame, except
+    that the per-frame signal columns come first.
+
+    Batches draw from the same random streams as in a single process, so
+    with a seed the traces are identical to those of a single-process run.
+    For that, chunk_size must be a multiple of batch_size. It defaults to
+    the multiple of batch_size closest to 1000 traces.
+    """
+    batch_size = params.get("batch_size", 1000)
+    if chunk_size is None:
+        chunk_size = batch_size * max(1, round(1000 / batch_size))
+    elif chunk_size % batch_size != 0:
+        raise ValueError(
+            "chunk_size {} isn't a multiple of batch_size {}".format(
+                chunk_size, batch_size
+            )
+        )
+    if params.get("pipeline") is None:
+        import inspect
+
+        import lib.pipeline
+
+        # Workers run the pipeline, so it's built once here
+        names = inspect.signature(lib.pipeline.build_pipeline).parameters
+        params["pipeline"] = lib.pipeline.build_pipeline(
+            **{k: v for k, v in params.items() if k in names}
+        )
+    n_chunks = int(np.ceil(n_traces / chunk_size))
+    columns = _signal_columns(params)
+    shape = (n_traces, trace_length, len(columns))
+    buffer = SharedTraceBuffer(shape)
+
+    jobs = []
+    for start in range(0, n_traces, chunk_size):
+        stop = min(start + chunk_size, n_traces)
+        chunk_params = dict(
+            params,
+            trace_length=trace_length,
+            seed=seed,
+            first_trace=first_trace + start,
+        )
+        jobs.append((buffer.name, shape, start, stop, columns, chunk_params))
+
+    lengths = np.zeros(n_traces, dtype=int)
+    meta = {column: [None] * n_traces for column in META_COLUMNS}
+    try:
+        with multiprocessing.Pool(
+            min(processes or multiprocessing.cpu_count(), n_chunks),
+            initializer=_init_worker,
+        ) as pool:
+            for start, chunk_lengths, chunk_meta in pool.imap_unordered(
+                _generate_chunk, jobs
+            ):
+                lengths[start : start + len(chunk_lengths)] = chunk_lengths
+                idx = start + np.flatnonzero(chunk_lengths)
+                for column, values in zip(META_COLUMNS, chunk_meta):
+                    for i, v in zip(idx, values):
+                        meta[column][i] = v
+                if progressbar_callback is not None:
+                    for _ in range(len(chunk_lengths) // callback_every):
+                        progressbar_callback.increment()
+        signals = buffer.release()
+    except BaseException:
+        buffer.close()
+        buffer.shm.unlink()
+        raise
+
+    names = np.flatnonzero(lengths)
+    lengths = lengths[names]
+    if (lengths == trace_length).all():
+        if len(names) < n_traces:
+            # Discarded traces leave holes, which can only be removed by
+            # copying
+            signals = signals[names]
+        signals = signals.reshape(-1, len(columns))
+        frames = np.tile(np.arange(trace_length), len(names))
+    else:
+        # Traces shorter than trace_length are packed, which copies
+        valid = np.arange(trace_length)[None, :] < lengths[:, None]
+        signals = signals[names][valid]
+        frames = np.nonzero(valid)[1]
+
+    df = pd.DataFrame(signals, columns=columns, index=frames, copy=False)
+    df["frame"] = frames + 1
+    df["name"] = np.repeat(first_trace + names, lengths)
+    for column in META_COLUMNS:
+        values = [meta[column][i] for i in names]
+        dtype = object if any(v is None for v in values) else None
+        df[column] = np.repeat(np.array(values, dtype=dtype), lengths)
+    return df
@@ -70,32 +70,10 @@ def plot_category(y, ax, alpha=0.2):
     colors:
         Colors to cycle through
     """
-    cls = {
-        0: "bleached",
-        1: "aggregate",
-        2: "noisy",
-        3: "scramble",
-        4: "1-state",
-        5: "2-state",
-        6: "3-state",
-        7: "4-state",
-        8: "5-state",
-    }
-
-    colors = {0: "darkgrey",
-              1: "red",
-              2: "blue",
-              3: "purple",
-              4: "orange",
-              5: "lightgreen",
-              6: "green",
-              7: "mediumseagreen",
-              8: "darkolivegreen"}
+    import lib.labels
 
     y_ = y.argmax(axis=1) if len(y.shape) != 1 else y
-    y_ = y_.astype(int)  # type conversion to avoid float type labels
-    if len(colors) < len(set(y_)):
-        raise ValueError("Must have at least a color for each class")
+    y_ = np.asarray(y_).astype(int)  # avoid float type labels
 
     adjs, lns = count_adjacent_values(y_)
     position = range(len(y_))
@@ -105,9 +83,10 @@ def plot_category(y, ax, alpha=0.2):
             xmin=position[idx],
             xmax=position[idx] + ln,
             alpha=alpha,
-            facecolor=colors[label],
+            facecolor=lib.labels.class_color(label),
         )
-    ax.plot([], label = cls[y_[0]], color = colors[y_[0]])
+    ax.plot([], label = lib.labels.class_name(y_[0]),
+            color = lib.labels.class_color(y_[0]))
     ax.legend(loc = "upper right")
 
 
@@ -116,4 +95,11 @@ def min_none(ls):
     try:
         return min(ls)
     except TypeError:
-        return None
\ No newline at end of file
+        return None
+
+
+class NoProgress:
+    """Progressbar stand-in that shows nothing, e.g. in worker processes"""
+
+    def increment(self):
+        pass
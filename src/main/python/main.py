@@ -3,17 +3,18 @@ from typing import List, Tuple, Union
 import os
 import time
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from PyQt5.QtWidgets import *
 from fbs_runtime.application_context.PyQt5 import ApplicationContext
+from matplotlib.axes import Subplot
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure, SubplotParams
 from matplotlib.gridspec import GridSpec, GridSpecFromSubplotSpec
 
-import lib.algorithms
 import lib.utils
+
+# pandas and lib.algorithms (and through it the simulation dependencies) are
+# imported on first use, so the window can be shown as early as possible
 from ui._MainWindow import Ui_MainWindow
 
 
@@ -130,7 +131,9 @@ class MainWindow(QMainWindow):
 
         self.connect_ui()
 
-        self.traces = pd.DataFrame()
+        self.traces = None
+        self.population = None
+        self.population_view = None
         self.values_from_gui()
 
         self.show()
@@ -281,8 +284,14 @@ class MainWindow(QMainWindow):
                 float(self.ui.inputScalerHi.value()),
             )
 
-    def set_traces(self, n_traces):
-        """Generate traces to show in the GUI or export"""
+    def set_traces(self, n_traces, population=False):
+        """
+        Generate traces to show in the GUI or export. With population, every
+        generated batch is added to the E-S population view, which only
+        shows full datasets and not the preview.
+        """
+        import lib.algorithms
+
         if n_traces > 50:
             update_freq = 5
             progressbar = ProgressBar(
@@ -292,6 +301,10 @@ class MainWindow(QMainWindow):
             update_freq = None
             progressbar = None
 
+        # The population view shows the latest dataset only
+        if population and self.population is not None:
+            self.population.reset()
+
         self.traces = lib.algorithms.generate_traces(
             n_traces=n_traces,
             aa_mismatch=self.inputs.aa_mismatch,
@@ -314,11 +327,29 @@ class MainWindow(QMainWindow):
             acceptable_noise=0.25,
             progressbar_callback=progressbar,
             callback_every=update_freq,
+            batch_callback=self.update_population if population else None,
         )
 
         if progressbar is not None:
             progressbar.close()
 
+    def update_population(self, batch):
+        """Adds a generated batch to the E-S population view, and redraws it"""
+        import lib.population
+        from lib.mpl_layout import PlotWidget
+
+        if self.population_view is None:
+            self.population_view = PlotWidget(width=5, height=5)
+            self.population_view.setWindowTitle("E-S population")
+            self.population_view.canvas.setupJointGridLayout()
+        if self.population is None:
+            self.population = lib.population.PopulationHistogram()
+
+        self.population.update_frame(batch)
+        self.population.draw(self.population_view.canvas)
+        self.population_view.show()
+        appctxt.app.processEvents()
+
     def refresh_plots(self):
         """Refreshes preview plots"""
         self.values_from_gui()
@@ -348,7 +379,7 @@ class MainWindow(QMainWindow):
                 height_ratios=[3, 3, 3, 3, 1],
             )
             axes = [
-                plt.Subplot(self.canvas.fig, inner_subplot[n]) for n in range(5)
+                Subplot(self.canvas.fig, inner_subplot[n]) for n in range(5)
             ]
             ax_g_r, ax_red, ax_frt, ax_sto, ax_lbl = axes
             bleach = trace["_bleaches_at"].values[0]
@@ -394,7 +425,13 @@ class MainWindow(QMainWindow):
         """
         Opens a folder dialog to save traces to ASCII .txt files
         """
-        self.set_traces(n_traces=int(self.ui.inputNumberOfTraces.value()))
+        import pandas as pd
+
+        import lib.background
+
+        self.set_traces(
+            n_traces=int(self.ui.inputNumberOfTraces.value()), population=True
+        )
         df = self.traces
 
         diag = ExportDialog(init_dir="~/Desktop/", accept_label="Export")
@@ -411,7 +448,6 @@ class MainWindow(QMainWindow):
 
         if outdir is not None:
             for idx, trace in df.groupby(df.index):
-                bg = np.zeros(len(trace))
                 path = os.path.join(
                     outdir,
                     "trace_{}_{}.txt".format(idx, time.strftime("%Y%m%d_%H%M")),
@@ -419,9 +455,9 @@ class MainWindow(QMainWindow):
 
                 df = pd.DataFrame(
                     {
-                        "D-Dexc-bg": bg,
-                        "A-Dexc-bg": bg,
-                        "A-Aexc-bg": bg,
+                        "D-Dexc-bg": lib.background.trace_background(trace, "DD"),
+                        "A-Dexc-bg": lib.background.trace_background(trace, "DA"),
+                        "A-Aexc-bg": lib.background.trace_background(trace, "AA"),
                         "D-Dexc-rw": trace["DD"],
                         "A-Dexc-rw": trace["DA"],
                         "A-Aexc-rw": trace["AA"],
@@ -433,7 +469,7 @@ class MainWindow(QMainWindow):
                 date_txt = "Date: {}".format(time.strftime("%Y-%m-%d, %H:%M"))
                 mov_txt = "Movie filename: {}".format(None)
                 id_txt = "FRET pair #{}".format(idx)
-                bl_txt = "Bleaches at {}".format(trace["fb"].values[0])
+                bl_txt = "Bleaches at {}".format(trace["_bleaches_at"].values[0])
 
                 with open(path, "w") as f:
                     exp_txt = "Simulated trace exported by Fiddler"